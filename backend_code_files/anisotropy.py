@@ -0,0 +1,118 @@
+import csv
+import os
+from statistics import NormalDist
+import numpy as np
+from backend_code_files import chain_paths
+from backend_code_files import console
+from backend_code_files import site_index
+
+'''
+Site size that fits a chain of every sweep length at every sweep angle: the largest
+height and the largest width of "site_index.calc_site_height_width" over all of them
+INPUTS:
+    lengths_m: chain lengths in meters
+    angles: chain angles in degrees
+OUTPUTS:
+    site_height_m, site_width_m: the largest footprint
+'''
+def get_sweep_footprint(lengths_m, angles):
+    sizes = [site_index.calc_site_height_width(length, angle) for length in lengths_m for angle in angles]
+    return max(size[0] for size in sizes), max(size[1] for size in sizes)
+
+'''
+Picks the shared start sites of a sweep. Sites are validated once, against the largest
+footprint of the sweep, so every site is valid for every angle and length. Unlike the
+random sampler the sites may overlap, since each is measured in every direction anyway.
+INPUTS:
+    dem: 2D numpy array of elevations
+    cell_size: size of each cell in meters
+    lengths_m: chain lengths in meters
+    angles: chain angles in degrees
+    num_sites: number of start sites
+    rng: numpy random Generator
+OUTPUTS:
+    sites: (num_sites, 2) array of (y, x) start sites, fewer if not enough valid centers exist
+'''
+def choose_sweep_sites(dem, cell_size, lengths_m, angles, num_sites, rng):
+    site_height_m, site_width_m = get_sweep_footprint(lengths_m, angles)
+    valid_centers = site_index.get_valid_centers(dem, site_height_m, site_width_m, cell_size)
+    if len(valid_centers) < num_sites:
+        console.report("Only", len(valid_centers), "valid sites fit the longest chain in every direction,",
+              num_sites, "were requested")
+    chosen = rng.choice(valid_centers, size=min(num_sites, len(valid_centers)), replace=False)
+    return np.stack(np.divmod(chosen, dem.shape[1]), axis=1).astype(np.int64)
+
+'''
+Anisotropy sweep: measures the rugosity of a shared set of start sites at every angle
+and every length. The sites are found once and every (angle, length) path template is
+built once, then all the chains are dropped by one batch call (see chain_paths.py).
+INPUTS:
+    dem: 2D numpy array of elevations
+    cell_size: size of each cell in meters
+    lengths_m: chain lengths in meters
+    num_sites: number of start sites
+    angle_step: whole degrees between the angles, the angles go from 0 to 179. The path
+        templates are built for whole degrees, so other steps raise a ValueError
+    seed: seed of the site choice, None picks a random one
+OUTPUTS:
+    sweep: dict with
+        angles: (num_angles,) angles in degrees
+        lengths: (num_lengths,) lengths in meters
+        sites: (num_sites, 2) start sites
+        rugosity: (num_sites, num_angles, num_lengths) rugosity matrix, NaN for chains without one
+        status: same shape, chain_paths reason codes
+        seed: the seed that was used
+'''
+def run_anisotropy_sweep(dem, cell_size, lengths_m, num_sites, angle_step=1, seed=None):
+    if angle_step != int(angle_step) or angle_step < 1:
+        raise ValueError("The angle step must be a whole number of degrees, not " + str(angle_step))
+    seed_seq = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seed_seq)
+    angles = np.arange(0, 180, int(angle_step))
+    lengths = np.asarray(lengths_m, dtype=np.float64).reshape(-1)
+    sites = choose_sweep_sites(dem, cell_size, lengths, angles, num_sites, rng)
+
+    # One chain per (site, angle, length), in that order
+    num_sites, num_angles, num_lengths = len(sites), len(angles), len(lengths)
+    starts = np.repeat(sites, num_angles*num_lengths, axis=0)
+    chain_angles = np.tile(np.repeat(angles, num_lengths), num_sites)
+    chain_lengths = np.tile(lengths, num_sites*num_angles)
+    rugosities, status, _ = chain_paths.drop_chains_batch(dem, starts, chain_angles, chain_lengths, cell_size)
+
+    shape = (num_sites, num_angles, num_lengths)
+    return {"angles": angles, "lengths": lengths, "sites": sites, "rugosity": rugosities.reshape(shape),
+            "status": status.reshape(shape), "seed": seed_seq.entropy}
+
+'''
+Summary statistics of each angle and length of a sweep, over the sites
+INPUTS:
+    sweep: from "run_anisotropy_sweep"
+    confidence: confidence level of the interval of the mean
+OUTPUTS:
+    summary: dict of (num_angles, num_lengths) arrays: mean, std, ci_half_width, num_valid
+'''
+def summarize_sweep(sweep, confidence=0.95):
+    rugosity = sweep["rugosity"]
+    num_valid = np.count_nonzero(~np.isnan(rugosity), axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = np.nansum(rugosity, axis=0)
+        mean = np.where(num_valid > 0, total / np.maximum(num_valid, 1), np.nan)
+        squares = np.nansum((rugosity - mean)**2, axis=0)
+        std = np.where(num_valid > 1, np.sqrt(squares / np.maximum(num_valid-1, 1)), np.nan)
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        ci_half_width = z * std / np.sqrt(num_valid)
+    return {"mean": mean, "std": std, "ci_half_width": ci_half_width, "num_valid": num_valid}
+
+'''
+Writes the per-angle summary of a sweep as a CSV, one row per angle and length
+'''
+def write_sweep_csv(sweep, summary, filename):
+    folder = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(folder, exist_ok=True)
+    with open(filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["angle", "length", "rugosity_mean", "rugosity_std", "rugosity_ci", "num_valid"])
+        for i, angle in enumerate(sweep["angles"]):
+            for j, length in enumerate(sweep["lengths"]):
+                writer.writerow([int(angle), float(length), summary["mean"][i, j], summary["std"][i, j],
+                                 summary["ci_half_width"][i, j], int(summary["num_valid"][i, j])])
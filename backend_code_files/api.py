@@ -0,0 +1,90 @@
+from backend_code_files import calc_site_surface_complexity as calc_sc
+from backend_code_files import console
+from backend_code_files import convert_dem_to_npy
+from backend_code_files import derived_cache
+from backend_code_files import roi
+from backend_code_files import sampling_engine
+
+# Library entry points for scripts and other programs. They never prompt, print, show
+# progress bars or plot, and importing this module does not import matplotlib or tqdm:
+#     from backend_code_files import api
+#     dem, cell_size = api.load_dem("DEMS/area1.txt")
+#     sc = api.surface_complexity(dem, cell_size)
+#     samples, seed, summary = api.sample_rugosity(dem, cell_size, 1000, 1.0, seed=42)
+
+'''
+Loads a DEM (.txt, .npy, .flt or .npz). ASCII grids are converted to a memory mapped
+.npy cache on the first load, see convert_dem_to_npy.load_dem.
+INPUTS:
+    filepath: path to the DEM
+    dtype: dtype to convert .txt DEMs to, None uses convert_dem_to_npy.DEFAULT_DTYPE
+OUTPUTS:
+    dem: 2D numpy array (or memmap) of elevations
+    cell_size: size of each cell in meters
+'''
+def load_dem(filepath, dtype=None):
+    with console.quiet():
+        return convert_dem_to_npy.load_dem(filepath, plotting=False, dtype=dtype)
+
+'''
+Surface complexity (3D area / 2D area) of a whole DEM
+INPUTS:
+    dem: 2D numpy array (or memmap) of elevations
+    cell_size: size of each cell in meters
+    num_workers: number of worker threads, None uses every core
+'''
+def surface_complexity(dem, cell_size, num_workers=1):
+    with console.quiet():
+        return calc_sc.calculate_site_surface_complexity(dem, cell_size, num_workers=num_workers)
+
+'''
+Surface complexity of bounding boxes and polygons of a DEM, see roi.roi_surface_complexity
+INPUTS:
+    dem: 2D numpy array (or memmap) of elevations
+    cell_size: size of each cell in meters
+    rois: list of ROI dicts, see roi.roi_surface_complexity
+    georef: from convert_dem_to_npy.read_georeference, needed for map coordinates
+    cache: optional derived data cache from derived_cache.open_cache. Bounding boxes are then
+           answered from its area tables (built on the first call), otherwise each box only
+           measures its own part of the DEM.
+'''
+def roi_surface_complexity(dem, cell_size, rois, georef=None, cache=None):
+    with console.quiet():
+        tables = None
+        if cache is not None and any("bbox" in item for item in rois):
+            tables = derived_cache.get_area_tables(dem, cell_size, cache)
+        return roi.roi_surface_complexity(dem, cell_size, rois, tables=tables, georef=georef)
+
+'''
+Monte Carlo rugosity sampling with virtual chains, see sampling_engine.run_sampling
+INPUTS:
+    dem: 2D numpy array (or memmap) of elevations
+    cell_size: size of each cell in meters
+    num_samples: number of samples to draw, the most samples when target_error is set
+    length: chain length in meters, or a (min, max) range to draw whole meters from
+    orientation: chain angle in degrees, or None to draw from 0 to 179
+    seed: master seed, None picks a random one
+    num_workers: number of worker processes, None uses every core
+    target_error: stop once the confidence interval of the mean is within this fraction
+                  of the mean (see sampling_engine.run_adaptive_sampling), None draws all samples
+    output: optional .csv file or folder to stream the samples to (fixed runs only)
+OUTPUTS:
+    samples: sampling_engine.SAMPLE_DTYPE array with one row per sample
+    seed: the master seed that was used
+    summary: dict with the mean, variance, ci_half_width, relative_error, num_valid and
+             converged (always True without a target_error)
+'''
+def sample_rugosity(dem, cell_size, num_samples, length, orientation=None, seed=None, num_workers=1,
+                    target_error=None, output=None):
+    with console.quiet():
+        if target_error is not None:
+            if output is not None:
+                raise ValueError("Adaptive runs cannot be streamed, save the samples with result_writer.write_results")
+            return sampling_engine.run_adaptive_sampling(
+                dem, cell_size, length, orientation, seed, target_error, max_samples=num_samples,
+                num_workers=num_workers)
+        samples, seed = sampling_engine.run_sampling(
+            dem, cell_size, num_samples, length, orientation, seed, num_workers, output=output)
+        summary = sampling_engine.summarize(samples)
+        summary["converged"] = True
+        return samples, seed, summary
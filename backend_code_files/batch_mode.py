@@ -0,0 +1,193 @@
+import csv
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from backend_code_files import calc_site_surface_complexity as calc_sc
+from backend_code_files import chain_paths
+from backend_code_files import convert_dem_to_npy
+from backend_code_files import instrumentation
+from backend_code_files import sampling_engine
+
+# Columns of the manifest. Only "dem" is required.
+#   dem: path to the DEM (.txt, .npy, .flt or .npz)
+#   num_samples: number of rugosity samples, 0 to skip sampling (the most samples when target_error is set)
+#   target_error: relative precision of the mean to stop sampling at, e.g. 0.01, empty to draw all num_samples
+#   length: chain length in meters, or "min-max" for a random length in whole meters
+#   orientation: chain angle in degrees, or "R" for random
+#   seed: master seed of the sampling, empty for a random one
+#   surface_complexity: "Y" to measure the surface complexity of the whole DEM
+MANIFEST_DEFAULTS = {
+    "num_samples": "0",
+    "length": "1",
+    "orientation": "R",
+    "seed": "",
+    "surface_complexity": "Y",
+    "target_error": "",
+}
+
+RESULT_COLUMNS = [
+    "row", "dem", "num_samples", "length", "orientation", "seed", "target_error", "surface_complexity",
+    "rugosity_mean", "rugosity_std", "rugosity_ci", "num_drawn", "num_valid", "num_cut", "converged",
+    "elapsed_s", "error",
+]
+# Result columns measured by the run. They stay blank until measured and are blanked again
+# if the row fails, so a manifest flag like surface_complexity=Y never shows up as a result.
+OUTPUT_COLUMNS = [
+    "surface_complexity", "rugosity_mean", "rugosity_std", "rugosity_ci", "num_drawn", "num_valid", "num_cut",
+    "converged",
+]
+
+'''
+Reads a manifest CSV with one row per DEM and parameter set, filling in the defaults
+INPUTS:
+    manifest_path: path to the manifest
+OUTPUTS:
+    rows: list of dicts, one per manifest row
+'''
+def read_manifest(manifest_path):
+    rows = []
+    folder = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, 'r', newline='') as file:
+        for row in csv.DictReader(file):
+            row = {key.strip().lower(): (value or "").strip() for key, value in row.items() if key}
+            if not row.get("dem"):
+                continue
+            for key, value in MANIFEST_DEFAULTS.items():
+                if not row.get(key):
+                    row[key] = value
+            # DEM paths are relative to the manifest
+            row["dem"] = os.path.join(folder, row["dem"])
+            rows.append(row)
+    return rows
+
+'''
+Turns the length and orientation columns of a manifest row into sampling_engine arguments
+'''
+def parse_sampling_args(row):
+    if "-" in row["length"].lstrip("-"):
+        min_length, max_length = row["length"].split("-")
+        length = (int(min_length), int(max_length))
+    else:
+        length = float(row["length"])
+    orientation = None if row["orientation"].upper() == "R" else int(row["orientation"])
+    seed = int(row["seed"]) if row["seed"] else None
+    return length, orientation, seed
+
+'''
+Starts the result of a manifest row, with the manifest columns and blank output columns
+'''
+def new_result(row, number):
+    result = dict(row, row=number)
+    result.update((column, "") for column in OUTPUT_COLUMNS)
+    return result
+
+'''
+Runs every manifest row of one DEM. The DEM is loaded (and converted if needed) once.
+INPUTS:
+    dem_path: path to the DEM
+    rows: list of (row number, manifest row) for this DEM
+    dtype: dtype to convert .txt DEMs to, None uses convert_dem_to_npy.DEFAULT_DTYPE
+OUTPUTS:
+    results: list of result dicts with the RESULT_COLUMNS
+'''
+def process_dem(dem_path, rows, dtype=None):
+    results = []
+    try:
+        dem, cell_size = convert_dem_to_npy.load_dem(dem_path, plotting=False, dtype=dtype)
+    except Exception as e:
+        for number, row in rows:
+            results.append(dict(new_result(row, number), error="Could not load DEM: " + str(e)))
+        return results
+
+    surface_complexity = None
+    for number, row in rows:
+        start_time = time.time()
+        result = new_result(row, number)
+        try:
+            if row["surface_complexity"].upper() == "Y":
+                # The same DEM only has to be measured once
+                if surface_complexity is None:
+                    surface_complexity = calc_sc.calculate_site_surface_complexity(dem, cell_size)
+                result["surface_complexity"] = surface_complexity
+            num_samples = int(row["num_samples"])
+            if num_samples > 0:
+                length, orientation, seed = parse_sampling_args(row)
+                if row["target_error"]:
+                    samples, seed, summary = sampling_engine.run_adaptive_sampling(
+                        dem, cell_size, length, orientation, seed, float(row["target_error"]),
+                        max_samples=num_samples)
+                    result["converged"] = summary["converged"]
+                else:
+                    samples, seed = sampling_engine.run_sampling(
+                        dem, cell_size, num_samples, length, orientation, seed)
+                    summary = sampling_engine.summarize(samples)
+                result["seed"] = seed
+                result["rugosity_mean"] = summary["mean"]
+                result["rugosity_std"] = np.sqrt(summary["variance"])
+                result["rugosity_ci"] = summary["ci_half_width"]
+                result["num_drawn"] = len(samples)
+                result["num_valid"] = summary["num_valid"]
+                result["num_cut"] = int(np.count_nonzero(samples["status"] != chain_paths.CHAIN_OK))
+        except Exception as e:
+            result.update((column, "") for column in OUTPUT_COLUMNS)
+            result["error"] = str(e) or traceback.format_exc(limit=1)
+        result["elapsed_s"] = round(time.time() - start_time, 3)
+        results.append(result)
+    return results
+
+'''
+Runs "process_dem" in a worker process and sends back what the worker recorded, so the
+parent can add it to its run statistics report
+'''
+def _process_dem_worker(dem_path, rows, dtype, instrument):
+    instrumentation.enable(instrument)
+    results = process_dem(dem_path, rows, dtype)
+    return results, instrumentation.snapshot() if instrument else None
+
+'''
+Runs a whole manifest without any prompts or plots. The DEMs are processed concurrently
+on a bounded process pool and every result row is written to the output CSV as soon as
+its DEM is done, so finished rows survive a crash. The "row" column is the manifest row.
+INPUTS:
+    manifest_path: path to the manifest CSV
+    output_path: path of the result CSV
+    num_workers: number of DEMs processed at the same time, None uses every core
+    dtype: dtype to convert .txt DEMs to, None uses convert_dem_to_npy.DEFAULT_DTYPE
+OUTPUTS:
+    results: list of result dicts, in manifest order
+'''
+def run_manifest(manifest_path, output_path, num_workers=1, dtype=None):
+    rows = read_manifest(manifest_path)
+    dems = {}
+    for number, row in enumerate(rows):
+        dems.setdefault(row["dem"], []).append((number, row))
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    results = []
+    output_folder = os.path.dirname(os.path.abspath(output_path))
+    os.makedirs(output_folder, exist_ok=True)
+    with open(output_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=RESULT_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+
+        def write(dem_results):
+            writer.writerows(dem_results)
+            file.flush()
+            results.extend(dem_results)
+
+        if num_workers > 1 and len(dems) > 1:
+            with ProcessPoolExecutor(max_workers=min(num_workers, len(dems))) as executor:
+                futures = [executor.submit(_process_dem_worker, dem_path, dem_rows, dtype,
+                                           instrumentation.is_enabled())
+                           for dem_path, dem_rows in dems.items()]
+                for future in as_completed(futures):
+                    dem_results, worker_stats = future.result()
+                    instrumentation.merge(worker_stats)
+                    write(dem_results)
+        else:
+            for dem_path, dem_rows in dems.items():
+                write(process_dem(dem_path, dem_rows, dtype))
+    return sorted(results, key=lambda result: result["row"])
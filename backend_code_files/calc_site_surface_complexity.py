@@ -1,5 +1,9 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from tqdm import tqdm
+from backend_code_files import console
+from backend_code_files import instrumentation
 
 def calc_single_area(grid, cell_size):
     def calc_tri_area(a, b, c):
@@ -19,13 +23,295 @@ def calc_single_area(grid, cell_size):
                        (cs, 0, grid[1][0]), (cs, cs, grid[1][1]))
     return a1+a2
 
+'''
+Vectorized version of "calc_single_area" for every 2x2 quad of a DEM at once.
+The four corners of each quad are taken from shifted slices of the DEM and the
+same two triangles are measured with Heron's formula.
+INPUTS:
+    data: 2D numpy array of elevations
+    cell_size: the size of each cell in the DEM
+OUTPUTS:
+    quad_areas: (rows-1, cols-1) array of 3D quad areas, NaN where any corner is NaN
+'''
+def calc_quad_areas(data, cell_size):
+    cs2 = float(cell_size)**2
+    z00 = data[:-1, :-1]
+    z01 = data[:-1, 1:]
+    z10 = data[1:, :-1]
+    z11 = data[1:, 1:]
 
-def calculate_site_surface_complexity(data, cell_size):
+    def heron(ab, bc, ac):
+        s = (ab+bc+ac)/2
+        return np.sqrt(s*(s-ab)*(s-bc)*(s-ac))
+
+    # The diagonal is shared by both triangles
+    ac = np.sqrt(2*cs2 + (z00-z11)**2)
+    a1 = heron(np.sqrt(cs2 + (z00-z01)**2), np.sqrt(cs2 + (z01-z11)**2), ac)
+    a2 = heron(np.sqrt(cs2 + (z00-z10)**2), np.sqrt(cs2 + (z10-z11)**2), ac)
+    # Any NaN corner propagates through the arithmetic, so NaN quads are masked here too
+    return a1+a2
+
+# dtype the quad areas are computed in, whatever the dtype the DEM is stored in. Heron's
+# formula is badly conditioned for the long thin triangles of steep quads, in float32 it
+# goes negative for them and the quads would be dropped as NaN. Only one tile is converted
+# at a time, so a float32 DEM still takes half the memory.
+COMPUTE_DTYPE = np.float64
+
+'''
+Sums the 3D area and counts the valid quads of each row of quads in a block of DEM rows
+INPUTS:
+    block: 2D numpy array of elevations (at least 2 rows)
+    cell_size: the size of each cell in the DEM
+OUTPUTS:
+    row_area_3d: 3D area of the valid quads in each row of quads
+    row_valid: number of valid quads in each row of quads
+'''
+def calc_row_area_sums(block, cell_size):
+    quad_areas = calc_quad_areas(np.asarray(block, dtype=COMPUTE_DTYPE), cell_size)
+    valid = ~np.isnan(quad_areas)
+    row_area_3d = np.where(valid, quad_areas, 0.0).sum(axis=1, dtype=np.float64)
+    row_valid = valid.sum(axis=1)
+    return row_area_3d, row_valid
+
+# Number of DEM cells processed per tile when no tile size is given
+DEFAULT_TILE_CELLS = 2**21
+
+'''
+Splits the quad rows of a DEM into tiles of rows. Each tile needs one extra DEM row
+below it (the one row overlap), so quads crossing a tile boundary are counted once.
+INPUTS:
+    num_rows: number of rows in the DEM
+    tile_rows: number of quad rows per tile
+OUTPUTS:
+    tiles: list of (start, stop) DEM row ranges, use as data[start:stop]
+'''
+def get_row_tiles(num_rows, tile_rows):
+    tile_rows = max(1, int(tile_rows))
+    tiles = []
+    for start in range(0, num_rows-1, tile_rows):
+        stop = min(start+tile_rows, num_rows-1) + 1
+        tiles.append((start, stop))
+    return tiles
+
+'''
+Picks a tile size so each tile holds about DEFAULT_TILE_CELLS cells, and so every
+worker gets a few tiles to keep the pool busy
+'''
+def default_tile_rows(data, num_workers=1):
+    tile_rows = max(1, DEFAULT_TILE_CELLS // max(1, data.shape[1]))
+    if num_workers > 1:
+        tile_rows = min(tile_rows, max(1, math.ceil((data.shape[0]-1) / (4*num_workers))))
+    return tile_rows
+
+'''
+Measures the 3D area and valid quad count of every row of quads of the DEM.
+The DEM is walked in row tiles, so it can be a memory mapped array (np.load with
+mmap_mode="r") and only the tiles being worked on are held in memory.
+With num_workers > 1 the tiles are measured on a thread pool. The numpy kernels
+release the GIL, so the threads run on separate cores while sharing the same input.
+INPUTS:
+    data: 2D numpy array (or memmap) of elevations
+    cell_size: the size of each cell in the DEM
+    tile_rows: number of quad rows per tile, None picks one from DEFAULT_TILE_CELLS
+    num_workers: number of worker threads, None uses every core
+OUTPUTS:
+    row_area_3d: 3D area of the valid quads in each row of quads
+    row_valid: number of valid quads in each row of quads
+'''
+@instrumentation.timed("surface_complexity")
+def calc_site_row_sums(data, cell_size, tile_rows=None, num_workers=1):
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if tile_rows is None:
+        tile_rows = default_tile_rows(data, num_workers)
+    tiles = get_row_tiles(data.shape[0], tile_rows)
+
+    def measure_tile(tile):
+        start, stop = tile
+        return calc_row_area_sums(data[start:stop], cell_size)
+
+    with console.progress(total=len(tiles), unit="tile") as progress:
+        if num_workers > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = [executor.submit(measure_tile, tile) for tile in tiles]
+                for future in futures:
+                    future.add_done_callback(lambda _: progress.update(1))
+                # Results are collected in tile order so the reduction is deterministic
+                results = [future.result() for future in futures]
+        else:
+            results = []
+            for tile in tiles:
+                results.append(measure_tile(tile))
+                progress.update(1)
+
+    if not results:
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+    row_area_3d = np.concatenate([row_area_3d for row_area_3d, _ in results])
+    row_valid = np.concatenate([row_valid for _, row_valid in results])
+    return row_area_3d, row_valid
+
+'''
+Turns the per-row sums from "calc_site_row_sums" into the surface complexity.
+The rows are combined with math.fsum, so the result does not depend on the tile size,
+the worker count or the order the tiles finish in.
+'''
+def complexity_from_row_sums(row_area_3d, row_valid, cell_size):
+    area_3d = math.fsum(row_area_3d)
+    area_2d = int(np.sum(row_valid)) * float(cell_size)**2
+    return area_3d/area_2d
+
+'''
+Calculates the surface complexity (3D area / 2D area) of the whole DEM.
+See "calc_site_row_sums" for how the DEM is split up between tiles and workers.
+INPUTS:
+    data: 2D numpy array (or memmap) of elevations
+    cell_size: the size of each cell in the DEM
+    tile_rows: number of quad rows per tile, None picks one from DEFAULT_TILE_CELLS
+    num_workers: number of worker threads, None uses every core
+OUTPUTS:
+    surface complexity of the site
+'''
+def calculate_site_surface_complexity(data, cell_size, tile_rows=None, num_workers=1):
+    console.report("Calculating Entire Site Surface Complexity")
+    row_area_3d, row_valid = calc_site_row_sums(data, cell_size, tile_rows, num_workers)
+    return complexity_from_row_sums(row_area_3d, row_valid, cell_size)
+
+'''
+Builds summed-area tables of the per-quad 3D area and of the valid quad count, padded
+with a leading row and column of zeros (see site_index.summed_area_table). The quad
+areas are computed once, tile by tile, so the temporaries stay bounded.
+INPUTS:
+    data: 2D numpy array (or memmap) of elevations
+    cell_size: the size of each cell in the DEM
+    tile_rows: number of quad rows per tile, None picks one from DEFAULT_TILE_CELLS
+    out: optional zero filled (area_sat, count_sat) arrays to fill, e.g. memory maps
+OUTPUTS:
+    area_sat: (rows, cols) float64 summed-area table of the 3D quad areas
+    count_sat: (rows, cols) int64 summed-area table of the valid quads
+'''
+@instrumentation.timed("surface_complexity")
+def calc_area_tables(data, cell_size, tile_rows=None, out=None):
+    if tile_rows is None:
+        tile_rows = default_tile_rows(data)
+    num_rows, num_cols = data.shape
+    if out is None:
+        area_sat = np.zeros((num_rows, num_cols), dtype=np.float64)
+        count_sat = np.zeros((num_rows, num_cols), dtype=np.int64)
+    else:
+        area_sat, count_sat = out
+    for start, stop in get_row_tiles(num_rows, tile_rows):
+        quad_areas = calc_quad_areas(np.asarray(data[start:stop], dtype=COMPUTE_DTYPE), cell_size)
+        valid = ~np.isnan(quad_areas)
+        # Column sums first, then carry the running total down from the row above the tile
+        area_rows = np.cumsum(np.where(valid, quad_areas, 0.0), axis=1, dtype=np.float64)
+        count_rows = np.cumsum(valid, axis=1)
+        area_sat[start+1:stop, 1:] = np.cumsum(area_rows, axis=0) + area_sat[start, 1:]
+        count_sat[start+1:stop, 1:] = np.cumsum(count_rows, axis=0) + count_sat[start, 1:]
+    return area_sat, count_sat
+
+'''
+Sums a summed-area table over every k x k window, with the window starts stride apart
+'''
+def window_sums(sat, rows, cols, k):
+    return sat[np.ix_(rows+k, cols+k)] - sat[np.ix_(rows, cols+k)] \
+        - sat[np.ix_(rows+k, cols)] + sat[np.ix_(rows, cols)]
+
+'''
+3D area and valid quad count of a rectangle of the DEM, answered in O(1) from the
+summed-area tables of "calc_area_tables". Only the quads with all four corners inside
+the rectangle count.
+INPUTS:
+    tables: (area_sat, count_sat) from "calc_area_tables"
+    bbox: (row0, col0, row1, col1) DEM cells of the rectangle, rows [row0, row1) and cols [col0, col1)
+OUTPUTS:
+    area_3d: 3D area of the valid quads
+    count: number of valid quads
+'''
+def bbox_area_sums(tables, bbox):
+    area_sat, count_sat = tables
+    row0, col0, row1, col1 = [int(value) for value in bbox]
+    # Quads are one smaller than cells, clip to the DEM
+    row0, col0 = max(row0, 0), max(col0, 0)
+    row1, col1 = min(row1-1, area_sat.shape[0]-1), min(col1-1, area_sat.shape[1]-1)
+    if row1 <= row0 or col1 <= col0:
+        return 0.0, 0
+    area_3d = area_sat[row1, col1] - area_sat[row0, col1] - area_sat[row1, col0] + area_sat[row0, col0]
+    count = count_sat[row1, col1] - count_sat[row0, col1] - count_sat[row1, col0] + count_sat[row0, col0]
+    return float(area_3d), int(count)
+
+'''
+Surface complexity of a rectangle of the DEM, see "bbox_area_sums"
+OUTPUTS:
+    surface complexity of the rectangle, NaN if it has no valid quads
+'''
+def bbox_surface_complexity(tables, cell_size, bbox):
+    area_3d, count = bbox_area_sums(tables, bbox)
+    if count == 0:
+        return float("nan")
+    return float(area_3d / (count * float(cell_size)**2))
+
+'''
+Makes local surface complexity rasters: the 3D/2D ratio of every window of the DEM, for
+several window sizes. The quad areas are measured once and turned into summed-area
+tables, so each window is answered in O(1) no matter its size.
+Pixel [i, j] of a raster covers the quads [i*stride, i*stride+k) x [j*stride, j*stride+k),
+where k is the window size in cells. Windows without valid quads are NaN.
+INPUTS:
+    data: 2D numpy array (or memmap) of elevations
+    cell_size: the size of each cell in the DEM
+    window_sizes_m: list of window sizes in meters
+    stride: number of quads between neighbouring windows
+    out_prefix: if given, each raster is written to out_prefix + "_<size>m.npy" as a
+                memory mappable array instead of being kept in memory
+    tables: optional (area_sat, count_sat) from "calc_area_tables" to reuse
+OUTPUTS:
+    rasters: dict of window size in meters to its complexity raster
+'''
+def calc_local_surface_complexity(data, cell_size, window_sizes_m, stride=1, out_prefix=None, tables=None):
+    console.report("Calculating Local Surface Complexity")
+    if tables is None:
+        tables = calc_area_tables(data, cell_size)
+    area_sat, count_sat = tables
+    num_quad_rows, num_quad_cols = area_sat.shape[0]-1, area_sat.shape[1]-1
+    stride = max(1, int(stride))
+    quad_area_2d = float(cell_size)**2
+
+    rasters = {}
+    for window_m in window_sizes_m:
+        k = max(1, int(round(window_m/cell_size)))
+        if k > num_quad_rows or k > num_quad_cols:
+            console.report("Window of", window_m, "m is larger than the DEM, skipping it")
+            continue
+        rows = np.arange(0, num_quad_rows-k+1, stride)
+        cols = np.arange(0, num_quad_cols-k+1, stride)
+        if out_prefix is None:
+            raster = np.empty((len(rows), len(cols)), dtype=np.float64)
+        else:
+            raster = np.lib.format.open_memmap(out_prefix + "_" + str(window_m) + "m.npy", mode='w+',
+                                               dtype=np.float64, shape=(len(rows), len(cols)))
+        # Fill the raster in row blocks to bound the temporaries
+        block_rows = max(1, DEFAULT_TILE_CELLS // max(1, len(cols)))
+        for i in console.progress(range(0, len(rows), block_rows)):
+            block = rows[i:i+block_rows]
+            area_3d = window_sums(area_sat, block, cols, k)
+            area_2d = window_sums(count_sat, block, cols, k) * quad_area_2d
+            with np.errstate(invalid='ignore', divide='ignore'):
+                raster[i:i+len(block)] = np.where(area_2d > 0, area_3d/area_2d, np.nan)
+        if out_prefix is not None:
+            raster.flush()
+        rasters[window_m] = raster
+    return rasters
+
+'''
+Original cell by cell implementation, kept as a reference for checking the
+vectorized engine. This is very slow on large DEMs.
+'''
+def calculate_site_surface_complexity_reference(data, cell_size):
     area_3d = 0
     area_2d = 0
-    
-    print("Calculating Entire Site Surface Complexity")
-    for i in tqdm(range(data.shape[0]-1)):
+
+    console.report("Calculating Entire Site Surface Complexity")
+    for i in console.progress(range(data.shape[0]-1)):
         for j in range(data.shape[1]-1):
             if (np.isnan(data[i, j]) or np.isnan(data[i+1, j]) or np.isnan(data[i, j+1]) or np.isnan(data[i+1, j+1])):
                 continue
@@ -0,0 +1,195 @@
+from functools import lru_cache
+import numpy as np
+from backend_code_files import instrumentation
+
+# Distance between the points sampled along a chain, in cells
+STEP_SIZE = 0.33
+# Number of (angle, length) path templates kept in memory
+PATH_CACHE_SIZE = 4096
+# Number of path cells gathered at a time by "drop_chains_batch"
+BATCH_CHUNK_CELLS = 2**22
+
+'''
+Walks one arm of a chain path from the origin. The arm takes steps of STEP_SIZE
+in the direction of angle until it is at least max_dist cells from the origin.
+INPUTS:
+    angle: direction of the arm in radians
+    max_dist: length of the arm in cells
+OUTPUTS:
+    offsets: (n, 2) float array of the points along the arm, not including the origin
+'''
+def _walk_arm(angle, max_dist):
+    if max_dist <= 0:
+        return np.empty((0, 2))
+    num_steps = int(np.ceil(max_dist/STEP_SIZE)) + 2
+    steps = np.empty((num_steps, 2))
+    steps[:, 0] = np.cos(angle)*STEP_SIZE
+    steps[:, 1] = np.sin(angle)*STEP_SIZE
+    offsets = np.cumsum(steps, axis=0)
+    dist = np.sqrt(offsets[:, 0]**2 + offsets[:, 1]**2)
+    # A step is taken while the distance before it is still short of max_dist
+    num_taken = 1 + int(np.argmax(dist >= max_dist))
+    return offsets[:num_taken]
+
+'''
+Rounds the points of an arm to grid cells and drops repeated cells, keeping the first
+time each cell is reached
+'''
+def _unique_cells(offsets):
+    cells = np.rint(offsets).astype(np.int64)
+    if len(cells) == 0:
+        return cells
+    _, first = np.unique(cells, axis=0, return_index=True)
+    return cells[np.sort(first)]
+
+'''
+Builds the path template of a chain: the offsets from the start point of every point
+and grid cell the chain passes over. The path goes back length_cells/3 and forward
+length_cells/2 from the start, like "get_grid_points_rotation" always has.
+The shape only depends on the angle and length, so templates are kept in an LRU cache
+and shared by every start point. The returned arrays are read only.
+INPUTS:
+    angle_deg: The angle of the chain in degrees
+    length_cells: The length of the chain in grid cells
+OUTPUTS:
+    point_offsets: (n, 2) float offsets of the sampled points, the start first
+    cell_offsets: (m, 2) integer offsets of the unique cells, in order along the chain
+'''
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+@instrumentation.timed("path_generation")
+def get_path_template(angle_deg, length_cells):
+    instrumentation.count("paths.template_builds")
+    angle = angle_deg * np.pi/180
+    backward = _walk_arm(angle + np.pi, length_cells/3)
+    forward = _walk_arm(angle, length_cells/2)
+    point_offsets = np.concatenate((np.zeros((1, 2)), backward, forward), axis=0)
+    cell_offsets = np.concatenate(
+        (np.flip(_unique_cells(backward), axis=0), _unique_cells(forward)), axis=0)
+    point_offsets.flags.writeable = False
+    cell_offsets.flags.writeable = False
+    return point_offsets, cell_offsets
+
+# Reason codes returned by "drop_chains_batch"
+CHAIN_OK = 0
+CHAIN_NAN = 1
+CHAIN_OUT_OF_BOUNDS = 2
+CHAIN_PATH_END = 3
+CHAIN_EMPTY = 4
+CHAIN_STATUS_NAMES = {
+    CHAIN_OK: "ok",
+    CHAIN_NAN: "nan",
+    CHAIN_OUT_OF_BOUNDS: "out_of_bounds",
+    CHAIN_PATH_END: "path_end",
+    CHAIN_EMPTY: "empty",
+}
+
+'''
+Drops many chains on the grid in one call and calculates the rugosity of each chain.
+Chains that share an angle and length share a path template, so each group is handled
+with fancy-index gathers of the elevations along all of its paths at once. The 3D
+length of the chain is the running (cumulative) sum of its segment lengths, and the
+chain stops at the first segment where it reaches chain_length_m, like the per-chain
+loop this replaced. Chains that stay inside the grid give bit for bit the same results as
+that loop (see tests/test_chain_paths.py). Chains that reach the edge differ: the loop
+indexed the grid with the path cells directly, so a path crossing the top or left edge
+wrapped around to the far side of the DEM through negative indices, and only the bottom
+and right edges stopped it with an IndexError. Here every edge stops the chain.
+A chain that hits a NaN cell, leaves the grid or runs out of path before reaching its
+length keeps the rugosity measured up to that point and gets a reason code:
+    CHAIN_OK: reached its length
+    CHAIN_NAN: stopped at a NaN elevation
+    CHAIN_OUT_OF_BOUNDS: stopped at the edge of the grid
+    CHAIN_PATH_END: the path ended before the chain reached its length
+    CHAIN_EMPTY: no 2D distance was covered, the rugosity is NaN
+INPUTS:
+    grid: 2D numpy array of elevations
+    starts: (n, 2) array of (y, x) start points
+    angles: (n,) array of chain angles in degrees
+    lengths_m: (n,) array of chain lengths in meters
+    cell_size: size of each cell in meters
+    length_cells: optional (n,) path lengths in cells, int(lengths_m/cell_size) by default
+OUTPUTS:
+    rugosities: (n,) array of rugosities, NaN for CHAIN_EMPTY chains
+    status: (n,) array of reason codes
+    num_steps: (n,) number of path segments each chain covered
+'''
+@instrumentation.timed("chain_drop")
+def drop_chains_batch(grid, starts, angles, lengths_m, cell_size, length_cells=None):
+    starts = np.asarray(starts, dtype=np.int64).reshape(-1, 2)
+    num_chains = len(starts)
+    angles = np.broadcast_to(np.asarray(angles), (num_chains,))
+    lengths_m = np.broadcast_to(np.asarray(lengths_m, dtype=np.float64), (num_chains,))
+    if length_cells is None:
+        length_cells = (lengths_m/cell_size).astype(np.int64)
+    length_cells = np.broadcast_to(np.asarray(length_cells, dtype=np.int64), (num_chains,))
+
+    rugosities = np.full(num_chains, np.nan)
+    status = np.full(num_chains, CHAIN_OK, dtype=np.int8)
+    num_steps = np.zeros(num_chains, dtype=np.int64)
+
+    groups = {}
+    for i in range(num_chains):
+        groups.setdefault((angles[i].item(), int(length_cells[i])), []).append(i)
+
+    for (angle, length), members in groups.items():
+        members = np.array(members)
+        _, cell_offsets = get_path_template(angle, length)
+        # Bound the size of the gathered (chains, path) arrays
+        chunk = max(1, BATCH_CHUNK_CELLS // max(1, len(cell_offsets)))
+        for i in range(0, len(members), chunk):
+            chunk_members = members[i:i+chunk]
+            rugosities[chunk_members], status[chunk_members], num_steps[chunk_members] = \
+                _drop_chain_group(grid, starts[chunk_members], cell_offsets,
+                                  lengths_m[chunk_members], cell_size)
+    if instrumentation.is_enabled():
+        for code, amount in enumerate(np.bincount(status, minlength=len(CHAIN_STATUS_NAMES))):
+            instrumentation.count("chains." + CHAIN_STATUS_NAMES[code], amount)
+    return rugosities, status, num_steps
+
+'''
+Drops a group of chains that share one path template, see "drop_chains_batch"
+'''
+def _drop_chain_group(grid, starts, cell_offsets, target, cell_size):
+    height, width = grid.shape
+    num_chains = len(starts)
+    rows = np.arange(num_chains)
+    num_segments = len(cell_offsets) - 1
+    if num_segments < 1:
+        return np.full(num_chains, np.nan), np.full(num_chains, CHAIN_PATH_END), np.zeros(num_chains, dtype=np.int64)
+
+    cells = starts[:, None, :] + cell_offsets[None, :, :]
+    inside = (cells[..., 0] >= 0) & (cells[..., 0] < height) & \
+             (cells[..., 1] >= 0) & (cells[..., 1] < width)
+    z = grid[np.clip(cells[..., 0], 0, height-1), np.clip(cells[..., 1], 0, width-1)]
+    elevation_change = z[:, :-1] - z[:, 1:]
+
+    # 2D length of each segment is the same for every chain in the group
+    physical_dist = np.sqrt(((cell_offsets[:-1] - cell_offsets[1:])**2).sum(axis=1)) * cell_size
+    segment_3d = np.sqrt(elevation_change**2 + physical_dist**2)
+
+    # First segment the chain cannot cross, and why
+    out_of_bounds = ~(inside[:, :-1] & inside[:, 1:])
+    bad = out_of_bounds | np.isnan(elevation_change)
+    has_bad = bad.any(axis=1)
+    limit = np.where(has_bad, np.argmax(bad, axis=1), num_segments)
+    limit_reason = np.where(~has_bad, CHAIN_PATH_END,
+                            np.where(out_of_bounds[rows, np.minimum(limit, num_segments-1)],
+                                     CHAIN_OUT_OF_BOUNDS, CHAIN_NAN))
+
+    # Running 3D length, only meaningful before the limit
+    segment_index = np.arange(num_segments)
+    cum_3d = np.cumsum(np.where(segment_index < limit[:, None], segment_3d, np.inf), axis=1)
+    cum_2d = np.cumsum(physical_dist)
+    # Segments needed to reach the target (a searchsorted on each row)
+    needed = np.where(target > 0, (cum_3d < target[:, None]).sum(axis=1) + 1, 0)
+    steps = np.minimum(needed, limit)
+    status = np.where(needed <= limit, CHAIN_OK, limit_reason)
+
+    last = np.maximum(steps-1, 0)
+    total_dist = cum_2d[last]
+    # A chain needs some 2D distance to have a rugosity
+    taken = (steps > 0) & (total_dist > 0)
+    rugosities = np.full(num_chains, np.nan)
+    rugosities[taken] = cum_3d[rows, last][taken] / total_dist[taken]
+    status = np.where(taken | (status != CHAIN_OK), status, CHAIN_EMPTY)
+    return rugosities, status, steps
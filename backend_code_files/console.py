@@ -0,0 +1,63 @@
+import contextlib
+import threading
+
+# Messages and progress bars of the backend go through this module, so library callers can
+# silence them (see "quiet") and tqdm is only imported once a bar is actually shown
+_state = threading.local()
+
+def is_quiet():
+    return getattr(_state, "quiet", False)
+
+def set_quiet(quiet=True):
+    _state.quiet = quiet
+
+'''
+Silences the messages and progress bars of the calling thread inside a with block
+'''
+@contextlib.contextmanager
+def quiet(quiet=True):
+    previous = is_quiet()
+    set_quiet(quiet)
+    try:
+        yield
+    finally:
+        set_quiet(previous)
+
+'''
+Prints a message unless the calling thread is quiet
+'''
+def report(*args):
+    if not is_quiet():
+        print(*args)
+
+'''
+Stands in for a tqdm bar when the calling thread is quiet
+'''
+class _NoProgress:
+    def __init__(self, iterable=None):
+        self.iterable = iterable
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def update(self, n=1):
+        pass
+
+    def close(self):
+        pass
+
+'''
+Returns a tqdm progress bar, or a silent stand-in with the same interface when the calling
+thread is quiet. Takes the same arguments as tqdm.
+'''
+def progress(iterable=None, **kwargs):
+    if is_quiet():
+        return _NoProgress(iterable)
+    from tqdm import tqdm
+    return tqdm(iterable, **kwargs)
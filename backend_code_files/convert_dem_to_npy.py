@@ -1,27 +1,417 @@
-import numpy as np 
-import matplotlib.pyplot as plt 
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from backend_code_files import console
+from backend_code_files import dem_display
+from backend_code_files import instrumentation
 
-def dem_txt_to_npy(filename):
+# Number of characters of grid text parsed at a time by "read_ascii_grid"
+DEFAULT_CHUNK_CHARS = 2**25
+# Bump this when the layout of the DEM cache changes so old caches get rebuilt
+CACHE_VERSION = 1
+# Number of cells checked for NODATA at a time in a binary float grid
+NODATA_TILE_CELLS = 2**22
+# dtype ASCII grids are converted to. float32 halves the memory and bandwidth of every
+# DEM sized array and is plenty for millimetre scale photogrammetry. Set RUGOSITY_DTYPE=float32
+# to use it by default.
+DEFAULT_DTYPE = np.dtype(os.environ.get("RUGOSITY_DTYPE") or "float64")
+
+'''
+Reads the header of an ESRI ASCII grid. Keys are matched by name, so the header can
+have any number of lines, in any order, with any spacing or capitalization.
+INPUTS:
+    file: open text file positioned at the start of the grid
+OUTPUTS:
+    header: dict of lower case header keys (ncols, nrows, cellsize, nodata_value, ...)
+    first_line: the first line of elevation data, which had to be read to find the end of the header
+'''
+def read_ascii_header(file):
+    header = {}
+    while True:
+        line = file.readline()
+        parts = line.split()
+        if not parts:
+            if line == "":
+                break
+            continue
+        if not parts[0][0].isalpha():
+            break
+        key = parts[0].lower()
+        value = float(parts[1])
+        header[key] = int(value) if key in ("ncols", "nrows") else value
+    for key in ("ncols", "nrows", "cellsize"):
+        if key not in header:
+            raise ValueError("ASCII grid header is missing " + key)
+    return header, line
+
+'''
+Streams the elevations of an ESRI ASCII grid into an array in bounded memory batches.
+The text is parsed DEFAULT_CHUNK_CHARS characters at a time, NODATA values are set to
+NaN as each batch is written, and rows are written straight into the output array.
+INPUTS:
+    filename: path to the .txt/.asc grid
+    out: optional preallocated (nrows, ncols) array or memmap to write into
+    chunk_chars: number of characters to parse per batch
+OUTPUTS:
+    data: 2D numpy array of elevations (out, if it was given)
+    header: the parsed header, see "read_ascii_header"
+'''
+@instrumentation.timed("ingest")
+def read_ascii_grid(filename, out=None, chunk_chars=DEFAULT_CHUNK_CHARS):
+    start_time = time.time()
+    num_bytes = 0
+    with open(filename, 'r') as file:
+        header, text = read_ascii_header(file)
+        nrows, ncols = header["nrows"], header["ncols"]
+        nodata = header.get("nodata_value")
+        if out is None:
+            out = np.empty((nrows, ncols), dtype=np.float64)
+        elif out.shape != (nrows, ncols):
+            raise ValueError("Output array shape " + str(out.shape) +
+                             " does not match the grid (" + str(nrows) + ", " + str(ncols) + ")")
+        flat = out.reshape(-1)
+        filled = 0
+        leftover = ""
+        while filled < flat.size:
+            chunk = file.read(chunk_chars)
+            num_bytes += len(chunk)
+            text = leftover + text + chunk
+            if chunk:
+                # Keep the last (possibly cut) number for the next batch
+                cut = max(text.rfind(sep) for sep in " \t\r\n")
+                text, leftover = text[:cut+1], text[cut+1:]
+            else:
+                leftover = ""
+            values = np.fromstring(text, sep=" ") if text.strip() else np.empty(0)
+            text = ""
+            values = values[:flat.size - filled]
+            if nodata is not None:
+                values[values == nodata] = np.nan
+            flat[filled:filled+values.size] = values
+            filled += values.size
+            if not chunk:
+                break
+    if filled < flat.size:
+        raise ValueError("ASCII grid ended after " + str(filled // ncols) + " of " + str(nrows) + " rows")
+
+    elapsed = max(time.time() - start_time, 1e-9)
+    console.report("Parsed", nrows, "rows at", round(nrows/elapsed), "rows/s,",
+          round(num_bytes/elapsed/1e6, 1), "MB/s")
+    return out, header
+
+'''
+Returns the paths of the DEM cache for a DEM file: a raw .npy that can be memory mapped
+and a .json metadata sidecar next to it. float32 caches get an "_f32" suffix, so both
+can sit next to the same source.
+'''
+def get_cache_paths(filename, dtype=np.float64):
+    base = os.path.splitext(filename)[0]
+    if np.dtype(dtype) == np.float32:
+        base += "_f32"
+    return base + ".npy", base + ".json"
+
+'''
+SHA-256 of a file, read in blocks so the file never has to fit in memory
+'''
+def hash_file(filename, block_size=2**24):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+'''
+Reads the metadata sidecar of a DEM cache. Returns None if it does not exist.
+'''
+def read_cache_metadata(filename, dtype=np.float64):
+    _, meta_path = get_cache_paths(filename, dtype)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as file:
+        return json.load(file)
+
+'''
+Checks whether the DEM cache of a .txt file is complete and was built from the current
+version of the file. The size and modification time are checked first, and the file is
+only hashed again if they changed (a file that was touched but not edited stays valid).
+INPUTS:
+    file_txt: path to the source ASCII grid
+    dtype: dtype of the cache
+OUTPUTS:
+    True if the cache can be used
+'''
+def is_cache_fresh(file_txt, dtype=np.float64):
+    npy_path, meta_path = get_cache_paths(file_txt, dtype)
+    metadata = read_cache_metadata(file_txt, dtype)
+    if metadata is None or metadata.get("version") != CACHE_VERSION:
+        return False
+    # A .txt and a .flt of the same name would share the cache paths
+    if metadata.get("source", os.path.basename(file_txt)) != os.path.basename(file_txt):
+        return False
+    # Binary grids without NODATA cells are used as they are, their sidecar has no .npy
+    if metadata.get("has_npy", True) and not os.path.exists(npy_path):
+        return False
+    stat = os.stat(file_txt)
+    if metadata["source_size"] != stat.st_size:
+        return False
+    if metadata["source_mtime"] == stat.st_mtime:
+        return True
+    if metadata["source_sha256"] != hash_file(file_txt):
+        return False
+    metadata["source_mtime"] = stat.st_mtime
+    with open(meta_path, 'w') as file:
+        json.dump(metadata, file, indent=2)
+    return True
+
+'''
+Converts an ESRI ASCII grid into the DEM cache format: the elevations are streamed
+into a raw .npy and the header is written to a .json sidecar with the cell size,
+NODATA value, dimensions, origin, dtype and a hash of the source file.
+The sidecar is written last, so an interrupted conversion is never mistaken for a cache.
+INPUTS:
+    filename: path to the .txt grid
+    plotting: show the DEM once it is converted (blocks until the plot is closed)
+    dtype: dtype of the cache, float64 or float32
+OUTPUTS:
+    data: the DEM, memory mapped read only from the cache
+    cell_size: the size of each cell in the DEM
+'''
+def dem_txt_to_npy(filename, plotting=True, dtype=np.float64):
     file_txt = filename
-    filename = filename[:-4]
-    
+    dtype = np.dtype(dtype)
+    npy_path, meta_path = get_cache_paths(file_txt, dtype)
+    stat = os.stat(file_txt)
+
     with open(file_txt, 'r') as file:
-        header = file.readlines()[0:6]
-
-    ncols = int(header[0][13:-1])
-    # nrows = int(file.readlines()[1][14:-1])
-    cell_size = float(header[4][13:-1])    
-    NODATA_value = float(header[5][13:-1])
-
-    cell_size = np.array(cell_size)
-    print("Cell size is", cell_size, "meters per side")
-    data = np.genfromtxt(file_txt, skip_header=6, usecols=np.arange(0,ncols), invalid_raise = False)
-    print("Loaded data")
-    data[data == NODATA_value] = np.nan
-
-    np.savez(filename, name1=cell_size, name2=data)
-    plt.imshow(data)
-    plt.show()
-    print("Finished Loading")
+        header, _ = read_ascii_header(file)
+    cell_size = header["cellsize"]
+    console.report("Cell size is", cell_size, "meters per side")
+
+    tmp_path = npy_path + ".tmp"
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype,
+                                    shape=(header["nrows"], header["ncols"]))
+    read_ascii_grid(file_txt, out=out)
+    out.flush()
+    del out
+    os.replace(tmp_path, npy_path)
+    console.report("Loaded data")
+
+    metadata = {
+        "version": CACHE_VERSION,
+        "cellsize": cell_size,
+        "nodata_value": header.get("nodata_value"),
+        "nrows": header["nrows"],
+        "ncols": header["ncols"],
+        "origin": {key: value for key, value in header.items() if key[:3] in ("xll", "yll")},
+        "dtype": dtype.name,
+        "source": os.path.basename(file_txt),
+        "source_size": stat.st_size,
+        "source_mtime": stat.st_mtime,
+        "source_sha256": hash_file(file_txt),
+    }
+    with open(meta_path, 'w') as file:
+        json.dump(metadata, file, indent=2)
+
+    data = np.load(npy_path, mmap_mode='r')
+    if plotting:
+        import matplotlib.pyplot as plt
+        dem_display.show_dem(data)
+        plt.show()
+    console.report("Finished Loading")
     return data, cell_size
 
+'''
+Returns the .flt and .hdr paths of an ESRI binary float grid, given either of them
+'''
+def get_flt_paths(filename):
+    base = os.path.splitext(filename)[0]
+    return base + ".flt", base + ".hdr"
+
+'''
+Reads the .hdr header of an ESRI binary float grid. Like the ASCII header, keys are
+matched by name in any order or capitalization.
+INPUTS:
+    filename: path to the .hdr file
+OUTPUTS:
+    header: dict of lower case header keys (ncols, nrows, cellsize, nodata_value, byteorder, ...)
+'''
+def read_flt_header(filename):
+    header = {}
+    with open(filename, 'r') as file:
+        for line in file:
+            parts = line.split()
+            if len(parts) < 2:
+                continue
+            key = parts[0].lower()
+            if key == "byteorder":
+                header[key] = parts[1].upper()
+            elif key in ("ncols", "nrows", "nbits"):
+                header[key] = int(float(parts[1]))
+            else:
+                try:
+                    header[key] = float(parts[1])
+                except ValueError:
+                    header[key] = parts[1]
+    for key in ("ncols", "nrows", "cellsize"):
+        if key not in header:
+            raise ValueError("Binary grid header is missing " + key)
+    return header
+
+'''
+Opens an ESRI binary float grid (.flt + .hdr), as exported by Metashape and most GIS
+tools. A grid without NODATA cells is memory mapped straight from the .flt file. A grid
+with NODATA cells is copied once, tile by tile, into a NaN-masked .npy cache at the same
+place a .txt grid of that name would have it (see "get_cache_paths"), and the cache is
+memory mapped from then on. Either way the DEM is a read only memmap of a whole file, so
+worker processes reopen it instead of copying it (see sampling_engine.share_dem). The
+NODATA scan hashes the file in the same read, and a .json sidecar records the outcome,
+so the grid is only read once.
+INPUTS:
+    filename: path to the .flt or .hdr file
+OUTPUTS:
+    dem: the DEM as a memory mapped numpy array (float32 as stored in the file)
+    cell_size: the size of each cell in the DEM
+'''
+def load_flt(filename):
+    flt_path, hdr_path = get_flt_paths(filename)
+    header = read_flt_header(hdr_path)
+    # LSBFIRST (or I for Intel) is little endian, MSBFIRST (or M for Motorola) is big endian
+    byte_order = ">" if header.get("byteorder", "LSBFIRST") in ("MSBFIRST", "M", "BIG_ENDIAN") else "<"
+    dtype = np.dtype(byte_order + ("f8" if header.get("nbits") == 64 else "f4"))
+    shape = (header["nrows"], header["ncols"])
+    if os.path.getsize(flt_path) < shape[0]*shape[1]*dtype.itemsize:
+        raise ValueError("Binary grid " + flt_path + " is smaller than its header says")
+    console.report("Cell size is", header["cellsize"], "meters per side")
+    cache_dtype = dtype.newbyteorder("=")
+    npy_path, meta_path = get_cache_paths(flt_path, cache_dtype)
+    if is_cache_fresh(flt_path, cache_dtype):
+        if read_cache_metadata(flt_path, cache_dtype)["has_npy"]:
+            return np.load(npy_path, mmap_mode='r'), header["cellsize"]
+        return np.memmap(flt_path, dtype=dtype, mode='r', shape=shape), header["cellsize"]
+
+    # The file is read once: each tile is hashed and checked for NODATA. Grids without
+    # NODATA are used as they are, the copy only starts at the first tile with NODATA.
+    stat = os.stat(flt_path)
+    dem = np.memmap(flt_path, dtype=dtype, mode='r', shape=shape)
+    nodata = header.get("nodata_value")
+    nodata = dtype.type(nodata) if nodata is not None and not np.isnan(nodata) else None
+    tile_rows = max(1, NODATA_TILE_CELLS // max(shape[1], 1))
+    tmp_path = npy_path + ".tmp"
+    sha = hashlib.sha256()
+    out = None
+    with open(flt_path, 'rb') as file:
+        for start in range(0, shape[0], tile_rows):
+            raw = file.read(min(tile_rows, shape[0]-start) * shape[1] * dtype.itemsize)
+            sha.update(raw)
+            block = np.frombuffer(raw, dtype=dtype).reshape(-1, shape[1])
+            if out is None and nodata is not None and (block == nodata).any():
+                console.report("Saving the grid with its NODATA cells as NaN")
+                out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=cache_dtype, shape=shape)
+                # The tiles before this one have no NODATA cells
+                for done in range(0, start, tile_rows):
+                    out[done:min(done+tile_rows, start)] = dem[done:min(done+tile_rows, start)]
+            if out is not None:
+                block = block.astype(cache_dtype)
+                block[block == nodata] = np.nan
+                out[start:start+len(block)] = block
+        # Any bytes after the grid are part of the file hash too
+        for rest in iter(lambda: file.read(2**24), b""):
+            sha.update(rest)
+    has_nodata = out is not None
+    if has_nodata:
+        out.flush()
+        del out
+        os.replace(tmp_path, npy_path)
+
+    # The sidecar is written last, so an interrupted conversion is never mistaken for a cache
+    metadata = {
+        "version": CACHE_VERSION,
+        "cellsize": header["cellsize"],
+        "nodata_value": header.get("nodata_value"),
+        "nrows": shape[0],
+        "ncols": shape[1],
+        "origin": {key: value for key, value in header.items() if key[:3] in ("xll", "yll")},
+        "dtype": cache_dtype.name,
+        "has_npy": has_nodata,
+        "source": os.path.basename(flt_path),
+        "source_size": stat.st_size,
+        "source_mtime": stat.st_mtime,
+        "source_sha256": sha.hexdigest(),
+    }
+    with open(meta_path, 'w') as file:
+        json.dump(metadata, file, indent=2)
+    if has_nodata:
+        return np.load(npy_path, mmap_mode='r'), header["cellsize"]
+    return dem, header["cellsize"]
+
+'''
+Reads where a DEM sits in map coordinates, from the header of its .flt grid or the
+metadata of its DEM cache. Centre-registered grids (xllcenter) are turned into corners.
+INPUTS:
+    filepath: path the DEM was loaded from (.txt, .npy, .flt or .hdr)
+OUTPUTS:
+    georef: dict with xllcorner, yllcorner, cellsize and nrows, None if the file has none
+'''
+def read_georeference(filepath):
+    if filepath.endswith(".flt") or filepath.endswith(".hdr"):
+        header = read_flt_header(get_flt_paths(filepath)[1])
+        origin = {key: value for key, value in header.items() if key[:3] in ("xll", "yll")}
+    else:
+        metadata = None
+        for dtype in (np.float64, np.float32):
+            metadata = read_cache_metadata(filepath, dtype)
+            if metadata is not None:
+                break
+        if metadata is None:
+            return None
+        header = metadata
+        origin = metadata.get("origin", {})
+    cell_size = header["cellsize"]
+    georef = {"cellsize": cell_size, "nrows": header["nrows"]}
+    for axis in ("x", "y"):
+        if axis + "llcorner" in origin:
+            georef[axis + "llcorner"] = origin[axis + "llcorner"]
+        elif axis + "llcenter" in origin:
+            georef[axis + "llcorner"] = origin[axis + "llcenter"] - cell_size/2
+        else:
+            georef[axis + "llcorner"] = 0.0
+    return georef
+
+'''
+Loads a DEM, using the DEM cache whenever possible.
+    .txt: opens the cache next to it, (re)building it first if it is missing or stale
+    .npy: opens a cache directly
+    .flt/.hdr: memory maps an ESRI binary float grid, or its NaN-masked cache, see "load_flt"
+    .npz: files saved by older versions of this program (loaded fully into memory)
+INPUTS:
+    filepath: path to the DEM
+    mmap_mode: how to memory map the cache, see np.load
+    plotting: show the DEM if it had to be converted
+    dtype: dtype to convert .txt grids to, None uses DEFAULT_DTYPE. Other files keep
+           the dtype they were saved with.
+OUTPUTS:
+    dem: the DEM as a (memory mapped) numpy array
+    cell_size: the size of each cell in the DEM
+'''
+@instrumentation.timed("load")
+def load_dem(filepath, mmap_mode='r', plotting=False, dtype=None):
+    if filepath.endswith(".txt"):
+        dtype = DEFAULT_DTYPE if dtype is None else np.dtype(dtype)
+        if not is_cache_fresh(filepath, dtype):
+            console.report("Saving DEM as numpy file")
+            console.report("This will allow for faster loading in the future")
+            return dem_txt_to_npy(filepath, plotting, dtype)
+        filepath = get_cache_paths(filepath, dtype)[0]
+    if filepath.endswith(".npy"):
+        metadata = read_cache_metadata(filepath)
+        if metadata is None:
+            raise FileNotFoundError("Missing metadata file " + get_cache_paths(filepath)[1])
+        return np.load(filepath, mmap_mode=mmap_mode), metadata["cellsize"]
+    if filepath.endswith(".flt") or filepath.endswith(".hdr"):
+        return load_flt(filepath)
+    if filepath.endswith(".npz"):
+        data_npz = np.load(filepath)
+        return data_npz['name2'], data_npz['name1']
+    raise ValueError("File must be a .txt, .npy, .flt or .npz file")
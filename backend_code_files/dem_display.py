@@ -0,0 +1,157 @@
+import numpy as np
+from backend_code_files import chain_paths
+
+# matplotlib is only imported by the functions that draw, so building pyramids and the
+# rest of the backend do not pay for it
+
+# Levels are halved until the longest side is at most this many pixels
+PYRAMID_MIN_SIZE = 256
+# Number of DEM cells averaged at a time when building the first level
+PYRAMID_TILE_CELLS = 2**22
+
+'''
+Halves a raster by averaging every 2x2 block, ignoring NaN cells. A block is NaN only
+if all of its cells are NaN. Odd rows or columns at the edge are averaged on their own.
+INPUTS:
+    raster: 2D numpy array (or memmap)
+OUTPUTS:
+    half: (ceil(rows/2), ceil(cols/2)) float32 array
+'''
+def downsample_nanmean(raster):
+    num_rows, num_cols = raster.shape
+    half = np.empty(((num_rows+1)//2, (num_cols+1)//2), dtype=np.float32)
+    tile_rows = max(2, (PYRAMID_TILE_CELLS // max(num_cols, 1)) // 2 * 2)
+    for start in range(0, num_rows, tile_rows):
+        block = np.asarray(raster[start:start+tile_rows], dtype=np.float32)
+        # Pad with NaN to an even size, the padding is ignored like any other NaN
+        pad_rows, pad_cols = block.shape[0] % 2, block.shape[1] % 2
+        if pad_rows or pad_cols:
+            block = np.pad(block, ((0, pad_rows), (0, pad_cols)), constant_values=np.nan)
+        quads = block.reshape(block.shape[0]//2, 2, block.shape[1]//2, 2)
+        valid = ~np.isnan(quads)
+        total = np.where(valid, quads, 0).sum(axis=(1, 3))
+        count = valid.sum(axis=(1, 3))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            half[start//2:start//2+quads.shape[0]] = np.where(count > 0, total / count, np.nan)
+    return half
+
+'''
+Returns the shapes of the pyramid levels of a DEM, level 0 being the DEM itself
+'''
+def get_pyramid_shapes(shape, min_size=PYRAMID_MIN_SIZE):
+    shapes = [tuple(shape)]
+    while max(shapes[-1]) > min_size:
+        num_rows, num_cols = shapes[-1]
+        shapes.append(((num_rows+1)//2, (num_cols+1)//2))
+    return shapes
+
+'''
+Builds the overview pyramid of a DEM: each level is half the size of the one before it,
+NaN-aware (see "downsample_nanmean"), down to PYRAMID_MIN_SIZE. The first level is
+built in row tiles, so the DEM can be memory mapped.
+INPUTS:
+    dem: 2D numpy array (or memmap) of elevations
+OUTPUTS:
+    pyramid: list of levels, pyramid[0] is the DEM itself
+'''
+def build_pyramid(dem, min_size=PYRAMID_MIN_SIZE):
+    pyramid = [dem]
+    for _ in get_pyramid_shapes(dem.shape, min_size)[1:]:
+        pyramid.append(downsample_nanmean(pyramid[-1]))
+    return pyramid
+
+'''
+Picks the smallest pyramid level that still has at least one cell per display pixel
+INPUTS:
+    pyramid: from "build_pyramid"
+    display_pixels: (height, width) of the image on screen in pixels
+OUTPUTS:
+    level: index into the pyramid
+'''
+def pick_level(pyramid, display_pixels):
+    level = 0
+    for i, raster in enumerate(pyramid):
+        if raster.shape[0] < display_pixels[0] and raster.shape[1] < display_pixels[1]:
+            break
+        level = i
+    return level
+
+'''
+Shows a DEM at the pyramid level that matches the size of the axes on screen. The
+image is placed in DEM cell coordinates, so chains and other overlays can be drawn in
+row/column units whatever level is shown.
+INPUTS:
+    dem: 2D numpy array (or memmap) of elevations
+    pyramid: optional pyramid of the DEM from "build_pyramid", built if not given
+    ax: axes to draw on, the current axes if not given
+OUTPUTS:
+    image: the AxesImage that was drawn
+'''
+def show_dem(dem, pyramid=None, ax=None):
+    import matplotlib.pyplot as plt
+    if ax is None:
+        ax = plt.gca()
+    if pyramid is None:
+        pyramid = build_pyramid(dem)
+    bbox = ax.get_window_extent()
+    level = pick_level(pyramid, (bbox.height, bbox.width))
+    image = ax.imshow(np.asarray(pyramid[level]), extent=(-0.5, dem.shape[1]-0.5, dem.shape[0]-0.5, -0.5),
+                      interpolation='nearest')
+    ax.figure.colorbar(image, ax=ax)
+    return image
+
+'''
+Start and end of the line drawn for a chain, from the unique points of its path and the
+number of segments it covered. Nearly straight paths are drawn shortened by the average
+rugosity so far, the rule the original chain plots used.
+OUTPUTS:
+    y, x: [start, end] rows and columns of the line
+'''
+def get_chain_line(u_points, j, curr_avg, cell_size):
+    chain_start = u_points[0]
+    # Calc real world distance between points
+    real_world_dist = np.sqrt(
+        (chain_start[0]-u_points[j, 0])**2 + (chain_start[1]-u_points[j, 1])**2)*cell_size
+    physical_dist = np.sqrt(((u_points[1:j+1] - u_points[:j])**2).sum(axis=1))
+    total_real_world_distance = physical_dist.sum()*cell_size
+    # This case is used for adjusting the case where a line is graphed too long
+    # This occurs because of the new way I calculate the real world distance which accounts
+    # for the manhattan distance instead of the euclidean distance
+    if abs(real_world_dist - total_real_world_distance)/total_real_world_distance < 0.05:
+        end = u_points[int(j/curr_avg)]
+    else:
+        end = u_points[j]
+    return [chain_start[0], end[0]], [chain_start[1], end[1]]
+
+'''
+Draws the chains of a sampling run as one LineCollection, so thousands of chains draw
+as fast as one. Chains without a rugosity are skipped.
+INPUTS:
+    samples: sampling_engine.SAMPLE_DTYPE array
+    cell_size: size of each cell in meters
+    ax: axes to draw on, the current axes if not given
+    color: color of the chains
+OUTPUTS:
+    lines: the LineCollection that was drawn
+'''
+def plot_chains(samples, cell_size, ax=None, color='b'):
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+    if ax is None:
+        ax = plt.gca()
+    segments = []
+    rugosity_sum = 0.0
+    rugosity_count = 0
+    for sample in samples:
+        if np.isnan(sample["rugosity"]) or sample["steps"] < 1:
+            continue
+        rugosity_sum += sample["rugosity"]
+        rugosity_count += 1
+        length_cells = int(sample["length"]/cell_size)
+        _, cell_offsets = chain_paths.get_path_template(float(sample["angle"]), length_cells)
+        u_points = cell_offsets + (sample["y"], sample["x"])
+        y, x = get_chain_line(u_points, int(sample["steps"]), rugosity_sum/rugosity_count, cell_size)
+        segments.append(((x[0], y[0]), (x[1], y[1])))
+    lines = LineCollection(segments, colors=color, linewidths=1)
+    ax.add_collection(lines)
+    return lines
@@ -0,0 +1,218 @@
+import hashlib
+import os
+import shutil
+import numpy as np
+from backend_code_files import calc_site_surface_complexity as calc_sc
+from backend_code_files import convert_dem_to_npy
+from backend_code_files import dem_display
+from backend_code_files import site_index
+
+# Name of the folder next to the DEM that holds the derived data
+CACHE_DIR_NAME = "derived_cache"
+# Once the cache is bigger than this, the least recently used entries are deleted
+DEFAULT_CACHE_BYTES = 8 * 2**30
+
+'''
+Key of the DEM contents. DEMs loaded from the DEM cache use the source file hash from
+their metadata sidecar. Other DEM files (.flt, .npz, .npy without a sidecar) are keyed by
+their path, size and modification time, like "convert_dem_to_npy.is_cache_fresh", so
+opening the cache never reads the whole DEM. Only a DEM without a file is hashed block
+by block.
+INPUTS:
+    dem: 2D numpy array (or memmap) of elevations
+    filepath: optional path the DEM was loaded from
+OUTPUTS:
+    hex digest of the DEM
+'''
+def get_dem_hash(dem, filepath=None):
+    sha = hashlib.sha256()
+    sha.update((str(dem.shape) + dem.dtype.str).encode())
+    if filepath is not None:
+        # The sidecar of a float32 cache has the "_f32" suffix, unless the cache itself was loaded
+        for dtype in (dem.dtype, np.float64):
+            metadata = convert_dem_to_npy.read_cache_metadata(filepath, dtype)
+            if metadata is not None and "source_sha256" in metadata:
+                return metadata["source_sha256"]
+        if filepath.endswith((".flt", ".hdr")):
+            filepath = convert_dem_to_npy.get_flt_paths(filepath)[0]
+        if os.path.exists(filepath):
+            stat = os.stat(filepath)
+            sha.update((os.path.abspath(filepath) + str(stat.st_size) + repr(stat.st_mtime)).encode())
+            return sha.hexdigest()
+    tile_rows = calc_sc.default_tile_rows(dem)
+    for start in range(0, dem.shape[0], tile_rows):
+        sha.update(np.ascontiguousarray(dem[start:start+tile_rows]).tobytes())
+    return sha.hexdigest()
+
+'''
+Opens the derived data cache of a DEM. Entries are keyed by the DEM content hash and the
+cell size, so any copy of the same DEM shares them.
+INPUTS:
+    dem: 2D numpy array (or memmap) of elevations
+    cell_size: the size of each cell in the DEM
+    filepath: optional path the DEM was loaded from, the cache goes in the same folder
+    cache_dir: folder of the cache, overrides the one picked from filepath
+    max_bytes: size limit of the whole cache folder
+OUTPUTS:
+    cache: dict describing the cache entry, passed to the other functions of this file
+'''
+def open_cache(dem, cell_size, filepath=None, cache_dir=None, max_bytes=DEFAULT_CACHE_BYTES):
+    if cache_dir is None:
+        folder = os.path.dirname(os.path.abspath(filepath)) if filepath is not None else os.getcwd()
+        cache_dir = os.path.join(folder, CACHE_DIR_NAME)
+    key = get_dem_hash(dem, filepath)[:32] + "_" + repr(float(cell_size))
+    # A float32 copy of a DEM shares its source hash but not its derived data
+    if dem.dtype != np.float64:
+        key += "_" + dem.dtype.name
+    return {"root": cache_dir, "dir": os.path.join(cache_dir, key), "max_bytes": max_bytes}
+
+def _entry_size(entry_dir):
+    return sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+
+'''
+Deletes the least recently used cache entries until the cache fits in its size limit.
+The entry in use is never deleted.
+'''
+def evict(cache):
+    if not os.path.isdir(cache["root"]):
+        return
+    entries = [os.path.join(cache["root"], name) for name in os.listdir(cache["root"])]
+    entries = [entry for entry in entries if os.path.isdir(entry)]
+    sizes = {entry: _entry_size(entry) for entry in entries}
+    total = sum(sizes.values())
+    for entry in sorted(entries, key=os.path.getmtime):
+        if total <= cache["max_bytes"]:
+            break
+        if os.path.abspath(entry) == os.path.abspath(cache["dir"]):
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= sizes[entry]
+
+'''
+Path of a product of a cache entry
+'''
+def _product_path(cache, name):
+    return os.path.join(cache["dir"], name + ".npy")
+
+'''
+Creates a product as a memory mapped .npy inside the cache entry, for products too big to
+build in memory. Fill it in and return it from the build function of "load_products" like
+any other array, it is moved into place without another copy.
+'''
+def new_product(cache, name, shape, dtype):
+    os.makedirs(cache["dir"], exist_ok=True)
+    return np.lib.format.open_memmap(_product_path(cache, name) + ".tmp", mode='w+', dtype=dtype, shape=shape)
+
+'''
+Loads derived products from the cache, building and saving them first if any is missing.
+Products are raw .npy files opened with mmap_mode="r".
+INPUTS:
+    cache: from "open_cache"
+    names: names of the products
+    build: function returning a dict of name to array for all of the products, arrays
+           from "new_product" are already on disk
+OUTPUTS:
+    tuple of the products, in the order of names
+'''
+def load_products(cache, names, build):
+    paths = [_product_path(cache, name) for name in names]
+    if not all(os.path.exists(path) for path in paths):
+        os.makedirs(cache["dir"], exist_ok=True)
+        products = build()
+        for name, path in zip(names, paths):
+            product = products[name]
+            # Write to a temporary file first, so a crash never leaves half a product
+            if isinstance(product, np.memmap) and product.filename == os.path.abspath(path + ".tmp"):
+                product.flush()
+            else:
+                with open(path + ".tmp", 'wb') as file:
+                    np.save(file, product)
+        # Close the memory maps before moving their files
+        del products, product
+        for path in paths:
+            os.replace(path + ".tmp", path)
+        evict(cache)
+    # Mark the entry as recently used
+    os.utime(cache["dir"])
+    return tuple(np.load(path, mmap_mode='r') for path in paths)
+
+'''
+Per-row 3D area and valid quad count of the DEM, see calc_sc.calc_site_row_sums
+'''
+def get_row_sums(dem, cell_size, cache, num_workers=1):
+    def build():
+        row_area_3d, row_valid = calc_sc.calc_site_row_sums(dem, cell_size, num_workers=num_workers)
+        return {"row_area_3d": row_area_3d, "row_valid": row_valid}
+    return load_products(cache, ("row_area_3d", "row_valid"), build)
+
+'''
+Summed-area tables of the 3D quad area and valid quad count, see calc_sc.calc_area_tables
+'''
+def get_area_tables(dem, cell_size, cache):
+    def build():
+        # 16 bytes per DEM cell, so the tables are filled in place on disk
+        area_sat = new_product(cache, "area_sat", dem.shape, np.float64)
+        count_sat = new_product(cache, "count_sat", dem.shape, np.int64)
+        calc_sc.calc_area_tables(dem, cell_size, out=(area_sat, count_sat))
+        return {"area_sat": area_sat, "count_sat": count_sat}
+    return load_products(cache, ("area_sat", "count_sat"), build)
+
+'''
+Per-quad 3D area raster of the DEM (NaN for invalid quads), see calc_sc.calc_quad_areas
+'''
+def get_quad_areas(dem, cell_size, cache):
+    def build():
+        dtype = calc_sc.COMPUTE_DTYPE
+        quad_areas = new_product(cache, "quad_areas", (max(0, dem.shape[0]-1), max(0, dem.shape[1]-1)), dtype)
+        for start, stop in calc_sc.get_row_tiles(dem.shape[0], calc_sc.default_tile_rows(dem)):
+            quad_areas[start:stop-1] = calc_sc.calc_quad_areas(np.asarray(dem[start:stop], dtype=dtype), cell_size)
+        return {"quad_areas": quad_areas}
+    return load_products(cache, ("quad_areas",), build)[0]
+
+'''
+NaN mask of the DEM and its summed-area table, used by site_index. Both are filled tile
+by tile on disk, the same values as site_index.summed_area_table(np.isnan(dem)).
+'''
+def get_validity(dem, cache):
+    def build():
+        num_rows, num_cols = dem.shape
+        nan_mask = new_product(cache, "nan_mask", dem.shape, np.bool_)
+        nan_sat = new_product(cache, "nan_sat", (num_rows+1, num_cols+1), site_index.get_sat_dtype(dem.size))
+        tile_rows = max(1, calc_sc.DEFAULT_TILE_CELLS // max(1, num_cols))
+        for start in range(0, num_rows, tile_rows):
+            stop = min(start+tile_rows, num_rows)
+            mask = np.isnan(dem[start:stop])
+            nan_mask[start:stop] = mask
+            # Row sums first, then carry the running total down from the row above the tile
+            mask_rows = np.cumsum(mask, axis=1, dtype=nan_sat.dtype)
+            nan_sat[start+1:stop+1, 1:] = np.cumsum(mask_rows, axis=0) + nan_sat[start, 1:]
+        return {"nan_mask": nan_mask, "nan_sat": nan_sat}
+    return load_products(cache, ("nan_mask", "nan_sat"), build)
+
+'''
+Overview pyramid of the DEM for display, see dem_display.build_pyramid. Level 0 is the
+DEM itself, the other levels come from the cache.
+'''
+def get_pyramid(dem, cache):
+    names = tuple("pyramid_" + str(level) for level in range(1, len(dem_display.get_pyramid_shapes(dem.shape))))
+    def build():
+        return dict(zip(names, dem_display.build_pyramid(dem)[1:]))
+    if not names:
+        return [dem]
+    return [dem] + list(load_products(cache, names, build))
+
+'''
+Surface complexity of the whole DEM from the cached row sums. Gives exactly the same
+value as calc_sc.calculate_site_surface_complexity.
+'''
+def cached_site_surface_complexity(dem, cell_size, cache, num_workers=1):
+    row_area_3d, row_valid = get_row_sums(dem, cell_size, cache, num_workers)
+    return calc_sc.complexity_from_row_sums(row_area_3d, row_valid, cell_size)
+
+'''
+Registers the cached NaN summed-area table of the DEM with site_index, so site searches
+on this DEM start warm
+'''
+def warm_site_index(dem, cache):
+    _, nan_sat = get_validity(dem, cache)
+    site_index.register_nan_sat(dem, nan_sat)
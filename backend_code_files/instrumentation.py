@@ -0,0 +1,138 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# Stages timed by the calculator
+STAGES = ("ingest", "load", "site_search", "path_generation", "chain_drop", "surface_complexity")
+
+# Set RUGOSITY_INSTRUMENT=1 to turn instrumentation on from the start
+_enabled = os.environ.get("RUGOSITY_INSTRUMENT", "") not in ("", "0")
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+_start_time = time.time()
+_null_timer = contextlib.nullcontext()
+
+'''
+Turns instrumentation on or off. Turning it on also clears what was recorded so far.
+'''
+def enable(flag=True):
+    global _enabled
+    _enabled = bool(flag)
+    if _enabled:
+        reset()
+
+def is_enabled():
+    return _enabled
+
+'''
+Clears every timer and counter
+'''
+def reset():
+    global _start_time
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _start_time = time.time()
+
+'''
+Times a stage of the calculation. Use as
+    with instrumentation.timer("chain_drop"):
+        ...
+Does nothing when instrumentation is off. Nested stages are each timed in full.
+'''
+def timer(stage):
+    if not _enabled:
+        return _null_timer
+    return _timed(stage)
+
+@contextlib.contextmanager
+def _timed(stage):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(stage, time.perf_counter() - start_time)
+
+def add_time(stage, seconds):
+    with _lock:
+        entry = _timers.setdefault(stage, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+        entry["calls"] += 1
+        entry["seconds"] += seconds
+        entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+'''
+Decorator version of "timer", times every call of the function as the given stage
+'''
+def timed(stage):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _timed(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+'''
+Adds to a counter, for example count("chains.nan"). Does nothing when instrumentation is off.
+'''
+def count(name, amount=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + int(amount)
+
+'''
+Returns what was recorded so far, to be merged into another process with "merge"
+'''
+def snapshot():
+    with _lock:
+        return {"timers": {stage: dict(entry) for stage, entry in _timers.items()},
+                "counters": dict(_counters)}
+
+'''
+Adds a snapshot from a worker process to the timers and counters of this process
+'''
+def merge(other):
+    if not _enabled or not other:
+        return
+    with _lock:
+        for stage, entry in other["timers"].items():
+            mine = _timers.setdefault(stage, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+            mine["calls"] += entry["calls"]
+            mine["seconds"] += entry["seconds"]
+            mine["max_seconds"] = max(mine["max_seconds"], entry["max_seconds"])
+        for name, amount in other["counters"].items():
+            _counters[name] = _counters.get(name, 0) + amount
+
+'''
+Builds the run statistics report: wall time, time per stage (with its share of the wall
+time) and every counter. Stage times from worker processes are summed over the workers,
+so they can add up to more than the wall time.
+OUTPUTS:
+    report: dict that can be dumped as JSON
+'''
+def report():
+    data = snapshot()
+    wall_seconds = time.time() - _start_time
+    stages = {}
+    for stage, entry in sorted(data["timers"].items(), key=lambda item: -item[1]["seconds"]):
+        stages[stage] = dict(entry, mean_seconds=entry["seconds"] / max(entry["calls"], 1),
+                             share_of_wall=entry["seconds"] / wall_seconds if wall_seconds > 0 else 0.0)
+    return {"wall_seconds": wall_seconds, "stages": stages, "counters": dict(sorted(data["counters"].items()))}
+
+'''
+Writes the report as JSON to a file, or prints it when no path is given
+'''
+def dump_report(path=None):
+    text = json.dumps(report(), indent=2)
+    if path is None:
+        print(text)
+    else:
+        with open(path, 'w') as file:
+            file.write(text + "\n")
@@ -0,0 +1,229 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from backend_code_files import calc_site_surface_complexity as calc_sc
+from backend_code_files import chain_paths
+from backend_code_files import console
+from backend_code_files import convert_dem_to_npy
+from backend_code_files import derived_cache
+from backend_code_files import roi
+from backend_code_files import sampling_engine
+
+# Number of DEMs kept loaded (memory mapped) at the same time
+DEFAULT_MAX_RESIDENT_DEMS = 4
+
+_resident_dems = OrderedDict()
+_resident_lock = threading.Lock()
+_max_resident_dems = DEFAULT_MAX_RESIDENT_DEMS
+# dtype .txt DEMs are converted to, None uses convert_dem_to_npy.DEFAULT_DTYPE
+_dtype = None
+
+'''
+A request the client got wrong, answered with a 400
+'''
+class RequestError(ValueError):
+    pass
+
+'''
+Returns a field of a request, or raises a RequestError if it is missing
+'''
+def require(request, field):
+    if field not in request:
+        raise RequestError("Missing field '" + field + "'")
+    return request[field]
+
+'''
+Returns a resident DEM, loading it first if needed. Loaded DEMs are memory mapped, get a
+derived data cache and a warm site index, and are kept in an LRU of resident DEMs.
+INPUTS:
+    dem_path: path to the DEM (.txt, .npy, .flt or .npz)
+OUTPUTS:
+    entry: dict with the dem, cell_size, cache and a lock for building derived data
+'''
+def get_dem(dem_path):
+    dem_path = os.path.abspath(dem_path)
+    with _resident_lock:
+        entry = _resident_dems.get(dem_path)
+        if entry is None:
+            entry = {"path": dem_path, "lock": threading.Lock(), "dem": None}
+            _resident_dems[dem_path] = entry
+            while len(_resident_dems) > _max_resident_dems:
+                _resident_dems.popitem(last=False)
+        _resident_dems.move_to_end(dem_path)
+    # Only the first request of a DEM loads it, the others wait for it
+    with entry["lock"]:
+        if entry["dem"] is None:
+            dem, cell_size = convert_dem_to_npy.load_dem(dem_path, plotting=False, dtype=_dtype)
+            cache = derived_cache.open_cache(dem, cell_size, dem_path)
+            derived_cache.warm_site_index(dem, cache)
+            entry.update(dem=dem, cell_size=float(cell_size), cache=cache, tables=None,
+                         georef=convert_dem_to_npy.read_georeference(dem_path))
+    return entry
+
+'''
+Summed-area tables of a resident DEM, loaded once from the derived data cache
+'''
+def get_tables(entry):
+    with entry["lock"]:
+        if entry["tables"] is None:
+            entry["tables"] = derived_cache.get_area_tables(entry["dem"], entry["cell_size"], entry["cache"])
+    return entry["tables"]
+
+'''
+Query: surface complexity of a whole DEM
+    {"dem": path}
+'''
+def query_surface_complexity(request):
+    entry = get_dem(require(request, "dem"))
+    with entry["lock"]:
+        surface_complexity = derived_cache.cached_site_surface_complexity(
+            entry["dem"], entry["cell_size"], entry["cache"])
+    return {"surface_complexity": surface_complexity}
+
+'''
+Query: rugosity samples of a DEM
+    {"dem": path, "num_samples": n, "length": meters or [min, max], "orientation": degrees or null,
+     "seed": int or null, "values": true to return every sample,
+     "target_error": relative precision to stop at (num_samples is then the most samples)}
+'''
+def query_sample_rugosity(request):
+    entry = get_dem(require(request, "dem"))
+    length = request.get("length", 1)
+    if isinstance(length, list):
+        length = tuple(length)
+    if request.get("target_error") is not None:
+        samples, seed, summary = sampling_engine.run_adaptive_sampling(
+            entry["dem"], entry["cell_size"], length, request.get("orientation"), request.get("seed"),
+            float(require(request, "target_error")), max_samples=int(request.get("num_samples", sampling_engine.DEFAULT_MAX_SAMPLES)))
+    else:
+        samples, seed = sampling_engine.run_sampling(
+            entry["dem"], entry["cell_size"], int(request.get("num_samples", 100)), length,
+            request.get("orientation"), request.get("seed"))
+        summary = sampling_engine.summarize(samples)
+    response = {
+        "seed": seed,
+        "rugosity_mean": None if np.isnan(summary["mean"]) else summary["mean"],
+        "rugosity_std": None if np.isnan(summary["variance"]) else float(np.sqrt(summary["variance"])),
+        "rugosity_ci": None if np.isnan(summary["ci_half_width"]) else summary["ci_half_width"],
+        "num_drawn": len(samples),
+        "num_valid": summary["num_valid"],
+        "num_cut": int(np.count_nonzero(samples["status"] != chain_paths.CHAIN_OK)),
+    }
+    if "converged" in summary:
+        response["converged"] = summary["converged"]
+    if request.get("values"):
+        response["samples"] = [
+            {"y": int(sample["y"]), "x": int(sample["x"]), "angle": float(sample["angle"]),
+             "length": float(sample["length"]),
+             "rugosity": None if np.isnan(sample["rugosity"]) else float(sample["rugosity"]),
+             "status": chain_paths.CHAIN_STATUS_NAMES[int(sample["status"])]}
+            for sample in samples]
+    return response
+
+'''
+Query: surface complexity of regions of interest of a DEM
+    {"dem": path, "bboxes": [[row0, col0, row1, col1], ...]}
+or, with polygons and map coordinates (see roi.roi_surface_complexity)
+    {"dem": path, "rois": [{"name": "quadrat 1", "bbox": [xmin, ymin, xmax, ymax], "coords": "map"},
+                           {"polygon": [[row, col], ...]}, ...]}
+'''
+def query_roi(request):
+    entry = get_dem(require(request, "dem"))
+    if "rois" not in request:
+        tables = get_tables(entry)
+        values = [calc_sc.bbox_surface_complexity(tables, entry["cell_size"], bbox) for bbox in require(request, "bboxes")]
+        return {"surface_complexity": [None if np.isnan(value) else value for value in values]}
+    tables = get_tables(entry) if any("bbox" in item for item in request["rois"]) else None
+    results = roi.roi_surface_complexity(entry["dem"], entry["cell_size"], request["rois"], tables, entry["georef"])
+    for result in results:
+        if np.isnan(result["surface_complexity"]):
+            result["surface_complexity"] = None
+    return {"rois": results}
+
+'''
+Query: the DEMs that are currently resident
+'''
+def query_status(request):
+    with _resident_lock:
+        dems = [{"dem": path, "shape": list(entry["dem"].shape), "cell_size": entry["cell_size"]}
+                for path, entry in _resident_dems.items() if entry["dem"] is not None]
+    return {"resident_dems": dems, "max_resident_dems": _max_resident_dems}
+
+QUERIES = {
+    "surface_complexity": query_surface_complexity,
+    "sample_rugosity": query_sample_rugosity,
+    "roi": query_roi,
+    "status": query_status,
+}
+
+'''
+HTTP handler: POST /<query> with a JSON body, or GET /status. Answers are JSON.
+'''
+class QueryHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.answer({})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            self.send_json(400, {"error": "Invalid JSON: " + str(e)})
+            return
+        self.answer(request)
+
+    def answer(self, request):
+        query = QUERIES.get(self.path.strip("/"))
+        if query is None:
+            self.send_json(404, {"error": "Unknown query, use one of " + ", ".join(QUERIES)})
+            return
+        start_time = time.time()
+        try:
+            # Handler threads never print or show progress bars
+            with console.quiet():
+                response = query(request)
+        except RequestError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        response["elapsed_ms"] = round((time.time() - start_time)*1000, 3)
+        self.send_json(200, response)
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+'''
+Starts the query server on localhost and serves until interrupted
+INPUTS:
+    host: address to listen on, keep it on localhost
+    port: port to listen on
+    max_dems: number of DEMs kept resident
+    preload: list of DEM paths to load before serving
+    dtype: dtype to convert .txt DEMs to, None uses convert_dem_to_npy.DEFAULT_DTYPE
+'''
+def serve(host="127.0.0.1", port=8765, max_dems=DEFAULT_MAX_RESIDENT_DEMS, preload=(), dtype=None):
+    global _max_resident_dems, _dtype
+    _max_resident_dems = max(1, int(max_dems))
+    _dtype = dtype
+    for dem_path in preload:
+        get_dem(dem_path)
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    print("Rugosity query server listening on http://" + host + ":" + str(server.server_address[1]))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,203 @@
+import csv
+import io
+import json
+import os
+import time
+import numpy as np
+from backend_code_files import chain_paths
+
+# Output formats: a CSV with one row per sample, or a folder with one raw binary file
+# per column (readable with np.fromfile, or "read_results"). Every sample of a run has the
+# same seed, so the columnar format keeps it once, in the run_info of the checkpoint.
+FORMATS = ("csv", "columns")
+# Columns of every sample record, in file order
+RESULT_FIELDS = ("seed", "block", "y", "x", "angle", "length", "rugosity", "status", "steps")
+# A checkpoint is written at most this often, and always at the end of the run
+DEFAULT_CHECKPOINT_SECONDS = 10.0
+
+'''
+Path of the checkpoint that goes with a result file
+'''
+def get_checkpoint_path(path):
+    return path.rstrip("/\\") + ".checkpoint.json"
+
+def read_checkpoint(path):
+    checkpoint_path = get_checkpoint_path(path)
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r') as file:
+        return json.load(file)
+
+'''
+Writes the checkpoint atomically, so a crash leaves either the old or the new one
+'''
+def _write_checkpoint(path, checkpoint):
+    checkpoint_path = get_checkpoint_path(path)
+    with open(checkpoint_path + ".tmp", 'w') as file:
+        json.dump(checkpoint, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+def _column_path(path, field):
+    return os.path.join(path, field + ".bin")
+
+'''
+Dtype of every column of the columnar format, all the result fields but the seed
+'''
+def get_column_dtypes(sample_dtype):
+    return {field: sample_dtype[field].newbyteorder("<") for field in RESULT_FIELDS[1:]}
+
+'''
+Appends sampling results to a CSV or columnar output in batches, and checkpoints how many
+blocks are safely on disk. Opening an output that has a checkpoint resumes it: anything
+written after the last checkpoint is cut off and the run continues from the next block.
+INPUTS:
+    path: the .csv file, or the folder of the columnar format
+    run_info: dict describing the run (seed, parameters), stored in the checkpoint. An
+              existing checkpoint is only resumed if its run_info matches.
+    sample_dtype: dtype of the sample records, sampling_engine.SAMPLE_DTYPE
+    fmt: "csv" or "columns", None picks "csv" for paths ending in .csv
+'''
+class ResultWriter:
+    def __init__(self, path, run_info, sample_dtype, fmt=None, checkpoint_seconds=DEFAULT_CHECKPOINT_SECONDS):
+        if fmt is None:
+            fmt = "csv" if path.lower().endswith(".csv") else "columns"
+        if fmt not in FORMATS:
+            raise ValueError("Output format must be one of " + ", ".join(FORMATS))
+        self.path = path
+        self.fmt = fmt
+        self.run_info = run_info
+        self.sample_dtype = sample_dtype
+        self.checkpoint_seconds = checkpoint_seconds
+        self.seed = str(run_info["seed"])
+
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        checkpoint = read_checkpoint(path)
+        if checkpoint is not None and checkpoint["run_info"] != run_info:
+            raise ValueError("The output " + path + " belongs to a different run, pick another name "
+                             "or delete it and " + get_checkpoint_path(path))
+        if checkpoint is not None and checkpoint["format"] != fmt:
+            raise ValueError("The output " + path + " was written as " + checkpoint["format"])
+        self.blocks_done = checkpoint["blocks_done"] if checkpoint else 0
+        self.rows_done = checkpoint["rows_done"] if checkpoint else 0
+        self.complete = checkpoint["complete"] if checkpoint else False
+
+        if fmt == "csv":
+            bytes_done = checkpoint["bytes_done"] if checkpoint else 0
+            self.file = open(path, 'r+b' if checkpoint else 'wb')
+            # Drop anything written after the last checkpoint
+            self.file.truncate(bytes_done)
+            self.file.seek(bytes_done)
+            if not checkpoint:
+                self.file.write((",".join(RESULT_FIELDS) + "\n").encode())
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.files = {}
+            for field, dtype in get_column_dtypes(sample_dtype).items():
+                column_file = open(_column_path(path, field), 'r+b' if checkpoint else 'wb')
+                column_file.truncate(self.rows_done * dtype.itemsize)
+                column_file.seek(self.rows_done * dtype.itemsize)
+                self.files[field] = column_file
+        self.last_checkpoint = time.monotonic()
+        if not checkpoint:
+            self.checkpoint()
+
+    '''
+    Appends one block of samples. The block index must follow the blocks already written.
+    '''
+    def write_block(self, block, samples):
+        if block != self.blocks_done:
+            raise ValueError("Block " + str(block) + " written out of order, expected " + str(self.blocks_done))
+        if self.fmt == "csv":
+            text = io.StringIO()
+            writer = csv.writer(text, lineterminator="\n")
+            for sample in samples:
+                writer.writerow([self.seed, int(sample["block"]), int(sample["y"]), int(sample["x"]),
+                                 repr(float(sample["angle"])), repr(float(sample["length"])), repr(float(sample["rugosity"])),
+                                 chain_paths.CHAIN_STATUS_NAMES[int(sample["status"])], int(sample["steps"])])
+            self.file.write(text.getvalue().encode())
+        else:
+            for field, dtype in get_column_dtypes(self.sample_dtype).items():
+                self.files[field].write(samples[field].astype(dtype).tobytes())
+        self.blocks_done += 1
+        self.rows_done += len(samples)
+        if time.monotonic() - self.last_checkpoint >= self.checkpoint_seconds:
+            self.checkpoint()
+
+    '''
+    Flushes everything written so far to disk and records it in the checkpoint
+    '''
+    def checkpoint(self, complete=False):
+        files = [self.file] if self.fmt == "csv" else list(self.files.values())
+        for file in files:
+            file.flush()
+            os.fsync(file.fileno())
+        self.complete = complete
+        _write_checkpoint(self.path, {
+            "format": self.fmt,
+            "run_info": self.run_info,
+            "blocks_done": self.blocks_done,
+            "rows_done": self.rows_done,
+            "bytes_done": self.file.tell() if self.fmt == "csv" else None,
+            "complete": complete,
+        })
+        self.last_checkpoint = time.monotonic()
+
+    def close(self, complete=False):
+        self.checkpoint(complete)
+        files = [self.file] if self.fmt == "csv" else list(self.files.values())
+        for file in files:
+            file.close()
+
+'''
+Reads the samples written by a ResultWriter, up to its last checkpoint
+INPUTS:
+    path: the .csv file or the columnar folder
+    sample_dtype: dtype of the sample records, sampling_engine.SAMPLE_DTYPE
+OUTPUTS:
+    samples: sample_dtype array
+    seeds: array of the seed of each sample (from the checkpoint for the columnar format)
+'''
+def read_results(path, sample_dtype):
+    checkpoint = read_checkpoint(path)
+    num_rows = checkpoint["rows_done"] if checkpoint else None
+    if os.path.isdir(path):
+        columns = {}
+        for field, dtype in get_column_dtypes(sample_dtype).items():
+            columns[field] = np.fromfile(_column_path(path, field), dtype=dtype, count=-1 if num_rows is None else num_rows)
+        samples = np.zeros(len(columns["block"]), dtype=sample_dtype)
+        for field in RESULT_FIELDS[1:]:
+            samples[field] = columns[field]
+        seed = str(checkpoint["run_info"]["seed"]) if checkpoint else ""
+        return samples, np.full(len(samples), seed)
+
+    status_codes = {name: code for code, name in chain_paths.CHAIN_STATUS_NAMES.items()}
+    with open(path, 'r', newline='') as file:
+        rows = list(csv.DictReader(file))
+    if num_rows is not None:
+        rows = rows[:num_rows]
+    samples = np.zeros(len(rows), dtype=sample_dtype)
+    for i, row in enumerate(rows):
+        samples[i] = (int(row["block"]), int(row["y"]), int(row["x"]), float(row["angle"]), float(row["length"]),
+                      float(row["rugosity"]), status_codes[row["status"]], int(row["steps"]))
+    return samples, np.array([row["seed"] for row in rows])
+
+'''
+Writes a finished set of samples in one go (for runs like the adaptive sampler that only
+know which samples they keep at the end), block by block like a streamed run
+INPUTS:
+    path: the .csv file, or the folder of the columnar format
+    samples: sample_dtype array, in block order
+    run_info: dict describing the run, must hold its "seed"
+    sample_dtype: dtype of the sample records, sampling_engine.SAMPLE_DTYPE
+    fmt: "csv" or "columns", None picks from the path
+'''
+def write_results(path, samples, run_info, sample_dtype, fmt=None):
+    writer = ResultWriter(path, run_info, sample_dtype, fmt)
+    _, starts = np.unique(samples["block"], return_index=True)
+    for i, start in enumerate(starts):
+        end = starts[i+1] if i+1 < len(starts) else len(samples)
+        writer.write_block(i, samples[start:end])
+    writer.close(complete=True)
@@ -0,0 +1,157 @@
+import math
+import numpy as np
+from backend_code_files import calc_site_surface_complexity as calc_sc
+
+# Regions of interest (ROIs) are bounding boxes and polygons, in grid or map coordinates:
+#   grid: (row, col) of DEM cells, cell centers are at whole numbers
+#   map: (x, y) in the units of the DEM header, see convert_dem_to_npy.read_georeference
+# A cell belongs to an ROI when its center is inside it, and a quad counts when all four
+# of its corner cells belong to the ROI, the same rule as calc_sc.bbox_surface_complexity.
+
+'''
+Turns map coordinates into fractional grid coordinates of cell centers
+INPUTS:
+    x, y: map coordinates (scalars or arrays)
+    georef: from convert_dem_to_npy.read_georeference
+OUTPUTS:
+    rows, cols: grid coordinates, cell (i, j) has its center at (i, j)
+'''
+def map_to_grid(x, y, georef):
+    cell_size = georef["cellsize"]
+    top = georef["yllcorner"] + georef["nrows"]*cell_size
+    rows = (top - np.asarray(y, dtype=np.float64))/cell_size - 0.5
+    cols = (np.asarray(x, dtype=np.float64) - georef["xllcorner"])/cell_size - 0.5
+    return rows, cols
+
+'''
+Turns a map bounding box (xmin, ymin, xmax, ymax) into the DEM cells whose centers are
+inside it, as (row0, col0, row1, col1) with rows [row0, row1) and cols [col0, col1)
+'''
+def map_bbox_to_grid(bbox, georef):
+    xmin, ymin, xmax, ymax = bbox
+    (row_top, row_bottom), (col_left, col_right) = map_to_grid([xmin, xmax], [ymax, ymin], georef)
+    return (math.ceil(row_top), math.ceil(col_left), math.floor(row_bottom)+1, math.floor(col_right)+1)
+
+'''
+Rasterizes a polygon into a mask of the DEM cells whose centers are inside it (even-odd
+rule, so holes drawn as part of the outline work). Only the cells of the polygon's
+bounding box, clipped to the DEM, are tested.
+INPUTS:
+    vertices: (n, 2) polygon vertices in grid coordinates (row, col)
+    shape: shape of the DEM
+OUTPUTS:
+    row0, col0: DEM cell of mask[0, 0]
+    mask: 2D boolean array of the cells inside the polygon
+'''
+def rasterize_polygon(vertices, shape):
+    vertices = np.asarray(vertices, dtype=np.float64)
+    row0 = max(math.ceil(vertices[:, 0].min()), 0)
+    row1 = min(math.floor(vertices[:, 0].max())+1, shape[0])
+    col0 = max(math.ceil(vertices[:, 1].min()), 0)
+    col1 = min(math.floor(vertices[:, 1].max())+1, shape[1])
+    if row1 <= row0 or col1 <= col0:
+        return row0, col0, np.zeros((0, 0), dtype=bool)
+
+    rows = np.arange(row0, row1, dtype=np.float64)[:, None]
+    cols = np.arange(col0, col1, dtype=np.float64)[None, :]
+    mask = np.zeros((row1-row0, col1-col0), dtype=bool)
+    # Crossing test: flip every cell left of an edge that spans its row
+    for (r_a, c_a), (r_b, c_b) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        if r_a == r_b:
+            continue
+        spans = (r_a > rows) != (r_b > rows)
+        crossing = c_a + (rows - r_a) * (c_b - c_a) / (r_b - r_a)
+        mask ^= spans & (cols < crossing)
+    return row0, col0, mask
+
+'''
+3D area and valid quad count of the quads inside a polygon. Only the DEM rows and columns
+under the polygon's bounding box are read.
+INPUTS:
+    dem: 2D numpy array (or memmap) of elevations
+    cell_size: the size of each cell in the DEM
+    vertices: (n, 2) polygon vertices in grid coordinates (row, col)
+OUTPUTS:
+    area_3d: 3D area of the valid quads inside the polygon
+    count: number of valid quads inside the polygon
+'''
+def polygon_area_sums(dem, cell_size, vertices):
+    row0, col0, mask = rasterize_polygon(vertices, dem.shape)
+    if mask.shape[0] < 2 or mask.shape[1] < 2:
+        return 0.0, 0
+    block = dem[row0:row0+mask.shape[0], col0:col0+mask.shape[1]]
+    quad_areas = calc_sc.calc_quad_areas(np.asarray(block, dtype=calc_sc.COMPUTE_DTYPE), cell_size)
+    inside = mask[:-1, :-1] & mask[1:, :-1] & mask[:-1, 1:] & mask[1:, 1:] & ~np.isnan(quad_areas)
+    return math.fsum(quad_areas[inside]), int(np.count_nonzero(inside))
+
+'''
+3D area and valid quad count of the quads inside a bounding box, measured from the DEM
+rows and columns of the box only. Gives the same quads as calc_sc.bbox_area_sums without
+building the summed-area tables of the whole DEM.
+INPUTS:
+    dem: 2D numpy array (or memmap) of elevations
+    cell_size: the size of each cell in the DEM
+    bbox: (row0, col0, row1, col1) DEM cells of the rectangle, rows [row0, row1) and cols [col0, col1)
+OUTPUTS:
+    area_3d: 3D area of the valid quads
+    count: number of valid quads
+'''
+def bbox_window_area_sums(dem, cell_size, bbox):
+    row0, col0, row1, col1 = [int(value) for value in bbox]
+    block = dem[max(row0, 0):max(min(row1, dem.shape[0]), 0), max(col0, 0):max(min(col1, dem.shape[1]), 0)]
+    if block.shape[0] < 2 or block.shape[1] < 2:
+        return 0.0, 0
+    quad_areas = calc_sc.calc_quad_areas(np.asarray(block, dtype=calc_sc.COMPUTE_DTYPE), cell_size)
+    valid = ~np.isnan(quad_areas)
+    return math.fsum(quad_areas[valid]), int(np.count_nonzero(valid))
+
+'''
+Surface complexity of many ROIs of a DEM in one call. With the summed-area tables of the
+DEM (for example from derived_cache.get_area_tables) bounding boxes are answered in O(1)
+each, without them each box only reads its own part of the DEM. Polygons are rasterized
+and only read the part of the DEM they cover.
+INPUTS:
+    dem: 2D numpy array (or memmap) of elevations
+    cell_size: the size of each cell in the DEM
+    rois: list of dicts, each with either
+              "bbox": [row0, col0, row1, col1] in grid coordinates, or [xmin, ymin, xmax, ymax] in map coordinates
+              "polygon": [[row, col], ...] in grid coordinates, or [[x, y], ...] in map coordinates
+          and optionally "coords": "grid" (the default) or "map", and a "name"
+    tables: optional (area_sat, count_sat) from calc_sc.calc_area_tables or derived_cache.get_area_tables
+    georef: from convert_dem_to_npy.read_georeference, needed for map coordinates
+OUTPUTS:
+    results: list of dicts, one per ROI, with the name, surface_complexity (NaN if the ROI
+             has no valid quads), area_3d, area_2d and num_quads
+'''
+def roi_surface_complexity(dem, cell_size, rois, tables=None, georef=None):
+    results = []
+    for roi in rois:
+        coords = roi.get("coords", "grid")
+        if coords not in ("grid", "map"):
+            raise ValueError("ROI coords must be grid or map, not " + str(coords))
+        if coords == "map" and georef is None:
+            raise ValueError("This DEM has no georeference, use grid coordinates")
+        if "bbox" in roi:
+            bbox = roi["bbox"]
+            if coords == "map":
+                bbox = map_bbox_to_grid(bbox, georef)
+            if tables is None:
+                area_3d, count = bbox_window_area_sums(dem, cell_size, bbox)
+            else:
+                area_3d, count = calc_sc.bbox_area_sums(tables, bbox)
+        elif "polygon" in roi:
+            vertices = np.asarray(roi["polygon"], dtype=np.float64).reshape(-1, 2)
+            if coords == "map":
+                vertices = np.stack(map_to_grid(vertices[:, 0], vertices[:, 1], georef), axis=1)
+            area_3d, count = polygon_area_sums(dem, cell_size, vertices)
+        else:
+            raise ValueError("An ROI needs a bbox or a polygon")
+        area_2d = count * float(cell_size)**2
+        results.append({
+            "name": roi.get("name"),
+            "surface_complexity": area_3d/area_2d if count else float("nan"),
+            "area_3d": area_3d,
+            "area_2d": area_2d,
+            "num_quads": count,
+        })
+    return results
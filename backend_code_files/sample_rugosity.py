@@ -1,87 +1,17 @@
 import numpy as np
-from numpy.random import default_rng
-import matplotlib.pyplot as plt
-from tqdm import tqdm
-import math
-import time
 import os
-'''
-Function to calculate what the height and width of the test site should be
-This information is passed into "Find_valid_test_sites"
-INPUTS:
-    site_length_m: Length of the test site in meters
-    angle_deg: Angle of the test site in degrees
-'''
-def calc_site_height_width(site_length_m, angle_deg):
-    angle_deg = np.abs(90 - angle_deg)
-    angle = (angle_deg) * np.pi/180 #(90 - )
-    # FIXME: Might need to switch the sign
-    if angle_deg < 45: 
-        site_height = site_length_m + abs(site_length_m * np.sin(angle))/1.3
-        site_width = site_length_m * np.cos(angle)
-        site_width /= 1.1
-
-    # elif angle_deg > 90 and angle_deg < 135:
-    #     site_height = site_length_m * np.cos(angle)
-    #     site_width = site_length_m + site_length_m * np.sin(angle) 
-    else:
-        site_height = site_length_m * np.sin(angle)
-        site_width = site_length_m + abs(site_length_m * np.cos(angle))/1.3
-        site_height /= 1.3
-    return site_height, site_width
+from backend_code_files import chain_paths
+from backend_code_files import dem_display
+from backend_code_files import result_writer
+from backend_code_files import sampling_engine
 
-
-'''
-Function to find valid test sites for the experiment
-It needs to find a valid area that when testing will not go out of bounds
-INPUTS:
-    grid: The grid to find the test sites in
-    site_hight_m: The height of the test site in meters
-    site_width_m: The width of the test site in meters
-    cell_size: The size of the grid cells in meters
-    num_sites: The number of test sites to find
-OUTPUTS:
-    valid_sites: A list of valid test sites
-'''
-def find_valid_test_sites(grid, site_hight_m, site_width_m, cell_size, num_sites):
-    seed = np.random.randint(0, 10000+1)
-    # seed = 5 # DELETE ME
-    rng = np.random.default_rng(seed)
-    valid_sites = []
-    height, width = grid.shape
-    num_cells_w = int(site_width_m/cell_size)/2
-    num_cells_h = int(site_hight_m/cell_size)/2
-    num_iter = 0
-    while len(valid_sites) < num_sites:
-        num_iter += 1
-        if num_iter % 10000 == 0:
-            num_sites -= 1
-            print("Decreasing number of sites to", num_sites)
-        x = rng.integers(1, width)
-        y = rng.integers(1, height)
-        if np.isnan(grid[y][x]):
-            continue
-        if y-num_cells_h < 0 or y+num_cells_h > height or x-num_cells_w < 0 or x+num_cells_w > width:
-            continue
-        else:
-            sub_grid = grid[int(y-num_cells_h):int(y+num_cells_h),
-                            int(x-num_cells_w):int(x+num_cells_w)]
-            if(np.isnan(sub_grid).any()):
-                continue
-            else:
-                similar_site = False
-                for site in valid_sites:
-                    site_x = site[1]
-                    site_y = site[0]
-                    if site_x < x+num_cells_w*2 and site_x > x-num_cells_w*2 and  \
-                            site_y < y+num_cells_h*2 and site_y > y-num_cells_h*2:
-                        similar_site = True
-                if similar_site == False:
-                    valid_sites.append((y, x))
-    return valid_sites
+# Most chains the interactive sampler offers to plot, they are drawn as one LineCollection
+MAX_PLOTTED_CHAINS = 10000
 
 '''
 Function to get which grid points the simulated chain will pass over
+The path shape comes from a cached template (see chain_paths.py), so this only adds
+the start point to the template offsets.
 INPUTS:
     start: The starting point of the chain
     angle_deg: The angle of the chain in degrees
@@ -91,171 +21,13 @@ OUTPUTS:
     u_points: The unique points the chain will pass over
 '''
 def get_grid_points_rotation(start, angle_deg, length_cells):
-    def removeDuplicates_list(mylist):
-        # set that keeps track of what elements have been added
-        seen = set()
-        no_dups = []
-        for lst in mylist:
-            # convert to hashable type
-            current = tuple(lst)
-            # If element not in seen, add it to both
-            if current not in seen:
-                no_dups.append(lst)
-                seen.add(current)
-        # print(no_dups)
-        return no_dups
-
-    x = start[0]
-    y = start[1]
-    points = []
-    points.append([x, y])
-    u_points = []
-    u_points_r = []
-
-    angle = angle_deg * np.pi/180
-    reverse_angle = angle + np.pi
-    step_size = 0.33
-    # First, go backwards
-    while np.sqrt((x-start[0])**2+(y-start[1])**2) < length_cells/3:
-        x += math.cos(reverse_angle)*step_size
-        y += math.sin(reverse_angle)*step_size
-        # Might need to re-implement this
-        # if x >= grid_size-1 or y >= grid_size-1 or x < 0 or y < 0:
-        #     break
-        points.append([x, y])
-        x_plot = int(round(x, 0))
-        y_plot = int(round(y, 0))
-        u_points_r.append([x_plot, y_plot])
-
-    x = start[0]
-    y = start[1]
-    # Then, go forwards
-    while np.sqrt((x-start[0])**2+(y-start[1])**2) < length_cells/2:
-        x += math.cos(angle)*step_size
-        y += math.sin(angle)*step_size
-        # if x >= grid_size-1 or y >= grid_size-1:
-        # break
-        points.append([x, y])
-        # u_points.add((x,y))
-        x_plot = int(round(x, 0))
-        y_plot = int(round(y, 0))
-        u_points.append([x_plot, y_plot])
-        # grid[x_plot, y_plot] = 1
-
-    points = np.array(points)
-    # u_point_list = removeDuplicates_list(u_points)
-    u_points = removeDuplicates_list(u_points)
-    u_points_r = removeDuplicates_list(u_points_r)
-    u_points_r = np.flip(u_points_r, axis=0)
-    u_points = np.array(u_points)
-    u_points = np.concatenate((u_points_r, u_points), axis=0)
-    # u_points = np.concatenate((u_points_r, u_points), axis=0)
-
+    point_offsets, cell_offsets = chain_paths.get_path_template(angle_deg, length_cells)
+    start = np.array([start[0], start[1]])
+    points = point_offsets + start
+    u_points = cell_offsets + start.astype(np.int64)
     return points, u_points
 
 
-'''
-This function drops N chains on the grid and calculates the rugosity of each chain.
-input:
-    grid: 2D numpy array of elevations
-    start_point: (y,x) tuple of the starting point of the chain
-    length_cells: number of cells in the chain
-    num_chains: number of chains to drop (defaulted to 1)
-    start_angle: angle of the first chain
-    max_angle: max angle between chains (unused)
-    cell_size: size of each cell in meters
-    chain_length_m: length of each chain in meters
-    plotting: boolean to plot the chains
-output:
-    rugosities: list of rugosities of each chain
-'''
-def drop_chains_rotation(grid, start_point, length_cells, num_chains, start_angle, cell_size, chain_length_m, plotting):
-    angle = start_angle
-    rugosities = []
-    for i in range(num_chains):
-        _, u_points = get_grid_points_rotation(
-            start_point, angle, length_cells)
-        chain_start = u_points[0]
-        chain_dist_calculated = 0
-        total_real_world_distance = 0
-        j = 0
-        # Iterate until chain is correct length
-        try:
-            while chain_dist_calculated < chain_length_m:
-                # Diff between neighboring cells
-                elevation_change = grid[u_points[j, 0], u_points[j, 1]] \
-                    - grid[u_points[j+1, 0], u_points[j+1, 1]]
-                if np.isnan(elevation_change):
-                    print("Nan elevation change at points:", u_points[j+1])
-                    break
-
-                # 2D distance between neighboring cells
-                physical_dist = np.sqrt(
-                    (u_points[j, 0]-u_points[j+1, 0])**2 + (u_points[j, 1]-u_points[j+1, 1])**2)
-                physical_dist *= cell_size  # Convert to meters
-                total_real_world_distance += physical_dist
-                # Chain length traveled between 2 points
-                chain_dist_calculated += np.sqrt(elevation_change **
-                                                2 + physical_dist**2)
-                j += 1
-        except IndexError:
-            pass
-            # print("IndexError at:", u_points[j], "chain dist_calc:", chain_dist_calculated)
-            
-        # Calc real world distance between points
-        real_world_dist = np.sqrt(
-            (chain_start[0]-u_points[j, 0])**2 + (chain_start[1]-u_points[j, 1])**2)*cell_size
-        # Add rugosity of line
-        try:
-            rugosities.append(chain_dist_calculated/total_real_world_distance) #real_world_dist)
-        except ZeroDivisionError:
-            continue
-
-        if plotting:
-            # This case is used for adjusting the case where a line is graphed too long
-            # This occurs because of the new way I calculate the real world distance which accounts
-            # for the manhattan distance instead of the euclidean distance
-            if abs(real_world_dist - total_real_world_distance)/total_real_world_distance < 0.05:
-                curr_avg = sum(rugosities)/len(rugosities)
-                y, x = [chain_start[0], u_points[int(j/curr_avg), 0]], [
-                    chain_start[1], u_points[int(j/curr_avg), 1]]
-            else:
-                y, x = [chain_start[0], u_points[j, 0]], [
-                    chain_start[1], u_points[j, 1]]
-            plt.plot(x, y, color='b')
-            # plt.show(block=False) # Remove this line to plot all chains at once
-            # plt.pause(0.01)
-            # plt.show(block=False)
-        # plot_grid(grid, points, u_points, grid_size)
-    return rugosities
-
-'''
-This function takes in the User input from "sample_rugosity" and interfaces with 
-the other functions to get the desired measurements
-'''
-def get_rugosity(grid, cell_size, site_length_m, orientation, plotting):
-    length_cells = int(site_length_m/cell_size)
-
-    site_height_m, site_width_m = calc_site_height_width(site_length_m, orientation)
-
-    # print("Finding Valid Test Sites... (If program hangs, choose less sites or shorter lengths)")
-    test_sites = find_valid_test_sites(grid, site_height_m, site_width_m, cell_size, 1)
-    # print("Found", len(test_sites), "valid test sites")
-    site_height_c = int(site_height_m/cell_size)
-    site_width_c = int(site_width_m/cell_size)
-
-    rugosities = drop_chains_rotation(
-        grid, test_sites[0], length_cells, 1, orientation, cell_size, site_length_m, plotting)
-    # print(np.mean(rugosities))
-    # print(np.var(rugosities))
-    # plt.plot(rugosities, color='b')
-
-    # plt.show()
-    # plt.pause(0.1)
-    # plt.close()
-
-    return rugosities[0]
-
 '''
 Function called from user side to get the Rugosity. It prompts the user for several setting
 inputs to get the desired result. Can save results to a file.
@@ -263,14 +35,26 @@ input:
     dem: Digital Elevation Model
     cell_size: size of each cell in the DEM
     filename: name of the file to be saved
+    get_pyramid: optional function returning the overview pyramid of the DEM, only called
+                 when plotting (see dem_display.build_pyramid)
 output:
     None
 '''
-def sample_rugosity(dem, cell_size, filename):
+def sample_rugosity(dem, cell_size, filename, get_pyramid=None):
     random_length = False
     random_orientation = False
-    num_samples = int(input("How many random samples would you like to measure? "))
+    adaptive = False
+    num_samples = input("How many random samples would you like to measure? \n\
+    Enter A to keep sampling until the mean is known to a chosen precision\n\
+    Samples: ")
     print("")
+    if num_samples == "A" or num_samples == "a":
+        adaptive = True
+        target_error = float(input("Within what percent of the mean should the 95% confidence interval be? ")) / 100
+        num_samples = int(input("What is the most samples to measure? "))
+        print("Sampling will stop when the mean is known within", target_error*100, "% or after", num_samples, "samples\n")
+    else:
+        num_samples = int(num_samples)
     # Getting chain length
     length = input("What length in meters would you like the virtual chains to be? Enter R for random\n \
     Length: ")
@@ -315,46 +99,74 @@ def sample_rugosity(dem, cell_size, filename):
         confirm = input("Is this correct? Y/N: ")
         if confirm == "N" or confirm == "n":
             print("\n----------------------------------------\n")
-            sample_rugosity(dem, cell_size, filename)
+            sample_rugosity(dem, cell_size, filename, get_pyramid)
+        checkpoint = result_writer.read_checkpoint(new_file_name)
+        if checkpoint is not None:
+            resume = "N"
+            if not checkpoint["complete"] and not adaptive:
+                resume = input("This file holds an unfinished run of " + str(checkpoint["rows_done"]) +
+                               " samples, continue it? (the settings must match) Y/N: ")
+            if resume != "Y" and resume != "y":
+                # Start over, the old results are overwritten
+                os.remove(result_writer.get_checkpoint_path(new_file_name))
 
     else:
         print("You have chosen not to save the results to a file")
         print("Results will be printed to the console\n")
 
     plotting = False
-    response = input("\nWould you like to plot the virtual chains? (Only works if you selected <100 samples)\n\
+    response = input("\nWould you like to plot the virtual chains? (Only works if you selected <" +
+                     str(MAX_PLOTTED_CHAINS) + " samples)\n\
     Y/N: ")
     print("")
-    if (response == "Y" or response == "y") and num_samples <= 100:
+    if (response == "Y" or response == "y") and num_samples <= MAX_PLOTTED_CHAINS:
         plotting = True
         print("You have chosen to plot the virtual chains\n")
     
     # Getting rugosity
-    rugosity_vals = []
     if plotting:
-        plt.imshow(dem)
-        plt.colorbar()
-    
-    for i in tqdm(range(num_samples)):
-        if random_length or random_orientation:
-            seed = np.random.randint(0, 10000+1)
-            rng = np.random.default_rng(seed)
-        if random_length:
-            length = rng.integers(min_length, max_length)
-        if random_orientation:
-            orientation = rng.integers(0, 180)
-        rugosity = get_rugosity(dem, cell_size, length, orientation, plotting)
-        rugosity_vals.append(rugosity)
-    
-    rugosity_vals = np.array(rugosity_vals)
-    site_mean = np.mean(rugosity_vals)
-    print("\nAt site", filename, "the rugosity mean of", num_samples, "is", site_mean)
-    if gen_file:
-        np.savetxt(new_file_name, rugosity_vals, delimiter=",")
+        dem_display.show_dem(dem, get_pyramid() if get_pyramid is not None else None)
+
+    # Draw every sample from one master seed, spread over all the cores
+    sample_length = (min_length, max_length) if random_length else length
+    sample_orientation = None if random_orientation else orientation
+    if adaptive:
+        samples, seed, summary = sampling_engine.run_adaptive_sampling(
+            dem, cell_size, sample_length, sample_orientation, target_error=target_error,
+            max_samples=num_samples, num_workers=None)
+        num_samples = len(samples)
+        if not summary["converged"]:
+            print("\nThe target precision was not reached within", num_samples, "samples")
     else:
+        # Results are streamed to the CSV as they arrive, so an interrupted run can be continued
+        samples, seed = sampling_engine.run_sampling(
+            dem, cell_size, num_samples, sample_length, sample_orientation, num_workers=None,
+            output=new_file_name if gen_file else None)
+        summary = sampling_engine.summarize(samples)
+    print("Sampling seed:", seed)
+    rugosity_vals = samples["rugosity"]
+    status = samples["status"]
+
+    if plotting:
+        dem_display.plot_chains(samples, cell_size)
+
+    num_cut = np.count_nonzero(status != chain_paths.CHAIN_OK)
+    if num_cut > 0:
+        print("\n", num_cut, "chains did not reach their full length:",
+              {chain_paths.CHAIN_STATUS_NAMES[code]: int(count) for code, count in
+               zip(*np.unique(status[status != chain_paths.CHAIN_OK], return_counts=True))})
+    site_mean = summary["mean"]
+    print("\nAt site", filename, "the rugosity mean of", num_samples, "is", site_mean)
+    print("95% confidence interval: +/-", summary["ci_half_width"],
+          "(" + str(round(summary["relative_error"]*100, 3)) + "% of the mean), variance", summary["variance"])
+    if gen_file and adaptive:
+        result_writer.write_results(new_file_name, samples, {"seed": seed, "target_error": target_error},
+                                    sampling_engine.SAMPLE_DTYPE)
+    if not gen_file:
         print("\nValues:\n", rugosity_vals)
 
     if plotting:
+        import matplotlib.pyplot as plt
         print("\nYou'll need to close the plot to continue")
         plt.show()
     
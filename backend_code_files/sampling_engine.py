@@ -0,0 +1,345 @@
+import math
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+from multiprocessing import shared_memory
+import numpy as np
+from backend_code_files import chain_paths
+from backend_code_files import console
+from backend_code_files import instrumentation
+from backend_code_files import result_writer
+from backend_code_files import site_index
+
+# Samples are drawn in fixed size blocks, each with its own child random stream.
+# The blocks do not depend on the number of workers, so neither do the results.
+SAMPLES_PER_BLOCK = 256
+
+# Adaptive sampling defaults: stop when the confidence interval of the mean is within
+# DEFAULT_TARGET_ERROR of the mean, but never before DEFAULT_MIN_SAMPLES valid samples
+DEFAULT_TARGET_ERROR = 0.01
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_MIN_SAMPLES = 30
+DEFAULT_MAX_SAMPLES = 10000
+
+# One row per rugosity sample
+SAMPLE_DTYPE = np.dtype([
+    ("block", np.int64),
+    ("y", np.int64),
+    ("x", np.int64),
+    ("angle", np.float64),
+    ("length", np.float64),
+    ("rugosity", np.float64),
+    ("status", np.int8),
+    ("steps", np.int64),
+])
+
+# DEM of a worker process and its NaN summed-area table, set up by "_init_worker"
+_worker_dem = None
+_worker_shm = None
+_worker_nan_sat = None
+_worker_nan_sat_shm = None
+
+'''
+Describes how worker processes can open the DEM (or another array of it, such as its NaN
+summed-area table) without copying it. A memory mapped array is reopened from its file,
+any other array is copied once into shared memory.
+INPUTS:
+    dem: 2D numpy array or memmap
+OUTPUTS:
+    dem_info: tuple passed to "open_shared_dem"
+    shm: the SharedMemory block to close and unlink when done, or None
+'''
+def share_dem(dem):
+    # Only a read only memmap of a whole file can be reopened from its filename (not a slice
+    # of one, nor a copy-on-write map that was changed in memory)
+    if isinstance(dem, np.memmap) and dem.filename is not None and dem.mode == 'r' and dem.flags.c_contiguous \
+            and os.path.getsize(dem.filename) == dem.offset + dem.nbytes:
+        return ("memmap", dem.filename, dem.offset, dem.shape, dem.dtype.str), None
+    shm = shared_memory.SharedMemory(create=True, size=max(1, dem.nbytes))
+    shared = np.ndarray(dem.shape, dtype=dem.dtype, buffer=shm.buf)
+    shared[:] = dem
+    return ("shm", shm.name, 0, dem.shape, dem.dtype.str), shm
+
+'''
+Opens a DEM shared by "share_dem"
+OUTPUTS:
+    dem: the DEM as a read only array
+    shm: the SharedMemory block backing it (keep a reference while the DEM is used), or None
+'''
+def open_shared_dem(dem_info):
+    kind, name, offset, shape, dtype = dem_info
+    if kind == "memmap":
+        return np.memmap(name, dtype=dtype, mode='r', offset=offset, shape=shape), None
+    shm = shared_memory.SharedMemory(name=name)
+    dem = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    dem.flags.writeable = False
+    return dem, shm
+
+def _init_worker(dem_info, nan_sat_info, instrument, quiet):
+    global _worker_dem, _worker_shm, _worker_nan_sat, _worker_nan_sat_shm
+    _worker_dem, _worker_shm = open_shared_dem(dem_info)
+    # The parent built (or loaded from the derived data cache) the NaN summed-area table
+    # once, so no worker builds its own
+    _worker_nan_sat, _worker_nan_sat_shm = open_shared_dem(nan_sat_info)
+    site_index.register_nan_sat(_worker_dem, _worker_nan_sat)
+    instrumentation.enable(instrument)
+    console.set_quiet(quiet)
+
+def _run_worker_block(args):
+    # Each block sends back what it recorded, so the parent can add it to its report
+    instrumentation.reset()
+    samples = sample_block(_worker_dem, *args)
+    return samples, instrumentation.snapshot() if instrumentation.is_enabled() else None
+
+'''
+Draws one block of rugosity samples from its own random stream.
+INPUTS:
+    dem: 2D numpy array of elevations
+    cell_size: size of each cell in meters
+    block: index of the block
+    seed: SeedSequence of the block
+    num_samples: number of samples in the block
+    length: chain length in meters, or a (min, max) range to draw whole meters from
+    orientation: chain angle in degrees, or None to draw from 0 to 179
+OUTPUTS:
+    samples: SAMPLE_DTYPE array of the block
+'''
+def sample_block(dem, cell_size, block, seed, num_samples, length, orientation):
+    rng = np.random.default_rng(seed)
+    samples = np.zeros(num_samples, dtype=SAMPLE_DTYPE)
+    samples["block"] = block
+    for i in range(num_samples):
+        if isinstance(length, (tuple, list)):
+            sample_length = rng.integers(length[0], length[1])
+        else:
+            sample_length = length
+        sample_orientation = rng.integers(0, 180) if orientation is None else orientation
+        site_height_m, site_width_m = site_index.calc_site_height_width(sample_length, sample_orientation)
+        test_sites = site_index.find_valid_test_sites(
+            dem, site_height_m, site_width_m, cell_size, 1, seed=rng)
+        if len(test_sites) == 0:
+            raise ValueError("No valid test sites for a " + str(sample_length) + " m chain, try a shorter length")
+        samples["y"][i], samples["x"][i] = test_sites[0]
+        samples["angle"][i] = sample_orientation
+        samples["length"][i] = sample_length
+
+    rugosities, status, num_steps = chain_paths.drop_chains_batch(
+        dem, np.stack((samples["y"], samples["x"]), axis=1), samples["angle"], samples["length"], cell_size)
+    samples["rugosity"] = rugosities
+    samples["status"] = status
+    samples["steps"] = num_steps
+    return samples
+
+'''
+Streaming mean and variance of the rugosity samples (Welford's algorithm). NaN samples,
+from chains that were cut short, are counted but left out of the statistics.
+'''
+class RunningStats:
+    def __init__(self, confidence=DEFAULT_CONFIDENCE):
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        self.confidence = confidence
+        self.count = 0
+        self.num_nan = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, value):
+        if math.isnan(value):
+            self.num_nan += 1
+            return
+        self.count += 1
+        value = float(value)
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else math.nan
+
+    # Half width of the confidence interval of the mean
+    @property
+    def ci_half_width(self):
+        return self.z * math.sqrt(self.variance / self.count) if self.count > 1 else math.nan
+
+    @property
+    def relative_error(self):
+        return self.ci_half_width / abs(self.mean) if self.count > 1 and self.mean != 0 else math.nan
+
+    def summary(self):
+        return {
+            "mean": self.mean if self.count else math.nan,
+            "variance": self.variance,
+            "ci_half_width": self.ci_half_width,
+            "relative_error": self.relative_error,
+            "confidence": self.confidence,
+            "num_valid": self.count,
+            "num_nan": self.num_nan,
+        }
+
+'''
+Statistics of a finished set of samples, the same ones "run_adaptive_sampling" reports
+'''
+def summarize(samples, confidence=DEFAULT_CONFIDENCE):
+    stats = RunningStats(confidence)
+    for value in samples["rugosity"]:
+        stats.update(value)
+    return stats.summary()
+
+'''
+Splits the samples into blocks, each with its own child stream of the master seed
+'''
+def make_blocks(seed_seq, cell_size, num_samples, length, orientation):
+    block_sizes = [min(SAMPLES_PER_BLOCK, num_samples - start) for start in range(0, num_samples, SAMPLES_PER_BLOCK)]
+    return [(cell_size, i, child, size, length, orientation)
+            for i, (child, size) in enumerate(zip(seed_seq.spawn(len(block_sizes)), block_sizes))]
+
+'''
+Draws the blocks on a process pool (or in this process) and yields them in block order.
+Only a few blocks per worker are queued ahead, so a caller that stops early does not
+wait for the rest of the blocks.
+'''
+def iter_sample_blocks(dem, blocks, num_workers=1):
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if num_workers <= 1 or len(blocks) <= 1:
+        for block in blocks:
+            yield sample_block(dem, *block)
+        return
+
+    dem_info, shm = share_dem(dem)
+    nan_sat_info, nan_sat_shm = share_dem(site_index.get_nan_sat(dem))
+    executor = ProcessPoolExecutor(max_workers=min(num_workers, len(blocks)), initializer=_init_worker,
+                                   initargs=(dem_info, nan_sat_info, instrumentation.is_enabled(),
+                                             console.is_quiet()))
+    try:
+        pending = deque()
+        next_block = 0
+        while next_block < len(blocks) or pending:
+            while next_block < len(blocks) and len(pending) < 2*num_workers:
+                pending.append(executor.submit(_run_worker_block, blocks[next_block]))
+                next_block += 1
+            samples, worker_stats = pending.popleft().result()
+            instrumentation.merge(worker_stats)
+            yield samples
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for shared in (shm, nan_sat_shm):
+            if shared is not None:
+                shared.close()
+                shared.unlink()
+
+'''
+Monte Carlo rugosity sampling from a single master seed.
+The samples are split into blocks of SAMPLES_PER_BLOCK, every block gets an independent
+child stream from SeedSequence(seed).spawn, and the blocks are spread over a process
+pool that shares the DEM and its NaN summed-area table through their memory maps or
+shared memory. With a fixed seed the samples are identical for any number of workers.
+INPUTS:
+    dem: 2D numpy array or memmap of elevations
+    cell_size: size of each cell in meters
+    num_samples: number of samples to draw
+    length: chain length in meters, or a (min, max) range to draw whole meters from
+    orientation: chain angle in degrees, or None to draw from 0 to 179
+    seed: master seed, None picks a random one (or the one of the run being resumed)
+    num_workers: number of worker processes, None uses every core
+    output: optional path to stream every sample to as it is drawn, a .csv file or a folder
+            for the columnar format (see result_writer.py). If the output has a checkpoint of
+            the same run, the run resumes after the last checkpointed block.
+    output_format: "csv" or "columns", None picks from the output path
+OUTPUTS:
+    samples: SAMPLE_DTYPE array with one row per sample
+    seed: the master seed that was used
+'''
+def run_sampling(dem, cell_size, num_samples, length, orientation=None, seed=None, num_workers=1,
+                 output=None, output_format=None):
+    writer = None
+    done = []
+    if output is not None:
+        checkpoint = result_writer.read_checkpoint(output)
+        # Resuming without a seed continues the run that was interrupted
+        if seed is None and checkpoint is not None:
+            seed = checkpoint["run_info"]["seed"]
+    seed_seq = np.random.SeedSequence(seed)
+    blocks = make_blocks(seed_seq, cell_size, num_samples, length, orientation)
+    if output is not None:
+        run_info = {"seed": seed_seq.entropy, "num_samples": num_samples, "cell_size": float(cell_size),
+                    "length": list(length) if isinstance(length, (tuple, list)) else length,
+                    "orientation": orientation, "dem_shape": list(dem.shape),
+                    "samples_per_block": SAMPLES_PER_BLOCK}
+        writer = result_writer.ResultWriter(output, run_info, SAMPLE_DTYPE, output_format)
+        if writer.blocks_done:
+            done = [result_writer.read_results(output, SAMPLE_DTYPE)[0]]
+            console.report("Resuming", output, "after", writer.rows_done, "of", num_samples, "samples")
+
+    results = list(done)
+    with console.progress(total=num_samples, initial=sum(len(samples) for samples in done), unit="sample") as progress:
+        try:
+            first_block = writer.blocks_done if writer is not None else 0
+            for block, samples in enumerate(iter_sample_blocks(dem, blocks[first_block:], num_workers), first_block):
+                if writer is not None:
+                    writer.write_block(block, samples)
+                results.append(samples)
+                progress.update(len(samples))
+        finally:
+            if writer is not None:
+                writer.close(complete=writer.blocks_done == len(blocks))
+
+    samples = np.concatenate(results) if results else np.zeros(0, dtype=SAMPLE_DTYPE)
+    return samples, seed_seq.entropy
+
+'''
+Adaptive rugosity sampling: keeps drawing samples until the confidence interval of the
+mean rugosity is within target_error of the mean, or max_samples were drawn.
+The samples are the same blocks "run_sampling" draws with the same seed, and the stopping
+rule is checked sample by sample in block order, so the result is a prefix of the fixed
+run and does not depend on the number of workers.
+INPUTS:
+    dem: 2D numpy array or memmap of elevations
+    cell_size: size of each cell in meters
+    length: chain length in meters, or a (min, max) range to draw whole meters from
+    orientation: chain angle in degrees, or None to draw from 0 to 179
+    seed: master seed, None picks a random one
+    target_error: relative half width of the confidence interval to stop at, e.g. 0.01 for 1%
+    confidence: confidence level of the interval
+    max_samples: most samples to draw
+    min_samples: fewest valid samples before stopping is allowed
+    num_workers: number of worker processes, None uses every core
+OUTPUTS:
+    samples: SAMPLE_DTYPE array with the samples that were used
+    seed: the master seed that was used
+    summary: dict with the mean, variance, ci_half_width, relative_error, num_valid,
+        num_nan and converged (False if max_samples was reached first)
+'''
+def run_adaptive_sampling(dem, cell_size, length, orientation=None, seed=None,
+                          target_error=DEFAULT_TARGET_ERROR, confidence=DEFAULT_CONFIDENCE,
+                          max_samples=DEFAULT_MAX_SAMPLES, min_samples=DEFAULT_MIN_SAMPLES, num_workers=1):
+    seed_seq = np.random.SeedSequence(seed)
+    blocks = make_blocks(seed_seq, cell_size, max_samples, length, orientation)
+    stats = RunningStats(confidence)
+    converged = False
+
+    results = []
+    with console.progress(total=max_samples, unit="sample") as progress:
+        sample_blocks = iter_sample_blocks(dem, blocks, num_workers)
+        try:
+            for samples in sample_blocks:
+                used = len(samples)
+                for i, value in enumerate(samples["rugosity"]):
+                    stats.update(value)
+                    if stats.count >= max(min_samples, 2) and stats.relative_error <= target_error:
+                        converged = True
+                        used = i + 1
+                        break
+                results.append(samples[:used])
+                progress.update(used)
+                if converged:
+                    break
+        finally:
+            sample_blocks.close()
+
+    samples = np.concatenate(results) if results else np.zeros(0, dtype=SAMPLE_DTYPE)
+    summary = stats.summary()
+    summary["converged"] = converged
+    return samples, seed_seq.entropy, summary
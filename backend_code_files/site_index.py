@@ -0,0 +1,309 @@
+import math
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+from backend_code_files import console
+from backend_code_files import instrumentation
+
+# Number of (DEM, window size) site indexes kept by "get_valid_centers"
+SITE_INDEX_CACHE_SIZE = 16
+# Random cells tried by "draw_valid_center" before it falls back to a full site index
+MAX_DRAW_ATTEMPTS = 256
+_site_index_cache = OrderedDict()
+# Precomputed NaN summed-area tables, see "register_nan_sat"
+_nan_sat_registry = {}
+# Guards both caches, so threads (e.g. of the query server) can search sites at the same
+# time. Indexes are built outside of it, two threads may build the same one at worst.
+_cache_lock = threading.Lock()
+
+'''
+Integer dtype of the summed-area table of a mask with num_cells cells
+'''
+def get_sat_dtype(num_cells):
+    return np.int32 if num_cells < 2**31 else np.int64
+
+'''
+Builds a summed-area table of a boolean mask, padded with a leading row and column
+of zeros so the count inside rows [r0, r1) and cols [c0, c1) is
+    sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+INPUTS:
+    mask: 2D boolean array
+OUTPUTS:
+    sat: (rows+1, cols+1) integer array
+'''
+def summed_area_table(mask):
+    dtype = get_sat_dtype(mask.size)
+    sat = np.zeros((mask.shape[0]+1, mask.shape[1]+1), dtype=dtype)
+    np.cumsum(mask, axis=0, dtype=dtype, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return sat
+
+'''
+Cells a window reaches around its center: int() rounds towards zero, so the window
+around (y, x) is rows [y-up, y+down) and cols [x-left, x+right)
+'''
+def get_window_extent(num_cells_h, num_cells_w):
+    return math.ceil(num_cells_h), math.floor(num_cells_h), math.ceil(num_cells_w), math.floor(num_cells_w)
+
+'''
+Range of the centers whose window fits inside the DEM, as inclusive bounds y0, y1, x0, x1.
+Centers are drawn from [1, height) and [1, width), the same range the random search used.
+'''
+def get_center_bounds(shape, num_cells_h, num_cells_w):
+    height, width = shape
+    up, _, left, _ = get_window_extent(num_cells_h, num_cells_w)
+    return max(1, up), min(height-1, height-up), max(1, left), min(width-1, width-left)
+
+'''
+Finds every cell that "find_valid_test_sites" would accept as a site center: the center
+is not NaN, the window fits inside the DEM and the window holds no NaN cells.
+The window around (y, x) is grid[int(y-num_cells_h):int(y+num_cells_h),
+int(x-num_cells_w):int(x+num_cells_w)], the same slice the random search uses.
+Every window is checked in O(1) with a summed-area table of the NaN mask.
+INPUTS:
+    grid: 2D numpy array of elevations
+    num_cells_h: half height of the site in cells
+    num_cells_w: half width of the site in cells
+    nan_sat: optional precomputed summed_area_table(np.isnan(grid))
+OUTPUTS:
+    valid_centers: flat indices (y*width + x) of the valid site centers
+'''
+def build_site_index(grid, num_cells_h, num_cells_w, nan_sat=None):
+    height, width = grid.shape
+    sat = summed_area_table(np.isnan(grid)) if nan_sat is None else nan_sat
+    up, down, left, right = get_window_extent(num_cells_h, num_cells_w)
+    y0, y1, x0, x1 = get_center_bounds(grid.shape, num_cells_h, num_cells_w)
+    instrumentation.count("sites.index_builds")
+    if y1 < y0 or x1 < x0:
+        instrumentation.count("sites.index_out_of_bounds_cells", grid.size)
+        return np.empty(0, dtype=np.int64)
+
+    ys = slice(y0, y1+1)
+    xs = slice(x0, x1+1)
+    nan_count = sat[y0+down:y1+down+1, x0+right:x1+right+1] \
+        - sat[y0-up:y1-up+1, x0+right:x1+right+1] \
+        - sat[y0+down:y1+down+1, x0-left:x1-left+1] \
+        + sat[y0-up:y1-up+1, x0-left:x1-left+1]
+    valid = (nan_count == 0) & ~np.isnan(grid[ys, xs])
+
+    rows, cols = np.nonzero(valid)
+    # Cells of each index built, not draws: a draw from an index is always valid
+    if instrumentation.is_enabled():
+        instrumentation.count("sites.index_out_of_bounds_cells", grid.size - valid.size)
+        instrumentation.count("sites.index_invalid_cells", valid.size - len(rows))
+        instrumentation.count("sites.index_valid_cells", len(rows))
+    return (rows + y0).astype(np.int64) * width + (cols + x0)
+
+'''
+Registers a precomputed NaN summed-area table for a DEM (for example one loaded from the
+derived data cache), so new site indexes of that DEM skip building it
+'''
+def register_nan_sat(grid, nan_sat):
+    with _cache_lock:
+        _nan_sat_registry[id(grid)] = (weakref.ref(grid), nan_sat)
+
+'''
+Returns the NaN summed-area table registered for a DEM, or None
+'''
+def get_registered_nan_sat(grid):
+    with _cache_lock:
+        entry = _nan_sat_registry.get(id(grid))
+    if entry is None or entry[0]() is not grid:
+        return None
+    return entry[1]
+
+'''
+Returns the NaN summed-area table of a DEM. It is the same for every site size, so it is
+built on the first call and registered for the later ones.
+'''
+def get_nan_sat(grid):
+    nan_sat = get_registered_nan_sat(grid)
+    if nan_sat is None:
+        nan_sat = summed_area_table(np.isnan(grid))
+        register_nan_sat(grid, nan_sat)
+    return nan_sat
+
+'''
+Returns the valid site centers for a DEM and site size, building the index on the first
+call and reusing it for every later call with the same DEM and window size.
+INPUTS:
+    grid: 2D numpy array of elevations
+    site_hight_m: The height of the test site in meters
+    site_width_m: The width of the test site in meters
+    cell_size: The size of the grid cells in meters
+OUTPUTS:
+    valid_centers: flat indices (y*width + x) of the valid site centers
+'''
+def get_valid_centers(grid, site_hight_m, site_width_m, cell_size):
+    num_cells_w = int(site_width_m/cell_size)/2
+    num_cells_h = int(site_hight_m/cell_size)/2
+    key = (id(grid), grid.shape, num_cells_h, num_cells_w)
+    with _cache_lock:
+        entry = _site_index_cache.get(key)
+        if entry is not None and entry[0]() is grid:
+            _site_index_cache.move_to_end(key)
+            return entry[1]
+
+    valid_centers = build_site_index(grid, num_cells_h, num_cells_w, get_nan_sat(grid))
+    with _cache_lock:
+        _site_index_cache[key] = (weakref.ref(grid), valid_centers)
+        while len(_site_index_cache) > SITE_INDEX_CACHE_SIZE:
+            _site_index_cache.popitem(last=False)
+    return valid_centers
+
+'''
+Draws one random valid site center without building a site index. Up to MAX_DRAW_ATTEMPTS
+cells are drawn uniformly from the centers whose window fits the DEM and each window is
+checked in O(1) against the NaN summed-area table, so the first valid one is a uniform
+draw from the valid centers, the same as picking from "get_valid_centers". Chains of a
+random orientation need a different window for almost every sample, which would rebuild
+a whole index per sample.
+INPUTS:
+    grid: 2D numpy array of elevations
+    site_hight_m: The height of the test site in meters
+    site_width_m: The width of the test site in meters
+    cell_size: The size of the grid cells in meters
+    rng: numpy random Generator
+OUTPUTS:
+    center: flat index (y*width + x) of the center, or None if no attempt was valid (the
+            caller then falls back to "get_valid_centers")
+'''
+def draw_valid_center(grid, site_hight_m, site_width_m, cell_size, rng):
+    num_cells_w = int(site_width_m/cell_size)/2
+    num_cells_h = int(site_hight_m/cell_size)/2
+    up, down, left, right = get_window_extent(num_cells_h, num_cells_w)
+    y0, y1, x0, x1 = get_center_bounds(grid.shape, num_cells_h, num_cells_w)
+    instrumentation.count("sites.draws")
+    if y1 < y0 or x1 < x0:
+        instrumentation.count("sites.draws_no_room")
+        return None
+    sat = get_nan_sat(grid)
+    ys = rng.integers(y0, y1+1, MAX_DRAW_ATTEMPTS)
+    xs = rng.integers(x0, x1+1, MAX_DRAW_ATTEMPTS)
+    nan_count = sat[ys+down, xs+right] - sat[ys-up, xs+right] - sat[ys+down, xs-left] + sat[ys-up, xs-left]
+    valid = (nan_count == 0) & ~np.isnan(grid[ys, xs])
+    if not valid.any():
+        instrumentation.count("sites.draws_rejected", MAX_DRAW_ATTEMPTS)
+        instrumentation.count("sites.draws_fallback")
+        return None
+    first = int(np.argmax(valid))
+    instrumentation.count("sites.draws_rejected", first)
+    return int(ys[first]) * grid.shape[1] + int(xs[first])
+
+'''
+Places non-overlapping sites from a list of candidate centers, in order. A candidate is
+rejected if an accepted site lies less than a full site height and width away, the same
+rule the original linear search used. Accepted sites are kept in a uniform grid spatial
+hash with buckets one site apart, so each candidate only checks the 3x3 buckets around
+it and placing many sites takes near linear time.
+INPUTS:
+    candidates: flat indices (y*width + x) of candidate centers, in the order to try them
+    width: width of the DEM in cells
+    num_cells_h: half height of the site in cells
+    num_cells_w: half width of the site in cells
+    num_sites: number of sites to place
+OUTPUTS:
+    valid_sites: list of (y, x) site centers
+'''
+def place_non_overlapping_sites(candidates, width, num_cells_h, num_cells_w, num_sites):
+    min_dy, min_dx = num_cells_h*2, num_cells_w*2
+    bucket_h, bucket_w = max(min_dy, 1), max(min_dx, 1)
+    buckets = {}
+    valid_sites = []
+    for center in candidates:
+        if len(valid_sites) >= num_sites:
+            break
+        y, x = divmod(int(center), width)
+        by, bx = int(y // bucket_h), int(x // bucket_w)
+        similar_site = False
+        for ny in (by-1, by, by+1):
+            for nx in (bx-1, bx, bx+1):
+                for site_y, site_x in buckets.get((ny, nx), ()):
+                    if abs(site_x - x) < min_dx and abs(site_y - y) < min_dy:
+                        similar_site = True
+                        break
+                if similar_site:
+                    break
+            if similar_site:
+                break
+        if not similar_site:
+            valid_sites.append((y, x))
+            buckets.setdefault((by, bx), []).append((y, x))
+        else:
+            instrumentation.count("sites.rejected_overlap")
+    return valid_sites
+
+'''
+Function to calculate what the height and width of the test site should be
+This information is passed into "find_valid_test_sites"
+INPUTS:
+    site_length_m: Length of the test site in meters
+    angle_deg: Angle of the test site in degrees
+'''
+def calc_site_height_width(site_length_m, angle_deg):
+    angle_deg = np.abs(90 - angle_deg)
+    angle = (angle_deg) * np.pi/180 #(90 - )
+    # FIXME: Might need to switch the sign
+    if angle_deg < 45: 
+        site_height = site_length_m + abs(site_length_m * np.sin(angle))/1.3
+        site_width = site_length_m * np.cos(angle)
+        site_width /= 1.1
+
+    # elif angle_deg > 90 and angle_deg < 135:
+    #     site_height = site_length_m * np.cos(angle)
+    #     site_width = site_length_m + site_length_m * np.sin(angle) 
+    else:
+        site_height = site_length_m * np.sin(angle)
+        site_width = site_length_m + abs(site_length_m * np.cos(angle))/1.3
+        site_height /= 1.3
+    return site_height, site_width
+
+
+'''
+Function to find valid test sites for the experiment
+It needs to find a valid area that when testing will not go out of bounds
+A single site is drawn at random and checked in O(1) (see "draw_valid_center").
+Several sites, or a single one on a DEM where random draws keep failing, come from a
+precomputed index of the valid centers, so the search always ends. Overlapping sites are rejected with a spatial
+hash, so thousands of sites can be placed quickly. If there are fewer valid sites than
+requested, the sites that could be placed are returned and a message is printed.
+INPUTS:
+    grid: The grid to find the test sites in
+    site_hight_m: The height of the test site in meters
+    site_width_m: The width of the test site in meters
+    cell_size: The size of the grid cells in meters
+    num_sites: The number of test sites to find
+    seed: seed for the random site order, None picks a random one
+OUTPUTS:
+    valid_sites: A list of valid test sites
+'''
+@instrumentation.timed("site_search")
+def find_valid_test_sites(grid, site_hight_m, site_width_m, cell_size, num_sites, seed=None):
+    if seed is None:
+        seed = np.random.randint(0, 10000+1)
+    rng = np.random.default_rng(seed)
+    height, width = grid.shape
+    num_cells_w = int(site_width_m/cell_size)/2
+    num_cells_h = int(site_hight_m/cell_size)/2
+    if num_sites == 1:
+        # A single site is drawn directly, so chains of random orientation (a new site size
+        # for almost every sample) do not build a site index each
+        center = draw_valid_center(grid, site_hight_m, site_width_m, cell_size, rng)
+        if center is not None:
+            return [divmod(center, width)]
+    valid_centers = get_valid_centers(grid, site_hight_m, site_width_m, cell_size)
+    if len(valid_centers) < num_sites:
+        instrumentation.count("sites.not_enough_centers")
+        console.report("Only", len(valid_centers), "valid site centers exist for this site size,", num_sites, "were requested")
+
+    if num_sites == 1 and len(valid_centers) > 0:
+        candidates = [valid_centers[rng.integers(len(valid_centers))]]
+    else:
+        candidates = valid_centers[rng.permutation(len(valid_centers))]
+    valid_sites = place_non_overlapping_sites(
+        candidates, width, num_cells_h, num_cells_w, num_sites)
+    if len(valid_sites) < num_sites <= len(valid_centers):
+        instrumentation.count("sites.not_enough_room")
+        console.report("Could only place", len(valid_sites), "of", num_sites, "non-overlapping sites")
+    return valid_sites
@@ -0,0 +1,206 @@
+import math
+import numpy as np
+
+# Rows generated at a time when writing into an output array
+GENERATE_TILE_ROWS = 1024
+# Most noise cells "add_nan_holes" picks its threshold from
+HOLE_SAMPLE_CELLS = 2**24
+
+'''
+Makes the output array of a generator: out if it was given, a new array otherwise
+'''
+def _output(shape, out):
+    if out is None:
+        return np.empty(shape, dtype=np.float64)
+    if out.shape != tuple(shape):
+        raise ValueError("Output array shape " + str(out.shape) + " does not match " + str(tuple(shape)))
+    return out
+
+'''
+Tilted plane. Its surface complexity is exactly sqrt(1 + slope_x^2 + slope_y^2), and the
+triangulated surface matches it to rounding error.
+INPUTS:
+    nrows, ncols: size of the DEM in cells
+    cell_size: the size of each cell in meters
+    slope_x, slope_y: rise per meter along the columns and rows
+    out: optional (nrows, ncols) array or memmap to write into
+OUTPUTS:
+    dem: the DEM
+    surface_complexity: the exact surface complexity
+'''
+def make_plane(nrows, ncols, cell_size, slope_x=0.3, slope_y=0.2, out=None):
+    dem = _output((nrows, ncols), out)
+    x = np.arange(ncols) * cell_size * slope_x
+    for start in range(0, nrows, GENERATE_TILE_ROWS):
+        rows = np.arange(start, min(start+GENERATE_TILE_ROWS, nrows))
+        dem[rows[0]:rows[-1]+1] = (rows * cell_size * slope_y)[:, None] + x[None, :]
+    return dem, math.sqrt(1 + slope_x**2 + slope_y**2)
+
+'''
+Sinusoidal ridges z = amplitude * sin(2 pi x / wavelength) running along the rows.
+Its surface complexity is the mean of sqrt(1 + z'(x)^2) over a period, an elliptic
+integral that is evaluated here to full precision. The triangulated surface converges
+to it as the cells get smaller than the wavelength.
+INPUTS:
+    nrows, ncols: size of the DEM in cells
+    cell_size: the size of each cell in meters
+    amplitude: height of the ridges in meters
+    wavelength: distance between ridges in meters
+    out: optional (nrows, ncols) array or memmap to write into
+OUTPUTS:
+    dem: the DEM
+    surface_complexity: the exact surface complexity of the continuous surface
+'''
+def make_sinusoid(nrows, ncols, cell_size, amplitude=0.05, wavelength=0.5, out=None):
+    dem = _output((nrows, ncols), out)
+    k = 2*math.pi/wavelength
+    row = amplitude * np.sin(k * np.arange(ncols) * cell_size)
+    for start in range(0, nrows, GENERATE_TILE_ROWS):
+        dem[start:start+GENERATE_TILE_ROWS] = row
+    # The integrand is periodic and smooth, so the midpoint rule converges exponentially
+    phase = (np.arange(4096) + 0.5) / 4096 * 2*math.pi
+    surface_complexity = float(np.mean(np.sqrt(1 + (amplitude*k*np.cos(phase))**2)))
+    return dem, surface_complexity
+
+# Largest fractal made at full resolution in memory, bigger ones are made at a coarser
+# level and refined tile by tile into the output (see "make_diamond_square")
+FRACTAL_MAX_CELLS = 2**24
+
+'''
+Diamond-square fractal on a (n+1, n+1) grid, n a power of two, made in memory
+'''
+def _diamond_square(n, roughness, height, rng):
+    size = n + 1
+    dem = np.zeros((size, size))
+    dem[::n, ::n] = rng.normal(0, height, (2, 2))
+    step = n
+    scale = height
+    while step > 1:
+        half = step // 2
+        scale *= roughness
+        # Diamond step: centers of the squares
+        dem[half::step, half::step] = (dem[:-1:step, :-1:step] + dem[:-1:step, step::step] +
+                                       dem[step::step, :-1:step] + dem[step::step, step::step]) / 4 \
+            + rng.normal(0, scale, dem[half::step, half::step].shape)
+        # Square step: edge midpoints, averaged from their (up to) four neighbours
+        padded = np.pad(dem, half, mode='constant', constant_values=np.nan)
+        for row_start, col_start in ((0, half), (half, 0)):
+            rows = slice(row_start + half, size + half, step)
+            cols = slice(col_start + half, size + half, step)
+            neighbours = np.stack((
+                padded[rows.start-half:rows.stop-half:step, cols],
+                padded[rows.start+half:rows.stop+half:step, cols],
+                padded[rows, cols.start-half:cols.stop-half:step],
+                padded[rows, cols.start+half:cols.stop+half:step]))
+            target = dem[row_start::step, col_start::step]
+            target[:] = np.nanmean(neighbours, axis=0) + rng.normal(0, scale, target.shape)
+        step = half
+    return dem
+
+'''
+Fractal surface made with the diamond-square algorithm. The surface area is not known
+in closed form; it is meant for realistic reef-like timing runs.
+The algorithm needs the whole (2^n+1)^2 square in memory, so fractals bigger than
+FRACTAL_MAX_CELLS are made at the finest level that fits, bilinearly upsampled tile by
+tile into the output, and the finer levels are added as random noise of the same total
+variance. Memory then stays bounded whatever the size of the output.
+INPUTS:
+    nrows, ncols: size of the DEM in cells (the fractal is made at the next 2^n+1 and cropped)
+    roughness: how fast the random displacement shrinks, 0.5 to 0.7 looks natural
+    height: size of the first random displacement in meters
+    seed: seed of the random displacements
+    out: optional (nrows, ncols) array or memmap to write into
+OUTPUTS:
+    dem: the DEM
+'''
+def make_diamond_square(nrows, ncols, roughness=0.6, height=0.5, seed=0, out=None):
+    rng = np.random.default_rng(seed)
+    n = 1
+    while n + 1 < max(nrows, ncols):
+        n *= 2
+    coarse_n = n
+    while coarse_n > 1 and (coarse_n + 1)**2 > FRACTAL_MAX_CELLS:
+        coarse_n //= 2
+    fractal = _diamond_square(coarse_n, roughness, height, rng)
+    if coarse_n == n:
+        if out is None:
+            return fractal[:nrows, :ncols]
+        dem = _output((nrows, ncols), out)
+        for start in range(0, nrows, GENERATE_TILE_ROWS):
+            dem[start:start+GENERATE_TILE_ROWS] = fractal[start:min(start+GENERATE_TILE_ROWS, nrows), :ncols]
+        return dem
+
+    dem = _output((nrows, ncols), out)
+    factor = n // coarse_n
+    # Standard deviation of all the levels finer than the coarse fractal together
+    levels = int(math.log2(coarse_n))
+    fine_levels = int(math.log2(factor))
+    fine_scale = height * math.sqrt(sum(roughness**(2*level) for level in range(levels+1, levels+fine_levels+1)))
+    cols = np.arange(ncols) / factor
+    c0 = np.minimum(cols.astype(int), coarse_n - 1)
+    fc = (cols - c0)[None, :]
+    for start in range(0, nrows, GENERATE_TILE_ROWS):
+        rows = np.arange(start, min(start+GENERATE_TILE_ROWS, nrows)) / factor
+        r0 = np.minimum(rows.astype(int), coarse_n - 1)
+        fr = (rows - r0)[:, None]
+        dem[start:start+len(rows)] = fractal[np.ix_(r0, c0)]*(1-fr)*(1-fc) + fractal[np.ix_(r0+1, c0)]*fr*(1-fc) \
+            + fractal[np.ix_(r0, c0+1)]*(1-fr)*fc + fractal[np.ix_(r0+1, c0+1)]*fr*fc \
+            + rng.normal(0, fine_scale, (len(rows), ncols))
+    return dem
+
+'''
+Smoothed noise of the given rows, from bilinear upsampling of the coarse noise
+'''
+def _hole_noise(coarse, rows, ncols, hole_size):
+    rows = rows / hole_size
+    cols = np.arange(ncols) / hole_size
+    r0, c0 = rows.astype(int), cols.astype(int)
+    fr, fc = (rows - r0)[:, None], (cols - c0)[None, :]
+    return coarse[np.ix_(r0, c0)]*(1-fr)*(1-fc) + coarse[np.ix_(r0+1, c0)]*fr*(1-fc) \
+        + coarse[np.ix_(r0, c0+1)]*(1-fr)*fc + coarse[np.ix_(r0+1, c0+1)]*fr*fc
+
+'''
+Punches NaN holes in a DEM so a chosen fraction of the cells stay valid. The holes are
+blobs made by thresholding smoothed noise, like the gaps left by trimming in Metashape.
+The noise is made GENERATE_TILE_ROWS rows at a time, so memory mapped DEMs bigger than
+RAM get holes too. Their threshold comes from every n-th row (at most HOLE_SAMPLE_CELLS
+cells), so the valid fraction is only approximate for them.
+INPUTS:
+    dem: the DEM, changed in place
+    valid_fraction: fraction of cells that stay valid
+    hole_size: rough size of the holes in cells
+    seed: seed of the noise
+OUTPUTS:
+    dem: the DEM
+'''
+def add_nan_holes(dem, valid_fraction=0.8, hole_size=16, seed=0):
+    rng = np.random.default_rng(seed)
+    nrows, ncols = dem.shape
+    coarse = rng.random((nrows // hole_size + 2, ncols // hole_size + 2))
+    step = max(1, math.ceil(nrows*ncols / HOLE_SAMPLE_CELLS))
+    threshold = np.quantile(_hole_noise(coarse, np.arange(0, nrows, step), ncols, hole_size), valid_fraction)
+    for start in range(0, nrows, GENERATE_TILE_ROWS):
+        rows = np.arange(start, min(start+GENERATE_TILE_ROWS, nrows))
+        tile = dem[rows[0]:rows[-1]+1]
+        tile[_hole_noise(coarse, rows, ncols, hole_size) > threshold] = np.nan
+    return dem
+
+'''
+Writes a DEM as an ESRI ASCII grid, the format Metashape exports
+INPUTS:
+    dem: the DEM
+    filename: path of the .txt file
+    cell_size: the size of each cell in meters
+    nodata_value: value written for NaN cells
+'''
+def write_ascii_grid(dem, filename, cell_size, nodata_value=-32767):
+    with open(filename, 'w') as file:
+        file.write("ncols        " + str(dem.shape[1]) + "\n")
+        file.write("nrows        " + str(dem.shape[0]) + "\n")
+        file.write("xllcorner    0.0\n")
+        file.write("yllcorner    0.0\n")
+        file.write("cellsize     " + repr(float(cell_size)) + "\n")
+        file.write("NODATA_value " + str(nodata_value) + "\n")
+        for start in range(0, dem.shape[0], GENERATE_TILE_ROWS):
+            block = np.nan_to_num(np.asarray(dem[start:start+GENERATE_TILE_ROWS]), nan=nodata_value)
+            np.savetxt(file, block, fmt="%.6f")
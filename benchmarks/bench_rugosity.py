@@ -0,0 +1,327 @@
+'''
+Benchmark suite for the Rugosity Calculator hot paths, run on synthetic DEMs.
+
+For every DEM size it times and records the peak memory of:
+    surface_complexity: calc_site_surface_complexity.calculate_site_surface_complexity
+    site_index: site_index.find_valid_test_sites (cold, including the site index). The
+                index covers the whole DEM in RAM, so it is skipped above MEMORY_LIMIT_CELLS
+    site_random: one site per sample at a random orientation and length, the way the
+                 sampler draws them (a different site size for almost every sample). On
+                 memory mapped DEMs the NaN summed-area table comes from the derived data
+                 cache, like in rugosity_calculator.py, and is built before the timing
+    path_templates: sample_rugosity.get_grid_points_rotation (cold and warm template cache)
+    ingest: convert_dem_to_npy.dem_txt_to_npy on an ESRI ASCII grid of the DEM
+    float32: surface complexity and a fixed set of chain drops on a float32 copy of the
+             DEM (memory mapped above MEMORY_LIMIT_CELLS), with the float64 time, memory and the largest deviation from float64
+    import: cold start of the library API (backend_code_files.api) and the other entry
+            modules, each imported in a fresh interpreter, and whether matplotlib, tqdm or
+            art got imported with them (they should not be). Run once, not per size.
+The surface complexity of the synthetic surfaces is known, so the error is recorded too.
+Results are written as JSON so runs of different versions can be compared.
+
+To run, from the top folder of the repository type
+    python3 benchmarks/bench_rugosity.py --sizes 1e4 1e5 1e6 --output bench.json
+    python3 benchmarks/bench_rugosity.py --sizes 1e4 1e5 1e6 --compare bench.json
+'''
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from backend_code_files import calc_site_surface_complexity as calc_sc
+from backend_code_files import chain_paths
+from backend_code_files import convert_dem_to_npy
+from backend_code_files import derived_cache
+from backend_code_files import sample_rugosity
+from backend_code_files import site_index
+from backend_code_files import synthetic_dems
+
+CELL_SIZE = 0.001
+# Modules timed by the import benchmark, the first one is the headline number
+IMPORT_MODULES = ["backend_code_files.api", "backend_code_files.batch_mode", "backend_code_files.query_server"]
+# Modules that only plotting, progress bars and the interactive intro need
+HEAVY_MODULES = ["matplotlib", "tqdm", "art"]
+# Run in a fresh interpreter: imports one module and reports the time, the peak memory
+# (only when traced, tracing slows the import down) and the heavy modules it pulled in
+IMPORT_SCRIPT = """
+import json, sys, time, tracemalloc
+if sys.argv[2] == "memory":
+    tracemalloc.start()
+start = time.perf_counter()
+__import__(sys.argv[1])
+seconds = time.perf_counter() - start
+peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+print(json.dumps({"seconds": seconds, "peak_bytes": peak,
+                  "heavy_modules": [name for name in sys.argv[3:] if name in sys.modules]}))
+"""
+# DEMs bigger than this are generated into a memory mapped file instead of RAM, and the
+# benchmarks that need a full size copy in RAM are skipped
+MEMORY_LIMIT_CELLS = 10**8
+
+'''
+Runs a function with its prints silenced and returns its result, wall time and the
+peak memory numpy/python allocated while it ran (memory mapped pages are not counted)
+'''
+def measure(function, *args, **kwargs):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start_time
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+'''
+Makes the synthetic DEM of one size
+OUTPUTS:
+    dem: the DEM (memory mapped for very large sizes)
+    surface_complexity: the known surface complexity, None if the DEM has holes or no closed form
+'''
+def make_dem(surface, num_cells, valid_fraction, workdir):
+    nrows = ncols = max(2, int(round(math.sqrt(num_cells))))
+    out = None
+    if nrows*ncols > MEMORY_LIMIT_CELLS:
+        out = np.lib.format.open_memmap(os.path.join(workdir, "dem_" + str(nrows) + ".npy"),
+                                        mode='w+', dtype=np.float64, shape=(nrows, ncols))
+    if surface == "plane":
+        dem, surface_complexity = synthetic_dems.make_plane(nrows, ncols, CELL_SIZE, out=out)
+    elif surface == "sinusoid":
+        dem, surface_complexity = synthetic_dems.make_sinusoid(nrows, ncols, CELL_SIZE, out=out)
+    else:
+        dem, surface_complexity = synthetic_dems.make_diamond_square(nrows, ncols, out=out), None
+    if valid_fraction < 1:
+        synthetic_dems.add_nan_holes(dem, valid_fraction)
+        surface_complexity = None
+    return dem, surface_complexity
+
+def bench_surface_complexity(dem, expected):
+    value, seconds, peak = measure(calc_sc.calculate_site_surface_complexity, dem, CELL_SIZE)
+    result = {"seconds": seconds, "peak_bytes": peak, "value": value}
+    if expected is not None:
+        result["relative_error"] = abs(value - expected) / expected
+    return result
+
+def bench_site_index(dem):
+    site_index._site_index_cache.clear()
+    length_m = min(dem.shape) * CELL_SIZE / 20
+    site_height_m, site_width_m = site_index.calc_site_height_width(length_m, 45)
+    sites, seconds, peak = measure(site_index.find_valid_test_sites, dem, site_height_m,
+                                   site_width_m, CELL_SIZE, 100, seed=0)
+    return {"seconds": seconds, "peak_bytes": peak, "num_sites": len(sites)}
+
+def bench_site_random(dem, workdir, num_samples=200):
+    site_index._site_index_cache.clear()
+    site_index._nan_sat_registry.clear()
+    if isinstance(dem, np.memmap):
+        cache = derived_cache.open_cache(dem, CELL_SIZE, dem.filename, cache_dir=os.path.join(workdir, "derived"))
+        derived_cache.warm_site_index(dem, cache)
+    rng = np.random.default_rng(0)
+    max_length_m = min(dem.shape) * CELL_SIZE / 20
+
+    def run():
+        sites = []
+        for _ in range(num_samples):
+            site_height_m, site_width_m = site_index.calc_site_height_width(
+                rng.uniform(max_length_m / 2, max_length_m), rng.integers(0, 180))
+            sites += site_index.find_valid_test_sites(dem, site_height_m, site_width_m, CELL_SIZE, 1, seed=rng)
+        return sites
+    sites, seconds, peak = measure(run)
+    return {"seconds": seconds, "peak_bytes": peak, "num_sites": len(sites), "num_samples": num_samples}
+
+def bench_path_templates(dem):
+    chain_paths.get_path_template.cache_clear()
+    length_cells = min(dem.shape) // 4
+    start = (dem.shape[0] // 2, dem.shape[1] // 2)
+
+    def run():
+        for angle in range(180):
+            sample_rugosity.get_grid_points_rotation(start, angle, length_cells)
+    _, cold_seconds, peak = measure(run)
+    _, warm_seconds, _ = measure(run)
+    return {"seconds": cold_seconds, "warm_seconds": warm_seconds, "peak_bytes": peak,
+            "length_cells": length_cells}
+
+def bench_ingest(dem, workdir):
+    txt_path = os.path.join(workdir, "ingest_" + str(dem.shape[0]) + ".txt")
+    synthetic_dems.write_ascii_grid(dem, txt_path, CELL_SIZE)
+    _, seconds, peak = measure(convert_dem_to_npy.dem_txt_to_npy, txt_path, plotting=False)
+    result = {"seconds": seconds, "peak_bytes": peak, "file_bytes": os.path.getsize(txt_path),
+              "mb_per_s": os.path.getsize(txt_path) / seconds / 1e6}
+    for path in convert_dem_to_npy.get_cache_paths(txt_path) + (txt_path,):
+        os.remove(path)
+    return result
+
+def bench_float32(dem, expected, workdir):
+    if isinstance(dem, np.memmap):
+        dem32 = np.lib.format.open_memmap(os.path.join(workdir, "dem32_" + str(dem.shape[0]) + ".npy"),
+                                          mode='w+', dtype=np.float32, shape=dem.shape)
+        tile_rows = synthetic_dems.GENERATE_TILE_ROWS
+        for start in range(0, dem.shape[0], tile_rows):
+            dem32[start:start+tile_rows] = dem[start:start+tile_rows]
+    else:
+        dem32 = np.asarray(dem, dtype=np.float32)
+    value64, seconds64, peak64 = measure(calc_sc.calculate_site_surface_complexity, dem, CELL_SIZE)
+    value32, seconds32, peak32 = measure(calc_sc.calculate_site_surface_complexity, dem32, CELL_SIZE)
+
+    # The same chains on both, from the middle of the DEM in every direction
+    rng = np.random.default_rng(0)
+    num_chains = 1000
+    length_cells = max(2, min(dem.shape) // 8)
+    starts = np.stack((rng.integers(length_cells, max(length_cells+1, dem.shape[0]-length_cells), num_chains),
+                       rng.integers(length_cells, max(length_cells+1, dem.shape[1]-length_cells), num_chains)), axis=1)
+    angles = rng.integers(0, 180, num_chains)
+    lengths = np.full(num_chains, length_cells * CELL_SIZE / 2)
+    chain_args = (starts, angles, lengths, CELL_SIZE)
+    # Build the path templates first, so neither timing includes them
+    chain_paths.drop_chains_batch(dem, *chain_args)
+    (rugosity64, _, _), chain_seconds64, _ = measure(chain_paths.drop_chains_batch, dem, *chain_args)
+    (rugosity32, _, _), chain_seconds32, _ = measure(chain_paths.drop_chains_batch, dem32, *chain_args)
+
+    result = {"seconds": seconds32, "seconds_float64": seconds64, "peak_bytes": peak32,
+              "peak_bytes_float64": peak64, "dem_bytes": dem32.nbytes, "dem_bytes_float64": dem.nbytes,
+              "value": value32, "relative_deviation": abs(value32 - value64) / value64,
+              "chain_seconds": chain_seconds32, "chain_seconds_float64": chain_seconds64,
+              "chain_max_abs_deviation": float(np.nanmax(np.abs(rugosity32 - rugosity64), initial=0.0))}
+    if expected is not None:
+        result["relative_error"] = abs(value32 - expected) / expected
+    if isinstance(dem32, np.memmap):
+        os.remove(dem32.filename)
+    return result
+
+def import_in_fresh_interpreter(module, mode="time"):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT, module, mode] + HEAVY_MODULES,
+                                     cwd=root, text=True)
+    return json.loads(output)
+
+def bench_import(repeats=5):
+    # numpy alone is the floor every entry module pays
+    numpy_seconds = sorted(import_in_fresh_interpreter("numpy")["seconds"] for _ in range(repeats))
+    modules = {}
+    heavy_modules = set()
+    for module in IMPORT_MODULES:
+        runs = [import_in_fresh_interpreter(module) for _ in range(repeats)]
+        modules[module] = sorted(run["seconds"] for run in runs)[repeats // 2]
+        heavy_modules.update(*(run["heavy_modules"] for run in runs))
+    memory = import_in_fresh_interpreter(IMPORT_MODULES[0], "memory")
+    return {"seconds": modules[IMPORT_MODULES[0]], "peak_bytes": memory["peak_bytes"],
+            "numpy_seconds": numpy_seconds[repeats // 2], "modules": modules,
+            "heavy_modules": sorted(heavy_modules)}
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+'''
+Prints how much slower (>1) or faster (<1) each benchmark got compared to an older run
+'''
+def compare(results, old_path):
+    with open(old_path, 'r') as file:
+        old = {(result["benchmark"], result["cells"]): result for result in json.load(file)["results"]}
+    print("\nCompared to", old_path)
+    for result in results:
+        previous = old.get((result["benchmark"], result["cells"]))
+        if previous is None:
+            continue
+        print("  {:<20} {:>12} cells: time x{:.2f}, peak memory x{:.2f}".format(
+            result["benchmark"], result["cells"], result["seconds"] / max(previous["seconds"], 1e-12),
+            result["peak_bytes"] / max(previous["peak_bytes"], 1)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Rugosity Calculator on synthetic DEMs")
+    parser.add_argument("--sizes", nargs="+", type=float, default=[1e4, 1e5, 1e6],
+                        help="DEM sizes in cells, from 1e4 up to 1e9")
+    parser.add_argument("--surface", choices=["sinusoid", "plane", "fractal"], default="sinusoid")
+    parser.add_argument("--valid-fraction", type=float, default=1.0,
+                        help="fraction of valid (not NaN) cells, below 1 punches holes in the DEM")
+    parser.add_argument("--benchmarks", nargs="+",
+                        default=["surface_complexity", "site_index", "site_random", "path_templates", "ingest", "float32", "import"])
+    parser.add_argument("--max-ingest-cells", type=float, default=1e7,
+                        help="largest DEM written as text for the ingest benchmark")
+    parser.add_argument("--output", default="bench_results.json", help="JSON file for the results")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rugosity_bench_")
+    results = []
+    if "import" in args.benchmarks:
+        result = bench_import()
+        result.update(benchmark="import", cells=0)
+        results.append(result)
+        print("{:<20} {:>12} cells {:>10.4f} s {:>10.1f} MB peak (numpy alone {:.4f} s, heavy modules: {})".format(
+            "import", 0, result["seconds"], result["peak_bytes"] / 1e6, result["numpy_seconds"],
+            ", ".join(result["heavy_modules"]) or "none"))
+    try:
+        for size in args.sizes:
+            dem, expected = make_dem(args.surface, int(size), args.valid_fraction, workdir)
+            cells = int(dem.size)
+            for benchmark in args.benchmarks:
+                if benchmark == "surface_complexity":
+                    result = bench_surface_complexity(dem, expected)
+                elif benchmark == "site_index":
+                    if cells > MEMORY_LIMIT_CELLS:
+                        print("{:<20} {:>12} cells skipped, the site index does not fit in RAM".format(benchmark, cells))
+                        continue
+                    result = bench_site_index(dem)
+                elif benchmark == "site_random":
+                    result = bench_site_random(dem, workdir)
+                elif benchmark == "path_templates":
+                    result = bench_path_templates(dem)
+                elif benchmark == "ingest":
+                    if cells > args.max_ingest_cells:
+                        continue
+                    result = bench_ingest(dem, workdir)
+                elif benchmark == "float32":
+                    result = bench_float32(dem, expected, workdir)
+                elif benchmark == "import":
+                    continue
+                else:
+                    raise ValueError("Unknown benchmark " + benchmark)
+                result.update(benchmark=benchmark, cells=cells)
+                results.append(result)
+                print("{:<20} {:>12} cells {:>10.4f} s {:>10.1f} MB peak".format(
+                    benchmark, cells, result["seconds"], result["peak_bytes"] / 1e6))
+            del dem
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "surface": args.surface,
+            "valid_fraction": args.valid_fraction,
+            "cell_size": CELL_SIZE,
+        },
+        "results": results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print("Wrote", len(results), "results to", args.output)
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+'''
+Headless version of the Rugosity Calculator. It runs every DEM and parameter set of a
+manifest CSV without any prompts or plots and writes one result row per manifest row.
+
+Example manifest:
+    dem,num_samples,length,orientation,seed,surface_complexity
+    DEMS/area1.txt,500,2,R,42,Y
+    DEMS/area1.txt,500,1-3,45,42,N
+    DEMS/area2.npy,1000,2,R,,Y
+
+To run, in the terminal or command line type
+    python3 rugosity_batch.py manifest.csv -o OUTPUT/results.csv -j 4
+Add --report OUTPUT/report.json to also write the time spent in every stage of the
+calculation and counts of rejected sites and cut short chains.
+'''
+import argparse
+import os
+
+# Never open a plot window
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+from backend_code_files import batch_mode
+from backend_code_files import instrumentation
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Rugosity Calculator over a manifest of DEMs")
+    parser.add_argument("manifest", help="CSV with a dem column and optional num_samples, length, "
+                                         "orientation, seed and surface_complexity columns")
+    parser.add_argument("-o", "--output", default=os.path.join("OUTPUT", "batch_results.csv"),
+                        help="result CSV (default: OUTPUT/batch_results.csv)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of DEMs processed at the same time, 0 uses every core")
+    parser.add_argument("--dtype", choices=["float64", "float32"],
+                        help="precision .txt DEMs are converted to, float32 halves the memory (default: float64)")
+    parser.add_argument("--report", help="JSON file for the run statistics report (stage times and counters)")
+    args = parser.parse_args()
+
+    if args.report:
+        instrumentation.enable()
+    results = batch_mode.run_manifest(args.manifest, args.output, args.jobs or None, args.dtype)
+    num_errors = sum(1 for result in results if result.get("error"))
+    print("Wrote", len(results), "results to", args.output, "with", num_errors, "errors")
+    if args.report:
+        instrumentation.dump_report(args.report)
+        print("Wrote the run statistics report to", args.report)
+
+if __name__ == "__main__":
+    main()
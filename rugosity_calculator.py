@@ -1,21 +1,26 @@
 try:
-    import numpy as np 
-    import matplotlib.pyplot as plt
-    from tqdm import tqdm
+    import importlib.util
     import os
-    import math
-    import time
-    from art import *
+    import numpy as np
+    # matplotlib, tqdm and art are imported when first used, which keeps the start fast,
+    # but a missing one is still reported here
+    for module in ("matplotlib", "tqdm", "art"):
+        if importlib.util.find_spec(module) is None:
+            raise ImportError(module)
 except:
     print("Error: Please install the required libraries")
-    print("numpy, matplotlib, tqdm, os, math, time, art")
-    print("This can be done by running \"pip install numpy matplotlib tqdm os art time math\"")
+    print("numpy, matplotlib, tqdm, art")
+    print("This can be done by running \"pip install numpy matplotlib tqdm art\"")
     exit()
 
 try:
     from backend_code_files import convert_dem_to_npy as txt2npy
     from backend_code_files import calc_site_surface_complexity as calc_sc
     from backend_code_files import sample_rugosity as sample_rugosity
+    from backend_code_files import anisotropy
+    from backend_code_files import derived_cache
+    from backend_code_files import dem_display
+    from backend_code_files import instrumentation
 except Exception as e:
     print("Error: Could not find backend_code_files")
     print("Please make sure this folder is not missing!")
@@ -23,6 +28,7 @@ except Exception as e:
     exit()
 
 def intro():
+    from art import tprint
     tprint("Rugosity  Calculator")
     print("------------------------------------------------------------------------------")
     print("| This program will present several methods to measure the rugosity of a DEM |")
@@ -34,50 +40,48 @@ def intro():
     print("------------------------------------------------------------------------------")
     print("\n")
 '''
-This function loads a DEM file. If it's a .txt file, it will convert it to a .npz file
-for faster loading in the future (greater than 10x faster)
+This function loads a DEM file. If it's a .txt file, it will convert it to a .npy cache
+next to it for faster loading in the future. The cache is memory mapped, so only the
+parts of the DEM that are used get read, and it is rebuilt if the .txt file changes
 Inputs:
     None. It will prompt the user for a filepath
 Outputs:
     dem: the DEM as a numpy array
     cell_size: the cell size of the DEM
     name: the name of the DEM
+    filepath: the path the DEM was loaded from
 '''
 def load_file():
     print("Before running any experiments, please load a file \n \
         An example would be \"\DEMS\\area1.txt\" \n \
-                         or \"\DEMS\\area1.npz\" \n ")
+                         or \"\DEMS\\area1.npy\" \n \
+                         or \"\DEMS\\area1.flt\" \n ")
 
     filepath = input("Filepath to the DEM: ")
     print("")
     try:
-        if filepath.endswith(".txt"):
-            print("Saving DEM as numpy file")
-            print("This will allow for faster loading in the future")
+        if filepath.endswith((".txt", ".npy", ".npz", ".flt", ".hdr")):
             try:
-                dem, cell_size = txt2npy.dem_txt_to_npy(filepath)
+                dem, cell_size = txt2npy.load_dem(filepath, plotting=True)
+            except FileNotFoundError:
+                raise
             except Exception as e:
-                print("Error: Could not save numpy file. Maybe try doing this on a bigger computer?")
+                print("Error: Could not convert the DEM file. Make sure it is an ESRI ASCII grid")
                 print("Please try again \n")
                 print("Error from Python: ", e)
                 load_file()
-        elif filepath.endswith(".npz"):
-            data_npz = np.load(filepath)
-            cell_size = data_npz['name1']
-            dem = data_npz['name2']
         else:
-            print("Error: File must be a .txt or .npz file")
+            print("Error: File must be a .txt, .npy, .flt or .npz file")
             load_file()
     except Exception as e:
         print("File not found")
         print("Python Error: ", e)
         load_file()
     
-    name = filepath.split("\\")[-1]
-    name = filepath.split("\/")[-1]
-    name = name.split(".")[0]
+    # Name of the DEM without its folder or extension, e.g. "area1" for "DEMS/area1.txt"
+    name = os.path.splitext(os.path.basename(filepath.replace("\\", "/")))[0]
     print("")
-    return dem, cell_size, name
+    return dem, cell_size, name, filepath
 
 '''
 This function presents the user with the options menu
@@ -91,6 +95,8 @@ def choose_option():
     3) Measure random rugosity samples across entire DEM \n \
     4) Get more info about each choice \n \
     5) Tips and tricks \n \
+    6) Map local surface complexity at several window sizes \n \
+    7) Sweep rugosity over every chain orientation (anisotropy) \n \
     Q) Quit \n \
     Choice: ")
     print("")
@@ -106,12 +112,18 @@ def choose_option():
         This will measure the rugosity of random samples across the DEM \n \
         User can select number of samples, length and orientation of samples \n \
         Or can select a range of length and oreintation of samples that will be randomly selected\n")
+        print("6) Map local surface complexity at several window sizes \n \
+        This will measure the surface complexity of every window of the DEM \n \
+        For each window size a map is saved in the OUTPUT folder as a .npy file \n")
+        print("7) Sweep rugosity over every chain orientation (anisotropy) \n \
+        The same start sites are measured at every angle from 0 to 179 degrees and every chain length \n \
+        The mean rugosity of each angle is saved in the OUTPUT folder as a .csv file \n")
         choose_option()
 
     if choice == "5":
         print("\nTips and tricks: \n \
-        Make sure you have enough RAM to load the DEM.txt file, \n\
-        you might need a bigger computer to convert it \n\n \
+        The DEM.txt file is read in small batches, but the converted DEM \n\
+        still needs to fit in RAM \n\n \
         Make sure to trim the DEM in Agisoft Metashape before computing\n \
         Around the edges of the DEM there will be a lot of error and it needs to be trimmed\n \
         This can be done by using the polygon tool in Agisoft\n")
@@ -126,13 +138,15 @@ Inputs:
     dem: 2D numpy array of the DEM
     cell_size: the size of each cell in the DEM
     filename: the name of the DEM
+    cache: the derived data cache of the DEM
 Outputs:
     None
 '''
-def calc_surface_complexity(dem, cell_size, filename):
+def calc_surface_complexity(dem, cell_size, filename, cache):
     print("This will measure the surface complexity over the entire DEM")
-    print("This will take a while, please wait...")
-    sc = calc_sc.calculate_site_surface_complexity(dem, cell_size)
+    print("This will take a while the first time, please wait...")
+    # Use every core on this computer, the result is saved in the derived data cache
+    sc = derived_cache.cached_site_surface_complexity(dem, cell_size, cache, num_workers=None)
     print("Surface complexity (3D/2D) of", filename, "is", sc)
 
     return
@@ -144,45 +158,126 @@ Inputs:
     dem: 2D numpy array of the DEM
     cell_size: the size of each cell in the DEM
     filename: the name of the DEM
+    cache: the derived data cache of the DEM
 Outputs:
     None
 '''
-def random_sample_rugosity(dem, cell_size, filename):
-    sample_rugosity.sample_rugosity(dem, cell_size, filename)
+def random_sample_rugosity(dem, cell_size, filename, cache):
+    derived_cache.warm_site_index(dem, cache)
+    sample_rugosity.sample_rugosity(dem, cell_size, filename, lambda: derived_cache.get_pyramid(dem, cache))
+    return
+
+'''
+This function maps the local surface complexity of the DEM at several window sizes
+It will prompt the user for the window sizes and saves one map per size in the OUTPUT folder
+Inputs:
+    dem: 2D numpy array of the DEM
+    cell_size: the size of each cell in the DEM
+    filename: the name of the DEM
+    cache: the derived data cache of the DEM
+Outputs:
+    None
+'''
+def local_surface_complexity(dem, cell_size, filename, cache):
+    window_sizes = input("What window sizes in meters would you like to map? Separate them with commas\n \
+    Example: 0.5, 1, 2 \n \
+    Window sizes: ")
+    window_sizes = [float(size) for size in window_sizes.split(",")]
+    stride = int(input("How many cells apart should the windows be? (1 for a full resolution map): "))
+    print("")
+    os.makedirs("OUTPUT", exist_ok=True)
+    # The name can still hold the folder of the DEM, the maps always go to OUTPUT
+    out_prefix = os.path.join("OUTPUT", os.path.basename(filename) + "_complexity")
+    tables = derived_cache.get_area_tables(dem, cell_size, cache)
+    rasters = calc_sc.calc_local_surface_complexity(dem, cell_size, window_sizes, stride, out_prefix, tables)
+    for window_m, raster in rasters.items():
+        print("Window of", window_m, "m: mean complexity", np.nanmean(raster),
+              "saved as", out_prefix + "_" + str(window_m) + "m.npy")
+    return
+
+'''
+This function measures the rugosity of the DEM in every direction
+It will prompt the user for the chain lengths, number of sites and angle step, and saves
+the mean rugosity of each angle and length in the OUTPUT folder
+Inputs:
+    dem: 2D numpy array of the DEM
+    cell_size: the size of each cell in the DEM
+    filename: the name of the DEM
+    cache: the derived data cache of the DEM
+Outputs:
+    None
+'''
+def anisotropy_sweep(dem, cell_size, filename, cache):
+    lengths = input("What chain lengths in meters would you like to sweep? Separate them with commas\n \
+    Example: 0.5, 1, 2 \n \
+    Lengths: ")
+    lengths = [float(length) for length in lengths.split(",")]
+    num_sites = int(input("How many start sites should be measured at every angle? "))
+    angle_step = int(input("How many degrees apart should the angles be? (1 for every angle): "))
+    print("")
+    derived_cache.warm_site_index(dem, cache)
+    sweep = anisotropy.run_anisotropy_sweep(dem, cell_size, lengths, num_sites, angle_step)
+    summary = anisotropy.summarize_sweep(sweep)
+    print("Sweep seed:", sweep["seed"])
+    for j, length in enumerate(sweep["lengths"]):
+        means = summary["mean"][:, j]
+        if np.all(np.isnan(means)):
+            print("Length", length, "m: no chain had a rugosity")
+            continue
+        print("Length", length, "m: rugosity from", np.nanmin(means), "at", sweep["angles"][np.nanargmin(means)],
+              "degrees to", np.nanmax(means), "at", sweep["angles"][np.nanargmax(means)], "degrees")
+    # The name can still hold the folder of the DEM, the results always go to OUTPUT
+    out_prefix = os.path.join("OUTPUT", os.path.basename(filename) + "_anisotropy")
+    anisotropy.write_sweep_csv(sweep, summary, out_prefix + ".csv")
+    np.save(out_prefix + ".npy", sweep["rugosity"])
+    print("Saved the mean rugosity of each angle as", out_prefix + ".csv",
+          "and every chain (site x angle x length) as", out_prefix + ".npy")
     return
 
 def quit_program():
+    # Set RUGOSITY_INSTRUMENT=1 to get the run statistics report when quitting
+    if instrumentation.is_enabled():
+        instrumentation.dump_report()
     print("Exiting program...")
     print("Goodbye!")
     exit()
 
-try:
-    intro() # Print out the intro text
-    dem, cell_size, filename = load_file()
-
-    while True:
-        option_choice = choose_option()
-
-        if option_choice == "1":
-            print("You'll need to close the plot to continue")
-            plt.imshow(dem)
-            plt.colorbar()
-            plt.show()
-        elif option_choice == "2":
-            calc_surface_complexity(dem, cell_size, filename)
-        elif option_choice == "3":
-            random_sample_rugosity(dem, cell_size, filename)
-        elif option_choice == "Q" or option_choice == "q":
-            quit_program()
-        else:
-            print("Error: Invalid choice")
-            print("Please try again")
-        print("\n")
-# If the user presses Ctrl + C, exit the program
-except KeyboardInterrupt:
-    quit_program()
+# Only start the program when run as a script, not when worker processes import it
+if __name__ == "__main__":
+    try:
+        intro() # Print out the intro text
+        dem, cell_size, filename, filepath = load_file()
+        # Derived data (areas, masks, summed-area tables) is saved next to the DEM
+        cache = derived_cache.open_cache(dem, cell_size, filepath)
 
-except Exception as e:
-    print("There was an error.")
-    print("Error: ", e)
-    quit_program()
+        while True:
+            option_choice = choose_option()
+
+            if option_choice == "1":
+                import matplotlib.pyplot as plt
+                print("You'll need to close the plot to continue")
+                # Large DEMs are shown from the overview pyramid level that fits the screen
+                dem_display.show_dem(dem, derived_cache.get_pyramid(dem, cache))
+                plt.show()
+            elif option_choice == "2":
+                calc_surface_complexity(dem, cell_size, filename, cache)
+            elif option_choice == "3":
+                random_sample_rugosity(dem, cell_size, filename, cache)
+            elif option_choice == "6":
+                local_surface_complexity(dem, cell_size, filename, cache)
+            elif option_choice == "7":
+                anisotropy_sweep(dem, cell_size, filename, cache)
+            elif option_choice == "Q" or option_choice == "q":
+                quit_program()
+            else:
+                print("Error: Invalid choice")
+                print("Please try again")
+            print("\n")
+    # If the user presses Ctrl + C, exit the program
+    except KeyboardInterrupt:
+        quit_program()
+
+    except Exception as e:
+        print("There was an error.")
+        print("Error: ", e)
+        quit_program()
@@ -0,0 +1,40 @@
+'''
+Local query server for the Rugosity Calculator. DEMs are loaded and memory mapped once
+and kept resident, so lab tools can ask many small questions without reloading the DEM.
+
+Queries are JSON POSTs to http://127.0.0.1:8765/<query>:
+    surface_complexity  {"dem": "DEMS/area1.txt"}
+    sample_rugosity     {"dem": "DEMS/area1.txt", "num_samples": 200, "length": 2, "orientation": 45, "seed": 1}
+    roi                 {"dem": "DEMS/area1.txt", "bboxes": [[0, 0, 500, 500]]}
+                        {"dem": "DEMS/area1.txt", "rois": [{"name": "quadrat 1", "bbox": [xmin, ymin, xmax, ymax], "coords": "map"},
+                                                           {"polygon": [[row, col], [row, col], [row, col]]}]}
+    status              (GET) the resident DEMs
+
+To run, in the terminal or command line type
+    python3 rugosity_server.py --preload DEMS/area1.txt
+'''
+import argparse
+import os
+
+# Never open a plot window
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+from backend_code_files import query_server
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve rugosity queries over localhost HTTP")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on (default: 8765)")
+    parser.add_argument("--max-dems", type=int, default=query_server.DEFAULT_MAX_RESIDENT_DEMS,
+                        help="number of DEMs kept loaded at the same time")
+    parser.add_argument("--preload", nargs="*", default=[], help="DEMs to load before serving")
+    parser.add_argument("--dtype", choices=["float64", "float32"],
+                        help="precision .txt DEMs are converted to, float32 halves the memory (default: float64)")
+    args = parser.parse_args()
+    try:
+        query_server.serve(args.host, args.port, args.max_dems, args.preload, args.dtype)
+    except KeyboardInterrupt:
+        print("Exiting server...")
+
+if __name__ == "__main__":
+    main()
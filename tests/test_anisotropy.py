@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from backend_code_files import anisotropy
+from backend_code_files import synthetic_dems
+
+CELL_SIZE = 0.05
+
+@pytest.fixture(scope="module")
+def dem():
+    return synthetic_dems.make_diamond_square(80, 70, height=0.5, seed=51)
+
+@pytest.mark.parametrize("angle_step", [2.5, 0.5, 0, -15])
+def test_angle_step_must_be_whole_degrees(dem, angle_step):
+    with pytest.raises(ValueError, match="whole number of degrees"):
+        anisotropy.run_anisotropy_sweep(dem, CELL_SIZE, [0.5], 3, angle_step, seed=1)
+
+def test_whole_float_angle_step(dem):
+    sweep = anisotropy.run_anisotropy_sweep(dem, CELL_SIZE, [0.5], 3, 45.0, seed=1)
+    assert np.array_equal(sweep["angles"], [0, 45, 90, 135])
+    assert sweep["rugosity"].shape == (len(sweep["sites"]), 4, 1)
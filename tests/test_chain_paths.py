@@ -0,0 +1,154 @@
+import math
+import numpy as np
+import pytest
+from backend_code_files import chain_paths
+from backend_code_files import synthetic_dems
+
+CELL_SIZE = 0.05
+
+'''
+The per-chain loop drop_chains_batch replaced (from drop_chains_rotation, without the
+prints and plotting). Returns the rugosity, or None where the loop skipped the chain.
+'''
+def drop_chain_loop(grid, start_point, angle, length_cells, cell_size, chain_length_m):
+    u_points = chain_paths.get_path_template(angle, length_cells)[1] + np.asarray(start_point, dtype=np.int64)
+    chain_dist_calculated = 0
+    total_real_world_distance = 0
+    j = 0
+    try:
+        while chain_dist_calculated < chain_length_m:
+            elevation_change = grid[u_points[j, 0], u_points[j, 1]] \
+                - grid[u_points[j+1, 0], u_points[j+1, 1]]
+            if np.isnan(elevation_change):
+                break
+            physical_dist = np.sqrt(
+                (u_points[j, 0]-u_points[j+1, 0])**2 + (u_points[j, 1]-u_points[j+1, 1])**2)
+            physical_dist *= cell_size
+            total_real_world_distance += physical_dist
+            chain_dist_calculated += np.sqrt(elevation_change**2 + physical_dist**2)
+            j += 1
+    except IndexError:
+        pass
+    try:
+        return chain_dist_calculated/total_real_world_distance, j
+    except ZeroDivisionError:
+        return None, j
+
+'''
+The per-cell path walker get_path_template replaced (from get_grid_points_rotation). Returns
+the points and the cell of every point, before repeated cells are dropped.
+'''
+def walk_path_loop(start, angle_deg, length_cells):
+    x, y = start
+    points = [[x, y]]
+    cells_back = []
+    cells_forward = []
+    angle = angle_deg * np.pi/180
+    reverse_angle = angle + np.pi
+    while np.sqrt((x-start[0])**2 + (y-start[1])**2) < length_cells/3:
+        x += math.cos(reverse_angle)*chain_paths.STEP_SIZE
+        y += math.sin(reverse_angle)*chain_paths.STEP_SIZE
+        points.append([x, y])
+        cells_back.append((int(round(x, 0)), int(round(y, 0))))
+    x, y = start
+    while np.sqrt((x-start[0])**2 + (y-start[1])**2) < length_cells/2:
+        x += math.cos(angle)*chain_paths.STEP_SIZE
+        y += math.sin(angle)*chain_paths.STEP_SIZE
+        points.append([x, y])
+        cells_forward.append((int(round(x, 0)), int(round(y, 0))))
+    return np.array(points), cells_back, cells_forward
+
+def unique_path_cells(cells_back, cells_forward):
+    back = list(dict.fromkeys(cells_back))[::-1]
+    forward = list(dict.fromkeys(cells_forward))
+    return np.array(back + forward, dtype=np.int64).reshape(-1, 2)
+
+# Arms whose length is a whole number of steps end on a tie of the distance check
+def ends_on_step(length_cells):
+    return any(length > 0 and math.isclose(length/chain_paths.STEP_SIZE, round(length/chain_paths.STEP_SIZE))
+               for length in (length_cells/3, length_cells/2))
+
+LENGTHS = list(range(0, 41)) + [67, 100, 151, 200, 400]
+
+@pytest.mark.parametrize("angle", range(0, 180))
+def test_template_matches_walker_from_origin(angle):
+    for length_cells in LENGTHS:
+        points, cells_back, cells_forward = walk_path_loop((0, 0), angle, length_cells)
+        point_offsets, cell_offsets = chain_paths.get_path_template(angle, length_cells)
+        assert point_offsets.shape == points.shape
+        assert np.allclose(point_offsets, points, rtol=0, atol=1e-9)
+        assert np.array_equal(cell_offsets, unique_path_cells(cells_back, cells_forward))
+
+# At these angles some points land exactly on a .5 cell boundary (e.g. 100 steps of
+# 0.33*cos(60) is 16.5). The walker added the steps to the start point, so the floating
+# point error of the start decided the rounding. The template rounds the offsets instead,
+# so every start gets the same path.
+@pytest.mark.parametrize("angle", [30, 60, 120, 150])
+@pytest.mark.parametrize("start", [(37, 81), (500, 3), (1234, 987)])
+def test_template_only_differs_from_walker_on_ties(angle, start):
+    num_ties = 0
+    for length_cells in range(1, 201):
+        if ends_on_step(length_cells):
+            continue
+        points, cells_back, cells_forward = walk_path_loop(start, angle, length_cells)
+        point_offsets, cell_offsets = chain_paths.get_path_template(angle, length_cells)
+        assert np.allclose(point_offsets + start, points, rtol=0, atol=1e-9)
+        walker_cells = np.array(cells_back + cells_forward, dtype=np.int64).reshape(-1, 2)
+        template_cells = np.rint(point_offsets[1:]).astype(np.int64) + start
+        differ = np.any(walker_cells != template_cells, axis=1)
+        # Every cell that differs comes from a point on a tie, and is one cell away
+        on_tie = np.isclose(np.abs(point_offsets[1:] % 1), 0.5, rtol=0, atol=1e-9).any(axis=1)
+        assert np.all(on_tie[differ])
+        assert np.all(np.abs(walker_cells - template_cells)[differ] <= 1)
+        if not differ.any():
+            assert np.array_equal(cell_offsets + start, unique_path_cells(cells_back, cells_forward))
+        num_ties += int(on_tie.any())
+    assert num_ties > 0
+
+def test_templates_are_cached_and_read_only():
+    template = chain_paths.get_path_template(45, 30)
+    assert chain_paths.get_path_template(45, 30) is template
+    assert not template[0].flags.writeable and not template[1].flags.writeable
+
+@pytest.fixture(scope="module")
+def dem_with_holes():
+    dem = synthetic_dems.make_diamond_square(120, 110, height=0.5, seed=7)
+    synthetic_dems.add_nan_holes(dem, valid_fraction=0.9, hole_size=4, seed=8)
+    return dem
+
+def interior_chains(dem, num_chains, seed):
+    rng = np.random.default_rng(seed)
+    lengths_m = rng.uniform(0.3, 2.0, num_chains)
+    angles = rng.integers(0, 180, num_chains)
+    # The paths reach at most length_cells/2 from the start, keep them off the edges
+    margin = int(lengths_m.max()/CELL_SIZE)
+    starts = np.stack((rng.integers(margin, dem.shape[0]-margin, num_chains),
+                       rng.integers(margin, dem.shape[1]-margin, num_chains)), axis=1)
+    return starts, angles, lengths_m
+
+def test_batch_matches_per_chain_loop(dem_with_holes):
+    starts, angles, lengths_m = interior_chains(dem_with_holes, 300, seed=9)
+    rugosities, status, num_steps = chain_paths.drop_chains_batch(
+        dem_with_holes, starts, angles, lengths_m, CELL_SIZE)
+    assert not np.any(status == chain_paths.CHAIN_OUT_OF_BOUNDS)
+    # The holes stop some of the chains early
+    assert np.count_nonzero(status == chain_paths.CHAIN_NAN) > 0
+    for i in range(len(starts)):
+        length_cells = int(lengths_m[i]/CELL_SIZE)
+        rugosity, steps = drop_chain_loop(dem_with_holes, starts[i], angles[i], length_cells, CELL_SIZE, lengths_m[i])
+        assert num_steps[i] == steps
+        if rugosity is None:
+            assert np.isnan(rugosities[i])
+        else:
+            # The same sums in the same order, so bit for bit equal
+            assert rugosities[i] == rugosity
+
+def test_top_edge_stops_instead_of_wrapping(dem_with_holes):
+    # Paths start length_cells/3 behind the start point, at angle 0 that is above it. From
+    # row 2 the loop read rows -1, -2, ... at the bottom of the DEM instead.
+    grid = np.nan_to_num(dem_with_holes)
+    rugosities, status, num_steps = chain_paths.drop_chains_batch(grid, [(2, 50)], 0, 1.0, CELL_SIZE)
+    assert status[0] == chain_paths.CHAIN_OUT_OF_BOUNDS
+    assert num_steps[0] == 0 and np.isnan(rugosities[0])
+    rugosity, steps = drop_chain_loop(grid, (2, 50), 0, int(1.0/CELL_SIZE), CELL_SIZE, 1.0)
+    assert rugosity is not None and steps > 0
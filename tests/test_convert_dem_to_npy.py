@@ -0,0 +1,140 @@
+import os
+import numpy as np
+import pytest
+from backend_code_files import console
+from backend_code_files import convert_dem_to_npy
+from backend_code_files import synthetic_dems
+
+CELL_SIZE = 0.02
+NODATA = -32767
+
+@pytest.fixture(scope="module")
+def dem_with_holes():
+    dem = synthetic_dems.make_diamond_square(23, 17, seed=31)
+    synthetic_dems.add_nan_holes(dem, valid_fraction=0.8, hole_size=4, seed=32)
+    return dem
+
+def write_grid(dem, path, crlf=False):
+    synthetic_dems.write_ascii_grid(dem, str(path), CELL_SIZE, NODATA)
+    if crlf:
+        path.write_bytes(path.read_bytes().replace(b"\n", b"\r\n"))
+    return str(path)
+
+# Tiny chunks cut numbers, rows and CRLF pairs at every possible place
+@pytest.mark.parametrize("chunk_chars", [1, 7, 64, 1000, convert_dem_to_npy.DEFAULT_CHUNK_CHARS])
+@pytest.mark.parametrize("crlf", [False, True])
+def test_ascii_round_trip(dem_with_holes, tmp_path, chunk_chars, crlf):
+    path = write_grid(dem_with_holes, tmp_path / "dem.txt", crlf)
+    with console.quiet():
+        data, header = convert_dem_to_npy.read_ascii_grid(path, chunk_chars=chunk_chars)
+    assert (header["nrows"], header["ncols"]) == dem_with_holes.shape
+    assert header["cellsize"] == CELL_SIZE
+    assert np.array_equal(np.isnan(data), np.isnan(dem_with_holes))
+    # The grid is written with 6 decimals
+    assert np.allclose(data, dem_with_holes, rtol=0, atol=5e-7, equal_nan=True)
+
+def test_ascii_grid_cut_short(dem_with_holes, tmp_path):
+    path = tmp_path / "dem.txt"
+    write_grid(dem_with_holes, path)
+    lines = path.read_text().splitlines(keepends=True)
+    path.write_text("".join(lines[:-3]))
+    with console.quiet(), pytest.raises(ValueError, match="ended after 20 of 23 rows"):
+        convert_dem_to_npy.read_ascii_grid(str(path), chunk_chars=64)
+
+def test_cache_is_reused_and_rebuilt_when_stale(dem_with_holes, tmp_path):
+    path = write_grid(dem_with_holes, tmp_path / "dem.txt")
+    npy_path, _ = convert_dem_to_npy.get_cache_paths(path)
+    with console.quiet():
+        first, cell_size = convert_dem_to_npy.load_dem(path, dtype=np.float64)
+    assert cell_size == CELL_SIZE
+    assert isinstance(first, np.memmap) and first.filename == str(npy_path)
+    assert convert_dem_to_npy.is_cache_fresh(path)
+    built = (tmp_path / "dem.npy").stat().st_mtime_ns
+
+    # Touching the source without editing it keeps the cache, after checking the hash
+    stat = (tmp_path / "dem.txt").stat()
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    assert convert_dem_to_npy.is_cache_fresh(path)
+    with console.quiet():
+        convert_dem_to_npy.load_dem(path, dtype=np.float64)
+    assert (tmp_path / "dem.npy").stat().st_mtime_ns == built
+
+    # Editing the source rebuilds it, also when the size stays the same
+    changed = np.array(dem_with_holes)
+    (y0, x0), (y1, x1) = np.argwhere(~np.isnan(changed))[[0, -1]]
+    # Swapping two cells keeps the file size
+    changed[y0, x0], changed[y1, x1] = changed[y1, x1], changed[y0, x0]
+    write_grid(changed, tmp_path / "dem.txt")
+    assert (tmp_path / "dem.txt").stat().st_size == stat.st_size
+    stat = (tmp_path / "dem.txt").stat()
+    os.utime(path, (stat.st_atime, stat.st_mtime + 20))
+    assert not convert_dem_to_npy.is_cache_fresh(path)
+    with console.quiet():
+        rebuilt, _ = convert_dem_to_npy.load_dem(path, dtype=np.float64)
+    assert np.allclose(rebuilt, changed, rtol=0, atol=5e-7, equal_nan=True)
+    assert convert_dem_to_npy.is_cache_fresh(path)
+
+def test_interrupted_conversion_is_not_a_cache(dem_with_holes, tmp_path):
+    path = write_grid(dem_with_holes, tmp_path / "dem.txt")
+    with console.quiet():
+        convert_dem_to_npy.load_dem(path, dtype=np.float64)
+    npy_path, _ = convert_dem_to_npy.get_cache_paths(path)
+    os.remove(npy_path)
+    assert not convert_dem_to_npy.is_cache_fresh(path)
+    with console.quiet():
+        data, _ = convert_dem_to_npy.load_dem(path, dtype=np.float64)
+    assert np.allclose(data, dem_with_holes, rtol=0, atol=5e-7, equal_nan=True)
+
+def write_flt(dem, path, byte_order, nodata=-9999.0):
+    data = np.where(np.isnan(dem), nodata, dem).astype(byte_order + "f4")
+    data.tofile(str(path) + ".flt")
+    with open(str(path) + ".hdr", 'w') as file:
+        file.write("NCOLS " + str(dem.shape[1]) + "\nNROWS " + str(dem.shape[0]) + "\n")
+        file.write("xllcorner 100.0\nyllcorner 200.0\ncellsize " + repr(CELL_SIZE) + "\n")
+        file.write("NODATA_value " + repr(nodata) + "\n")
+        file.write("byteorder " + ("MSBFIRST" if byte_order == ">" else "LSBFIRST") + "\n")
+    return str(path) + ".flt"
+
+@pytest.mark.parametrize("byte_order", [">", "<"])
+def test_flt_with_nodata(dem_with_holes, tmp_path, byte_order):
+    path = write_flt(dem_with_holes, tmp_path / "dem", byte_order)
+    expected = dem_with_holes.astype(np.float32)
+    with console.quiet():
+        dem, cell_size = convert_dem_to_npy.load_dem(path)
+    assert cell_size == CELL_SIZE
+    assert dem.dtype == np.dtype("=f4")
+    assert np.array_equal(dem, expected, equal_nan=True)
+    # The NaN-masked copy is used from then on
+    assert dem.filename == str(tmp_path / "dem_f32.npy")
+    with console.quiet():
+        again, _ = convert_dem_to_npy.load_dem(str(tmp_path / "dem.hdr"))
+    assert again.filename == dem.filename
+    assert np.array_equal(again, expected, equal_nan=True)
+    assert convert_dem_to_npy.read_georeference(path)["xllcorner"] == 100.0
+
+def test_flt_without_nodata_is_not_copied(dem_with_holes, tmp_path):
+    path = write_flt(np.nan_to_num(dem_with_holes, nan=0.5), tmp_path / "dem", ">")
+    with console.quiet():
+        dem, _ = convert_dem_to_npy.load_dem(path)
+    assert dem.filename == path
+    assert not os.path.exists(tmp_path / "dem_f32.npy")
+    metadata = convert_dem_to_npy.read_cache_metadata(path, np.float32)
+    assert metadata["has_npy"] is False
+    assert metadata["source_sha256"] == convert_dem_to_npy.hash_file(path)
+
+# NODATA only in the last rows, so the copy starts after several tiles were scanned
+def test_flt_copy_starts_at_first_nodata_tile(dem_with_holes, tmp_path, monkeypatch):
+    monkeypatch.setattr(convert_dem_to_npy, "NODATA_TILE_CELLS", 3*dem_with_holes.shape[1])
+    grid = np.nan_to_num(dem_with_holes, nan=0.5)
+    grid[-2:, 3] = np.nan
+    path = write_flt(grid, tmp_path / "dem", "<")
+    # Bytes past the grid are hashed too
+    with open(path, 'ab') as file:
+        file.write(b"trailing")
+    with console.quiet():
+        dem, _ = convert_dem_to_npy.load_dem(path)
+    assert dem.filename == str(tmp_path / "dem_f32.npy")
+    assert np.array_equal(dem, grid.astype(np.float32), equal_nan=True)
+    metadata = convert_dem_to_npy.read_cache_metadata(path, np.float32)
+    assert metadata["has_npy"] is True
+    assert metadata["source_sha256"] == convert_dem_to_npy.hash_file(path)
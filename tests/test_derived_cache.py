@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from backend_code_files import calc_site_surface_complexity as calc_sc
+from backend_code_files import derived_cache
+from backend_code_files import site_index
+from backend_code_files import synthetic_dems
+
+CELL_SIZE = 0.01
+
+@pytest.fixture
+def dem_with_holes():
+    dem = synthetic_dems.make_diamond_square(41, 23, seed=3)
+    synthetic_dems.add_nan_holes(dem, valid_fraction=0.8, hole_size=5, seed=4)
+    dem[:, 0] = np.nan
+    return dem
+
+@pytest.fixture
+def small_tiles(monkeypatch):
+    # A few rows per tile, so the products are built over many tiles
+    monkeypatch.setattr(calc_sc, "DEFAULT_TILE_CELLS", 100)
+
+def test_validity_matches_in_memory_tables(dem_with_holes, small_tiles, tmp_path):
+    cache = derived_cache.open_cache(dem_with_holes, CELL_SIZE, cache_dir=str(tmp_path))
+    nan_mask, nan_sat = derived_cache.get_validity(dem_with_holes, cache)
+    reference = site_index.summed_area_table(np.isnan(dem_with_holes))
+    assert isinstance(nan_sat, np.memmap)
+    assert nan_sat.dtype == reference.dtype
+    assert np.array_equal(nan_sat, reference)
+    assert np.array_equal(nan_mask, np.isnan(dem_with_holes))
+
+def test_quad_areas_match_in_memory_raster(dem_with_holes, small_tiles, tmp_path):
+    cache = derived_cache.open_cache(dem_with_holes, CELL_SIZE, cache_dir=str(tmp_path))
+    quad_areas = derived_cache.get_quad_areas(dem_with_holes, CELL_SIZE, cache)
+    assert np.array_equal(quad_areas, calc_sc.calc_quad_areas(dem_with_holes, CELL_SIZE), equal_nan=True)
+    # The second call loads the saved product
+    assert np.array_equal(derived_cache.get_quad_areas(dem_with_holes, CELL_SIZE, cache), quad_areas, equal_nan=True)
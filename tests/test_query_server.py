@@ -0,0 +1,61 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+import pytest
+from backend_code_files import query_server
+from backend_code_files import synthetic_dems
+
+@pytest.fixture(scope="module")
+def server_url():
+    server = query_server.ThreadingHTTPServer(("127.0.0.1", 0), query_server.QueryHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:" + str(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(scope="module")
+def dem_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp("dems") / "dem.txt"
+    synthetic_dems.write_ascii_grid(synthetic_dems.make_diamond_square(60, 50, height=0.2, seed=41), str(path), 0.05)
+    return str(path)
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(), method="POST")
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+def test_missing_field_is_a_bad_request(server_url):
+    status, body = post(server_url + "/surface_complexity", {})
+    assert status == 400
+    assert body["error"] == "Missing field 'dem'"
+
+def test_other_errors_are_server_errors(server_url, dem_path):
+    # A KeyError raised while answering is not a missing field of the request
+    status, body = post(server_url + "/roi", {"dem": dem_path, "rois": [{"name": "no shape"}]})
+    assert status == 500
+    status, _ = post(server_url + "/surface_complexity", {"dem": dem_path + ".missing.txt"})
+    assert status == 500
+
+def test_concurrent_queries(server_url, dem_path):
+    results = []
+    def query(seed):
+        results.append(post(server_url + "/sample_rugosity",
+                            {"dem": dem_path, "num_samples": 30, "length": 0.5, "seed": seed}))
+    threads = [threading.Thread(target=query, args=(seed % 3,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(status == 200 for status, _ in results)
+    # The same seed gives the same answer, whatever ran next to it
+    means = {}
+    for _, body in results:
+        means.setdefault(body["seed"], set()).add(body["rugosity_mean"])
+    assert all(len(values) == 1 for values in means.values())
+    assert np.isfinite([body["rugosity_mean"] for _, body in results]).all()
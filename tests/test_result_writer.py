@@ -0,0 +1,82 @@
+import os
+import numpy as np
+import pytest
+from backend_code_files import console
+from backend_code_files import result_writer
+from backend_code_files import sampling_engine
+
+CELL_SIZE = 0.01
+NUM_SAMPLES = 3*sampling_engine.SAMPLES_PER_BLOCK - 50
+SEED = 12345
+
+@pytest.fixture(scope="module")
+def dem():
+    return np.random.default_rng(0).random((120, 150))
+
+@pytest.fixture(scope="module")
+def uninterrupted(dem):
+    with console.quiet():
+        samples, _ = sampling_engine.run_sampling(dem, CELL_SIZE, NUM_SAMPLES, 0.2, None, SEED)
+    return samples
+
+def assert_same_samples(a, b):
+    assert len(a) == len(b)
+    for field in a.dtype.names:
+        assert np.array_equal(a[field], b[field], equal_nan=a[field].dtype.kind == 'f'), field
+
+'''
+Leaves an output the way a crash would: the first blocks checkpointed, then half a block
+written after the checkpoint
+'''
+def interrupt_run(dem, path, fmt, blocks_done):
+    run_info = {"seed": SEED, "num_samples": NUM_SAMPLES, "cell_size": CELL_SIZE, "length": 0.2,
+                "orientation": None, "dem_shape": list(dem.shape),
+                "samples_per_block": sampling_engine.SAMPLES_PER_BLOCK}
+    blocks = sampling_engine.make_blocks(np.random.SeedSequence(SEED), CELL_SIZE, NUM_SAMPLES, 0.2, None)
+    writer = result_writer.ResultWriter(path, run_info, sampling_engine.SAMPLE_DTYPE, fmt)
+    for block in range(blocks_done):
+        writer.write_block(block, sampling_engine.sample_block(dem, *blocks[block]))
+    writer.checkpoint()
+    # Written after the last checkpoint, so a resume has to cut it off
+    writer.write_block(blocks_done, sampling_engine.sample_block(dem, *blocks[blocks_done])[:100])
+    files = [writer.file] if fmt == "csv" else list(writer.files.values())
+    for file in files:
+        file.close()
+
+@pytest.mark.parametrize("fmt, name", [("csv", "run.csv"), ("columns", "run")])
+@pytest.mark.parametrize("blocks_done", [0, 1, 2])
+def test_resume_matches_uninterrupted(dem, uninterrupted, tmp_path, fmt, name, blocks_done):
+    path = str(tmp_path / name)
+    interrupt_run(dem, path, fmt, blocks_done)
+    with console.quiet():
+        # No seed: the run adopts the one of the checkpoint
+        samples, seed = sampling_engine.run_sampling(dem, CELL_SIZE, NUM_SAMPLES, 0.2, None, output=path)
+    assert seed == SEED
+    assert_same_samples(samples, uninterrupted)
+    written, seeds = result_writer.read_results(path, sampling_engine.SAMPLE_DTYPE)
+    assert_same_samples(written, uninterrupted)
+    assert seeds.tolist() == [str(SEED)]*NUM_SAMPLES
+    assert result_writer.read_checkpoint(path)["complete"]
+
+def test_streamed_output_matches_samples(dem, uninterrupted, tmp_path):
+    path = str(tmp_path / "run.csv")
+    with console.quiet():
+        samples, _ = sampling_engine.run_sampling(dem, CELL_SIZE, NUM_SAMPLES, 0.2, None, SEED, output=path)
+    assert_same_samples(samples, uninterrupted)
+    assert_same_samples(result_writer.read_results(path, sampling_engine.SAMPLE_DTYPE)[0], uninterrupted)
+
+def test_other_run_is_refused(dem, tmp_path):
+    path = str(tmp_path / "run.csv")
+    interrupt_run(dem, path, "csv", 1)
+    with console.quiet(), pytest.raises(ValueError):
+        sampling_engine.run_sampling(dem, CELL_SIZE, NUM_SAMPLES, 0.5, None, output=path)
+
+def test_columns_keep_the_seed_once(uninterrupted, tmp_path):
+    path = str(tmp_path / "run")
+    result_writer.write_results(path, uninterrupted, {"seed": SEED}, sampling_engine.SAMPLE_DTYPE, "columns")
+    assert sorted(os.listdir(path)) == sorted(field + ".bin" for field in result_writer.RESULT_FIELDS[1:])
+    assert os.path.getsize(os.path.join(path, "block.bin")) == 8*len(uninterrupted)
+    assert result_writer.read_checkpoint(path)["run_info"]["seed"] == SEED
+    written, seeds = result_writer.read_results(path, sampling_engine.SAMPLE_DTYPE)
+    assert_same_samples(written, uninterrupted)
+    assert seeds.tolist() == [str(SEED)]*len(uninterrupted)
@@ -0,0 +1,36 @@
+import math
+import numpy as np
+import pytest
+from backend_code_files import api
+from backend_code_files import calc_site_surface_complexity as calc_sc
+from backend_code_files import derived_cache
+from backend_code_files import roi
+from backend_code_files import synthetic_dems
+
+CELL_SIZE = 0.01
+# Inside, touching the edges, partly and fully outside the DEM, and too small for a quad
+BBOXES = [(3, 4, 20, 18), (0, 0, 33, 27), (-5, -5, 10, 40), (30, 20, 50, 50), (40, 40, 50, 50), (5, 5, 6, 9)]
+
+@pytest.fixture(scope="module")
+def dem_with_holes():
+    dem = synthetic_dems.make_diamond_square(33, 27, seed=5)
+    synthetic_dems.add_nan_holes(dem, valid_fraction=0.85, hole_size=4, seed=6)
+    return dem
+
+@pytest.mark.parametrize("bbox", BBOXES)
+def test_bbox_window_matches_area_tables(dem_with_holes, bbox):
+    tables = calc_sc.calc_area_tables(dem_with_holes, CELL_SIZE)
+    area_3d, count = roi.bbox_window_area_sums(dem_with_holes, CELL_SIZE, bbox)
+    table_area_3d, table_count = calc_sc.bbox_area_sums(tables, bbox)
+    assert count == table_count
+    assert math.isclose(area_3d, table_area_3d, rel_tol=1e-12, abs_tol=1e-15)
+
+def test_api_uses_cached_area_tables(dem_with_holes, tmp_path):
+    rois = [{"name": str(bbox), "bbox": list(bbox)} for bbox in BBOXES]
+    rois.append({"name": "triangle", "polygon": [[2, 2], [25, 4], [10, 20]]})
+    cache = derived_cache.open_cache(dem_with_holes, CELL_SIZE, cache_dir=str(tmp_path))
+    cached = api.roi_surface_complexity(dem_with_holes, CELL_SIZE, rois, cache=cache)
+    windowed = api.roi_surface_complexity(dem_with_holes, CELL_SIZE, rois)
+    for with_cache, without_cache in zip(cached, windowed):
+        assert with_cache["num_quads"] == without_cache["num_quads"]
+        assert math.isclose(with_cache["area_3d"], without_cache["area_3d"], rel_tol=1e-12, abs_tol=1e-15)
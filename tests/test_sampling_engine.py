@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from backend_code_files import console
+from backend_code_files import sampling_engine
+from backend_code_files import synthetic_dems
+
+CELL_SIZE = 0.05
+# A few blocks, the last one partly filled
+NUM_SAMPLES = 4*sampling_engine.SAMPLES_PER_BLOCK - 30
+SEED = 2024
+
+@pytest.fixture(scope="module")
+def dem_with_holes():
+    dem = synthetic_dems.make_diamond_square(200, 180, height=0.5, seed=21)
+    synthetic_dems.add_nan_holes(dem, valid_fraction=0.95, hole_size=25, seed=22)
+    return dem
+
+def assert_same_samples(a, b):
+    assert len(a) == len(b)
+    for field in a.dtype.names:
+        assert np.array_equal(a[field], b[field], equal_nan=a[field].dtype.kind == 'f'), field
+
+@pytest.mark.parametrize("length, orientation", [((1, 3), None), (1.5, 37.5)])
+def test_samples_do_not_depend_on_workers(dem_with_holes, tmp_path, length, orientation):
+    # A memory mapped DEM is reopened by the workers, an in-memory one goes through shared memory
+    np.save(tmp_path / "dem.npy", dem_with_holes)
+    memmapped = np.load(tmp_path / "dem.npy", mmap_mode='r')
+    with console.quiet():
+        single, seed = sampling_engine.run_sampling(dem_with_holes, CELL_SIZE, NUM_SAMPLES, length, orientation, SEED, 1)
+        for dem in (dem_with_holes, memmapped):
+            samples, pool_seed = sampling_engine.run_sampling(dem, CELL_SIZE, NUM_SAMPLES, length, orientation, SEED, 3)
+            assert pool_seed == seed
+            assert_same_samples(samples, single)
+    assert len(single) == NUM_SAMPLES
+    assert np.array_equal(np.unique(single["block"]), np.arange(4))
+
+@pytest.mark.parametrize("target_error", [0.002, 1e-9])
+def test_adaptive_samples_do_not_depend_on_workers(dem_with_holes, target_error):
+    with console.quiet():
+        single, seed, summary = sampling_engine.run_adaptive_sampling(
+            dem_with_holes, CELL_SIZE, (1, 3), None, SEED, target_error, max_samples=NUM_SAMPLES, num_workers=1)
+        pooled, pool_seed, pool_summary = sampling_engine.run_adaptive_sampling(
+            dem_with_holes, CELL_SIZE, (1, 3), None, SEED, target_error, max_samples=NUM_SAMPLES, num_workers=3)
+        fixed, _ = sampling_engine.run_sampling(dem_with_holes, CELL_SIZE, NUM_SAMPLES, (1, 3), None, SEED)
+    assert pool_seed == seed
+    assert_same_samples(pooled, single)
+    assert pool_summary == summary
+    # The adaptive run stops at a prefix of the fixed run with the same seed
+    assert_same_samples(single, fixed[:len(single)])
+    assert summary["converged"] == (len(single) < NUM_SAMPLES)
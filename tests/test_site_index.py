@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+from backend_code_files import console
+from backend_code_files import site_index
+from backend_code_files import synthetic_dems
+
+CELL_SIZE = 0.1
+# Half sizes of the site in cells: empty, fractional, tall, wide, and too big to fit
+HALF_SIZES = [(0, 0), (0.5, 0.5), (1.5, 2.5), (4, 1), (2, 6.5), (12.5, 3), (40, 40)]
+
+@pytest.fixture(scope="module")
+def dem_with_holes():
+    dem = synthetic_dems.make_diamond_square(45, 38, seed=11)
+    synthetic_dems.add_nan_holes(dem, valid_fraction=0.85, hole_size=4, seed=12)
+    dem[:, 0] = np.nan
+    dem[-2, :] = np.nan
+    return dem
+
+'''
+The check of the original random search (from find_valid_test_sites): the center is not
+NaN, the site fits inside the DEM and its window holds no NaN cells
+'''
+def accepts(grid, y, x, num_cells_h, num_cells_w):
+    height, width = grid.shape
+    if np.isnan(grid[y][x]):
+        return False
+    if y-num_cells_h < 0 or y+num_cells_h > height or x-num_cells_w < 0 or x+num_cells_w > width:
+        return False
+    sub_grid = grid[int(y-num_cells_h):int(y+num_cells_h), int(x-num_cells_w):int(x+num_cells_w)]
+    return not np.isnan(sub_grid).any()
+
+# Every center the random search could draw and accept, as flat indices
+def brute_force_centers(grid, num_cells_h, num_cells_w):
+    height, width = grid.shape
+    return np.array([y*width + x for y in range(1, height) for x in range(1, width)
+                     if accepts(grid, y, x, num_cells_h, num_cells_w)], dtype=np.int64)
+
+@pytest.mark.parametrize("num_cells_h, num_cells_w", HALF_SIZES)
+def test_site_index_matches_brute_force(dem_with_holes, num_cells_h, num_cells_w):
+    expected = brute_force_centers(dem_with_holes, num_cells_h, num_cells_w)
+    assert np.array_equal(site_index.build_site_index(dem_with_holes, num_cells_h, num_cells_w), expected)
+    nan_sat = site_index.summed_area_table(np.isnan(dem_with_holes))
+    assert np.array_equal(site_index.build_site_index(dem_with_holes, num_cells_h, num_cells_w, nan_sat), expected)
+
+@pytest.mark.parametrize("num_cells_h, num_cells_w", HALF_SIZES)
+def test_draws_are_valid_centers(dem_with_holes, num_cells_h, num_cells_w):
+    expected = set(brute_force_centers(dem_with_holes, num_cells_h, num_cells_w).tolist())
+    # Sites of 2*num_cells cells, the sizes get_valid_centers turns back into half sizes
+    site_hight_m, site_width_m = 2*num_cells_h*CELL_SIZE + CELL_SIZE/2, 2*num_cells_w*CELL_SIZE + CELL_SIZE/2
+    rng = np.random.default_rng(13)
+    draws = [site_index.draw_valid_center(dem_with_holes, site_hight_m, site_width_m, CELL_SIZE, rng)
+             for _ in range(300)]
+    drawn = [draw for draw in draws if draw is not None]
+    assert set(drawn) <= expected
+    if not expected:
+        assert not drawn
+    elif len(expected) > 20:
+        # Uniform over the valid centers, so a few hundred draws spread over many of them
+        assert len(set(drawn)) > min(len(expected), 300) // 4
+    assert set(site_index.get_valid_centers(dem_with_holes, site_hight_m, site_width_m, CELL_SIZE).tolist()) == expected
+
+def test_single_site_search_is_valid(dem_with_holes):
+    width = dem_with_holes.shape[1]
+    num_cells_h, num_cells_w = int(0.6/CELL_SIZE)/2, int(0.9/CELL_SIZE)/2
+    expected = set(brute_force_centers(dem_with_holes, num_cells_h, num_cells_w).tolist())
+    for seed in range(50):
+        sites = site_index.find_valid_test_sites(dem_with_holes, 0.6, 0.9, CELL_SIZE, 1, seed=seed)
+        assert len(sites) == 1
+        y, x = sites[0]
+        assert y*width + x in expected
+
+def test_no_room_returns_no_sites(dem_with_holes):
+    with console.quiet():
+        assert site_index.find_valid_test_sites(dem_with_holes, 10.0, 10.0, CELL_SIZE, 1, seed=1) == []
+
+# The pairwise overlap check of the original search, placing candidates in order
+def place_pairwise(candidates, width, num_cells_h, num_cells_w, num_sites):
+    valid_sites = []
+    for center in candidates:
+        if len(valid_sites) >= num_sites:
+            break
+        y, x = divmod(int(center), width)
+        if not any(abs(site_x - x) < num_cells_w*2 and abs(site_y - y) < num_cells_h*2
+                   for site_y, site_x in valid_sites):
+            valid_sites.append((y, x))
+    return valid_sites
+
+@pytest.mark.parametrize("num_cells_h, num_cells_w", [(0, 0), (0.5, 0.5), (1.5, 2.5), (4, 1), (2, 6.5)])
+def test_spatial_hash_matches_pairwise_check(num_cells_h, num_cells_w):
+    width = 60
+    candidates = np.random.default_rng(14).permutation(30*width)
+    for num_sites in (1, 50, 10**6):
+        assert site_index.place_non_overlapping_sites(candidates, width, num_cells_h, num_cells_w, num_sites) == \
+            place_pairwise(candidates, width, num_cells_h, num_cells_w, num_sites)
+
+def test_placed_sites_do_not_overlap_and_are_seeded(dem_with_holes):
+    num_cells_h, num_cells_w = int(0.5/CELL_SIZE)/2, int(0.3/CELL_SIZE)/2
+    expected = set(brute_force_centers(dem_with_holes, num_cells_h, num_cells_w).tolist())
+    with console.quiet():
+        sites = site_index.find_valid_test_sites(dem_with_holes, 0.5, 0.3, CELL_SIZE, 40, seed=15)
+        assert site_index.find_valid_test_sites(dem_with_holes, 0.5, 0.3, CELL_SIZE, 40, seed=15) == sites
+        assert site_index.find_valid_test_sites(dem_with_holes, 0.5, 0.3, CELL_SIZE, 40, seed=16) != sites
+    assert len(sites) > 1
+    width = dem_with_holes.shape[1]
+    assert all(y*width + x in expected for y, x in sites)
+    for i, (y, x) in enumerate(sites):
+        for site_y, site_x in sites[:i]:
+            assert not (abs(site_x - x) < num_cells_w*2 and abs(site_y - y) < num_cells_h*2)
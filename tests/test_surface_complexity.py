@@ -0,0 +1,57 @@
+import math
+import numpy as np
+import pytest
+from backend_code_files import calc_site_surface_complexity as calc_sc
+from backend_code_files import console
+from backend_code_files import synthetic_dems
+
+CELL_SIZE = 0.01
+
+@pytest.fixture(scope="module")
+def dem_with_holes():
+    dem = synthetic_dems.make_diamond_square(37, 29, seed=1)
+    synthetic_dems.add_nan_holes(dem, valid_fraction=0.8, hole_size=6, seed=2)
+    # A NaN row and column edge, and a single NaN cell
+    dem[0, :] = np.nan
+    dem[:, -1] = np.nan
+    dem[20, 10] = np.nan
+    return dem
+
+@pytest.fixture(scope="module")
+def reference(dem_with_holes):
+    with console.quiet():
+        return calc_sc.calculate_site_surface_complexity_reference(dem_with_holes, CELL_SIZE)
+
+@pytest.mark.parametrize("tile_rows", [1, 2, 5, 36, None])
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_matches_reference(dem_with_holes, reference, tile_rows, num_workers):
+    with console.quiet():
+        value = calc_sc.calculate_site_surface_complexity(dem_with_holes, CELL_SIZE, tile_rows, num_workers)
+    assert math.isclose(value, reference, rel_tol=1e-12)
+
+def test_independent_of_tiles_and_workers(dem_with_holes):
+    with console.quiet():
+        values = {calc_sc.calculate_site_surface_complexity(dem_with_holes, CELL_SIZE, tile_rows, num_workers)
+                  for tile_rows in (1, 2, 5, 36, None) for num_workers in (1, 2, 3)}
+    # The rows are combined with math.fsum, so every tiling gives exactly the same value
+    assert len(values) == 1
+
+def test_valid_quad_count(dem_with_holes):
+    with console.quiet():
+        _, row_valid = calc_sc.calc_site_row_sums(dem_with_holes, CELL_SIZE, tile_rows=4)
+    dem = dem_with_holes
+    valid = ~(np.isnan(dem[:-1, :-1]) | np.isnan(dem[1:, :-1]) | np.isnan(dem[:-1, 1:]) | np.isnan(dem[1:, 1:]))
+    assert np.array_equal(row_valid, valid.sum(axis=1))
+
+def test_plane_is_exact():
+    dem, expected = synthetic_dems.make_plane(20, 30, CELL_SIZE)
+    with console.quiet():
+        value = calc_sc.calculate_site_surface_complexity(dem, CELL_SIZE, tile_rows=3)
+    assert math.isclose(value, expected, rel_tol=1e-12)
+
+def test_area_tables_match_row_sums(dem_with_holes):
+    with console.quiet():
+        row_area_3d, row_valid = calc_sc.calc_site_row_sums(dem_with_holes, CELL_SIZE)
+    area_sat, count_sat = calc_sc.calc_area_tables(dem_with_holes, CELL_SIZE, tile_rows=4)
+    assert count_sat[-1, -1] == row_valid.sum()
+    assert math.isclose(area_sat[-1, -1], math.fsum(row_area_3d), rel_tol=1e-12)